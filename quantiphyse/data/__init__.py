@@ -16,10 +16,13 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from .qpdata import DataGrid, OrthoSlice, QpData, NumpyData
+from .qpdata import DataGrid, OrthoSlice, QpData, NumpyData, label_dtype, as_label_array
 from .volume_management import ImageVolumeManagement
 from .load_save import load, save
 from .nifti import NiftiData
+from .sparse import SparseRoiData
+from .expression import ExpressionData
+from .session import save_session, load_session
 
 __all__ = ["DataGrid", "OrthoSlice", "QpData", "ImageVolumeManagement", 
-           "NiftiData", "NumpyData", "load", "save"]
+           "NiftiData", "NumpyData", "SparseRoiData", "ExpressionData", "load", "save", "save_session", "load_session", "label_dtype", "as_label_array"]
@@ -0,0 +1,134 @@
+"""
+Quantiphyse - Size-limited caches for data derived from QpData
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import threading
+from collections import OrderedDict
+
+def nbytes(obj):
+    """
+    Default size function for cached items
+
+    :return: Size of ``obj`` in bytes if it is a Numpy array (or provides
+             an ``nbytes`` attribute), otherwise 0
+    """
+    return getattr(obj, "nbytes", 0)
+
+class LruCache(object):
+    """
+    Least-recently-used cache with a limit on the total size of the stored items
+
+    When adding an item would take the total size over the limit, the least recently
+    used items are discarded until it fits. Items which are larger than the limit on
+    their own are not stored at all. Access is thread-safe.
+    """
+
+    def __init__(self, max_size, sizeof=nbytes):
+        """
+        :param max_size: Maximum total size of cached items in bytes. If zero, nothing is cached
+        :param sizeof: Callable returning the size of an item in bytes
+        """
+        self._max_size = max_size
+        self._sizeof = sizeof
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+
+    @property
+    def max_size(self):
+        """ Maximum total size of cached items in bytes """
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, max_size):
+        with self._lock:
+            self._max_size = max_size
+            self._trim(0)
+
+    @property
+    def size(self):
+        """ Current total size of cached items in bytes """
+        return self._size
+
+    def get(self, key, default=None):
+        """
+        Get a cached item and mark it as most recently used
+
+        :return: Cached item, or ``default`` if not in the cache
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, size = self._items.pop(key)
+            self._items[key] = (value, size)
+            return value
+
+    def put(self, key, value):
+        """
+        Add an item to the cache, replacing any existing item with the same key
+
+        :return: True if the item was stored
+        """
+        size = self._sizeof(value)
+        with self._lock:
+            self.pop(key)
+            if size > self._max_size:
+                return False
+            self._trim(size)
+            self._items[key] = (value, size)
+            self._size += size
+            return True
+
+    def pop(self, key, default=None):
+        """
+        Remove an item from the cache
+
+        :return: The removed item, or ``default`` if not in the cache
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, size = self._items.pop(key)
+            self._size -= size
+            return value
+
+    def clear(self):
+        """ Remove all items from the cache """
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def keys(self):
+        """ :return: List of keys in order of use, least recently used first """
+        with self._lock:
+            return list(self._items.keys())
+
+    def __reduce__(self):
+        """
+        Make pickleable by leaving out the cached items and lock
+        """
+        return (LruCache, (self._max_size, self._sizeof))
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def _trim(self, extra_size):
+        while self._items and self._size + extra_size > self._max_size:
+            _, (_, size) = self._items.popitem(last=False)
+            self._size -= size
@@ -17,11 +17,13 @@ limitations under the License.
 """
 from __future__ import division, print_function
 
-import sys
 import os
 import warnings
 import glob
+import json
+import hashlib
 import logging
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -30,120 +32,358 @@ import nibabel as nib
 HAVE_DCMSTACK = True
 try:
     import dcmstack
-    import dicom
 except ImportError:
     HAVE_DCMSTACK = False
     warnings.warn("DCMSTACK not found - may not be able to read DICOM folders")
 
+HAVE_PYDICOM = True
+try:
+    import pydicom as dicom
+except ImportError:
+    try:
+        import dicom
+    except ImportError:
+        HAVE_PYDICOM = False
+
 from quantiphyse.utils import QpException
-from .qpdata import DataGrid, QpData, NumpyData
+from .qpdata import DataGrid, QpData, NumpyData, _readonly_view
 
 LOG = logging.getLogger(__name__)
 
+#: Number of threads used to read DICOM files
+DICOM_THREADS = 8
+
+#: Directory in which indexes of DICOM folders are saved so they can be re-opened
+#: without parsing the DICOM headers. Set to None to disable saving of indexes
+DICOM_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".quantiphyse", "dicom_index")
+
+#: Version of the saved index format. Saved indexes with a different version are ignored
+DICOM_INDEX_VERSION = 1
+
+def _read_dcm(fname, pixels=True):
+    """
+    Read a DICOM file
+
+    :param pixels: If False, only read the header
+    :return: DICOM dataset or None if the file could not be read as DICOM
+    """
+    try:
+        # read_file is the name used by older versions of pydicom
+        dcmread = getattr(dicom, "dcmread", None) or dicom.read_file
+        return dcmread(fname, stop_before_pixels=not pixels)
+    except Exception: # pylint: disable=broad-except
+        return None
+
+def _pool_map(pool, func, items, progress_cb=None, progress_start=0, progress_end=1):
+    """
+    Apply a function to items using a thread pool, reporting progress as items complete
+
+    :return: List of results in the same order as ``items``
+    """
+    results = [None,] * len(items)
+    def _apply(idx):
+        results[idx] = func(items[idx])
+
+    for done, _ in enumerate(pool.imap_unordered(_apply, range(len(items)))):
+        if progress_cb is not None:
+            progress_cb(progress_start + (progress_end - progress_start) * float(done+1) / len(items))
+    return results
+
+def _folder_files(dirname):
+    """
+    :return: Dictionary of file name : (modification time, size) for files in a folder
+    """
+    files = {}
+    for fname in glob.glob(os.path.join(dirname, "*")):
+        stat = os.stat(fname)
+        files[os.path.basename(fname)] = [stat.st_mtime, stat.st_size]
+    return files
+
+def _index_fname(dirname):
+    """
+    :return: Path of the saved index for a DICOM folder
+    """
+    key = hashlib.sha1(os.path.abspath(dirname).encode("utf-8")).hexdigest()
+    return os.path.join(DICOM_INDEX_DIR, key + ".json")
+
+def _load_index(dirname):
+    """
+    Load the saved index for a DICOM folder
+
+    :return: Index dictionary, or None if there is no saved index or the folder contents
+             have changed since it was created
+    """
+    if DICOM_INDEX_DIR is None or not os.path.exists(_index_fname(dirname)):
+        return None
+
+    try:
+        with open(_index_fname(dirname), "r") as index_file:
+            index = json.load(index_file)
+    except (IOError, OSError, ValueError):
+        LOG.warn("Failed to read saved DICOM index for %s", dirname)
+        return None
+
+    if index.get("version", None) != DICOM_INDEX_VERSION or \
+       index.get("folder", None) != os.path.abspath(dirname) or \
+       index.get("files", None) != _folder_files(dirname):
+        LOG.debug("Saved DICOM index for %s is out of date", dirname)
+        return None
+    return index
+
+def _save_index(dirname, index):
+    """
+    Save the index for a DICOM folder. Failure to save is not an error
+    """
+    if DICOM_INDEX_DIR is None:
+        return
+
+    fname = _index_fname(dirname)
+    try:
+        if not os.path.exists(DICOM_INDEX_DIR):
+            os.makedirs(DICOM_INDEX_DIR)
+        # Write to a temporary file first so a partially written index is never used
+        with open(fname + ".tmp", "w") as index_file:
+            json.dump(index, index_file)
+        if os.path.exists(fname):
+            os.remove(fname)
+        os.rename(fname + ".tmp", fname)
+    except (IOError, OSError):
+        LOG.warn("Failed to save DICOM index for %s", dirname)
+
+def _build_index(dirname, progress_cb=None):
+    """
+    Index a folder of DICOM files for a single series
+
+    Basically we determine the sequence using the InstanceNumber tag but make sure
+    we put slices together into volumes using the SliceLocation tag. Only the headers
+    are read, using a pool of ``DICOM_THREADS`` threads.
+
+    :param dirname: Folder containing DICOM files
+    :param progress_cb: Optional callable taking a progress fraction between 0 and 1
+    :return: Index dictionary describing the geometry, pixel scaling and file order
+    """
+    if not HAVE_PYDICOM:
+        raise QpException("The pydicom package is required to read DICOM folders")
+
+    import nibabel.nicom.dicomwrappers as nib_dcm
+
+    # Get the file details before reading so changes during indexing make the index out of date
+    files = _folder_files(dirname)
+    fnames = sorted(files.keys())
+    pool = ThreadPool(DICOM_THREADS)
+    try:
+        headers = _pool_map(pool, lambda fname: _read_dcm(os.path.join(dirname, fname), pixels=False),
+                            fnames, progress_cb)
+    finally:
+        pool.terminate()
+
+    dcms = [(fname, dcm) for fname, dcm in zip(fnames, headers)
+            if dcm is not None and "SliceLocation" in dcm]
+    if not dcms:
+        raise QpException("This doesn't seem to be a DICOM folder")
+
+    # The index can only describe a single stack of identically oriented slices. Anything
+    # else is left to DCMSTACK rather than risk silently combining the wrong files
+    series = set([dcm.get("SeriesInstanceUID", None) for _, dcm in dcms])
+    if len(series) > 1:
+        raise QpException("Could not parse DICOMS - folder contains %i series" % len(series))
+    geometries = set([(tuple([round(float(v), 4) for v in dcm.get("ImageOrientationPatient", [])]),
+                       dcm.get("Rows", None), dcm.get("Columns", None)) for _, dcm in dcms])
+    if len(geometries) > 1:
+        raise QpException("Could not parse DICOMS - slices have different orientations or sizes")
+
+    # Group files by slice location and order each group by instance number
+    # to give the volume index
+    slices = {}
+    for fname, dcm in dcms:
+        slices.setdefault(float(dcm.SliceLocation), []).append((dcm.InstanceNumber, fname))
+    slice_locs = sorted(slices.keys())
+    n_vols = int(len(dcms) / len(slices))
+    if n_vols * len(slices) != len(dcms):
+        raise QpException("Could not parse DICOMS - unable to determine fixed number of volumes")
+
+    fname1, hdr1 = dcms[0]
+    dcm_affine = nib_dcm.wrapper_from_file(os.path.join(dirname, fname1)).affine
+    ss, rs, ri = 1, 1, 0 # Pixel value scaling
+    try:
+        # Need all three of these to be of use
+        ss = hdr1[0x2005, 0x100e].value
+        rs = hdr1[0x2005, 0x140a].value
+        ri = hdr1[0x2005, 0x1409].value
+    except KeyError:
+        pass
+
+    if (ss, rs, ri) != (1, 1, 0):
+        dtype = "float32"
+    elif hdr1.PixelRepresentation:
+        dtype = "int%i" % hdr1.BitsAllocated
+    else:
+        dtype = "uint%i" % hdr1.BitsAllocated
+
+    LOG.debug("%i Volumes", n_vols)
+    LOG.debug("Ignored (non-DICOM) files: %i", len(fnames) - len(dcms))
+    LOG.debug("Slice locations are: %s", ", ".join([str(loc) for loc in slice_locs]))
+    LOG.debug("RescaleSlope: %f, RescaleIntercept: %f, ScaleSlope: %f", rs, ri, ss)
+
+    order = []
+    for sidx, loc in enumerate(slice_locs):
+        for vidx, (_, fname) in enumerate(sorted(slices[loc])):
+            order.append([fname, sidx, vidx])
+
+    return {
+        "version" : DICOM_INDEX_VERSION,
+        "folder" : os.path.abspath(dirname),
+        "files" : files,
+        "shape" : [int(hdr1.Rows), int(hdr1.Columns), len(slices), n_vols],
+        "affine" : np.array(dcm_affine).tolist(),
+        "dtype" : dtype,
+        "scaling" : [float(ss), float(rs), float(ri)],
+        "order" : order,
+    }
+
 class DicomFolder(QpData):
     """
     QpData instance loaded from a directory of DICOM files
+
+    The folder is first indexed by reading the DICOM headers to find where each file
+    belongs. The index is saved in ``DICOM_INDEX_DIR`` so re-opening an unchanged folder
+    does not require the headers to be parsed again. Pixel data is decoded in parallel
+    when it is first required, and individual volumes can be decoded without decoding
+    the whole series. DCMSTACK, if available, is only used to convert folders which
+    cannot be indexed.
     """
-    def __init__(self, fname):
-        # A directory containing DICOMs. Convert them to Nifti
-        print("Converting DICOMS in %s..." % (os.path.basename(fname)))
-        src_dcms = glob.glob('%s/*' % fname)
-        nii = None
-        try:
-            if HAVE_DCMSTACK:
-                # Give DCMSTACK a chance to do its thing
-                stacks = dcmstack.parse_and_stack(src_dcms)
-                stack = stacks.values()[0]
-                nii = stack.to_nifti()
-        except:
-            warnings.warn("DCMSTACK failed - trying our method")
-        if nii is None:
-            # Try our top-secret in-house method
-            nii = self.fallback_dcmstack(src_dcms)
-
-        print("DONE\n")
-        if len(nii.shape) > 3:
-            nvols = nii.shape[3]
+    def __init__(self, fname, progress_cb=None):
+        """
+        :param fname: Directory containing DICOM files
+        :param progress_cb: Optional callable taking a progress fraction between 0 and 1
+        """
+        self.dcmdata = None
+        self.voldata = None
+        self._index = _load_index(fname)
+        if self._index is not None:
+            LOG.debug("Using saved DICOM index for %s", fname)
+        else:
+            try:
+                LOG.info("Indexing DICOMS in %s", os.path.basename(fname))
+                self._index = _build_index(fname, progress_cb)
+                _save_index(fname, self._index)
+            except Exception: # pylint: disable=broad-except
+                nii = self._dcmstack(fname)
+                if nii is None:
+                    raise
+                LOG.info("Could not index DICOMS - using DCMSTACK")
+
+        if self._index is not None:
+            shape, affine = self._index["shape"], np.array(self._index["affine"])
+        else:
+            shape, affine = list(nii.shape), nii.header.get_best_affine()
+            self.dcmdata = nii.get_data()
+
+        if len(shape) > 3:
+            nvols = shape[3]
         else:
             nvols = 1
 
-        grid = DataGrid(nii.shape[:3], nii.header.get_best_affine())
-        self.dcmdata = nii.get_data()
+        grid = DataGrid(shape[:3], affine)
         QpData.__init__(self, fname, grid, nvols, fname=fname)
 
-    def raw(self):
-        return self.dcmdata
-
-    def fallback_dcmstack(self, fnames):
+    def _dcmstack(self, fname):
         """
-        Create NIFTI from DCM files. Quick and dirty method
-        for when DCMSTACK does not exist or fails.
+        Give DCMSTACK a chance to do its thing
 
-        Basically we determine the sequence using the InstanceNumber tag
-        but make sure we put slices together into volumes using the SliceLocation tag
+        :return: Nifti image or None if DCMSTACK is not available or failed
         """
-        import nibabel.nicom.dicomwrappers as nib_dcm
-        ignored_files = []
-        first = True
-        dcms = []
-        slices = set()
-        ss, rs, ri = 1, 1, 0 # Pixel value scaling
-        sys.stdout.write("  0%")
-        for idx, fname in enumerate(fnames):
+        if HAVE_DCMSTACK:
             try:
-                dcm = dicom.read_file(fname)
+                src_dcms = glob.glob('%s/*' % fname)
+                stacks = dcmstack.parse_and_stack(src_dcms)
+                stack = list(stacks.values())[0]
+                return stack.to_nifti()
             except:
-                ignored_files.append(fname)
-                continue
-            slices.add(float(dcm.SliceLocation))
-            dcms.append(dcm)
-
-            if first:
-                dcm1 = nib_dcm.wrapper_from_file(fname)
-                dcm_affine = dcm1.get_affine()
-                print(dcm_affine)
-                try:
-                    # Need all three of these to be of use
-                    ss = dcm[0x2005, 0x100e].value
-                    rs = dcm[0x2005, 0x140a].value
-                    ri = dcm[0x2005, 0x1409].value
-                except:
-                    pass
-                first = False
-
-            percent = 100*float(idx+1) / len(fnames)
-            sys.stdout.write("\b\b\b\b%3i%%" % int(percent))
-            sys.stdout.flush()
-        
-        if len(slices) < 0:
-            raise QpException("This doesn't seem to be a DICOM folder")
-            
-        n_vols = int(len(dcms) / len(slices))
-        if n_vols * len(slices) != len(dcms):
-            raise QpException("Could not parse DICOMS - unable to determine fixed number of volumes")
-
-        print("\n")
-        print("%i Volumes" % n_vols)
-        print("Ignored (non-DICOM) files: %i" % len(ignored_files))
-        print("Slice locations are: " + ", ".join([str(s) for s in slices]))
-        print("RescaleSlope: %f" % rs)
-        print("RescaleIntercept: %f" % ri)
-        print("ScaleSlope: %f" % ss)
-        for sidx, s in enumerate(sorted(slices)):
-            for idx, dcm in enumerate(sorted([d for d in dcms if d.SliceLocation == s], key=lambda x: x.InstanceNumber)):
-                dcm.GlobalIndex = sidx + len(slices) * idx
-            
-        print("Creating NIFTI...")
-        data = np.zeros([dcm1.image_shape[0], dcm1.image_shape[1], len(slices), int(n_vols)])
-        sidx, vidx = 0, 0
-        for dcm in sorted(dcms, key=lambda x: x.GlobalIndex):
-            data[:, :, sidx, vidx] = (np.squeeze(dcm.pixel_array)*rs + ri)/ss
-            sidx += 1
-            if sidx == len(slices):
-                sidx = 0
-                vidx += 1
-
-        nii = nib.Nifti1Image(data, dcm_affine)
-        nii.update_header()
-        print("DONE")
-        return nii
+                warnings.warn("DCMSTACK failed")
+        return None
+
+    def _decode(self, vol=None):
+        """
+        Decode pixel data from the DICOM files using a pool of ``DICOM_THREADS`` threads
+
+        :param vol: If specified, only decode this volume
+        :return: Numpy array
+        """
+        shape, order = list(self._index["shape"]), self._index["order"]
+        if vol is not None:
+            shape[3] = 1
+            order = [(fname, sidx, 0) for fname, sidx, vidx in order if vidx == vol]
+        ss, rs, ri = self._index["scaling"]
+        scaled = (ss, rs, ri) != (1, 1, 0)
+        data = np.zeros(shape, dtype=self._index["dtype"])
+
+        def _decode_file(entry):
+            fname, sidx, vidx = entry
+            dcm = _read_dcm(os.path.join(self.fname, fname))
+            if dcm is None:
+                raise QpException("Failed to read DICOM file: %s" % fname)
+            pixels = np.squeeze(dcm.pixel_array)
+            if scaled:
+                data[:, :, sidx, vidx] = (pixels*rs + ri)/ss
+            else:
+                data[:, :, sidx, vidx] = pixels
+
+        pool = ThreadPool(DICOM_THREADS)
+        try:
+            _pool_map(pool, _decode_file, order)
+        finally:
+            pool.terminate()
+
+        if data.shape[3] == 1:
+            data = np.squeeze(data, axis=-1)
+        return data
+
+    def raw(self):
+        with self._load_lock:
+            if self.dcmdata is None:
+                if self._index is not None:
+                    self.dcmdata = self._decode()
+                else:
+                    self.dcmdata = self._dcmstack(self.fname).get_data()
+                self.voldata = None
+            return self.dcmdata
+
+    def volume(self, vol, qpdata=False):
+        vol = min(vol, self.nvols-1)
+        with self._load_lock:
+            if self.dcmdata is not None or self._index is None or self.nvols == 1:
+                return QpData.volume(self, vol, qpdata)
+
+            if self.voldata is None:
+                self.voldata = [None,] * self.nvols
+            if self.voldata[vol] is None:
+                self.voldata[vol] = self._decode(vol)
+            voldata = self.voldata[vol]
+
+        if qpdata:
+            return NumpyData(_readonly_view(voldata), grid=self.grid, name="%s_vol_%i" % (self.name, vol))
+        else:
+            return voldata
+
+    @property
+    def reloadable(self):
+        return os.path.isdir(self.fname) and self._unmodified()
+
+    def uncache(self):
+        """
+        Discard the decoded data. The DICOM files will be decoded again when next required
+        """
+        with self._load_lock:
+            QpData.uncache(self)
+            if self.reloadable:
+                self.dcmdata = None
+                self.voldata = None
+
+    def memory_usage(self):
+        usage = QpData.memory_usage(self)
+        if self.dcmdata is not None:
+            usage += self.dcmdata.nbytes
+        if self.voldata is not None:
+            usage += sum([voldata.nbytes for voldata in self.voldata if voldata is not None])
+        return usage
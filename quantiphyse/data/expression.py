@@ -0,0 +1,362 @@
+"""
+Quantiphyse - Subclass of QpData whose voxels are computed from an expression
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import division
+
+import ast
+import math
+import weakref
+import logging
+
+import numpy as np
+
+from quantiphyse.utils import sf, QpException
+
+from .qpdata import QpData, NumpyData, WORLD_GRID
+
+LOG = logging.getLogger(__name__)
+
+#: Maximum number of values computed at once when the whole data set is evaluated
+EXPRESSION_CHUNK_SIZE = 4*1024*1024
+
+#: Numpy functions other than ufuncs which act on each voxel independently
+ELEMENTWISE_FUNCTIONS = ("where", "clip", "nan_to_num")
+
+def elementwise_names(expr):
+    """
+    Determine whether an expression acts on each voxel independently
+
+    This is the case if it contains only names, numbers, arithmetic and comparison
+    operators and calls to Numpy ufuncs (e.g. ``np.exp``) or the functions in
+    ``ELEMENTWISE_FUNCTIONS``. Such an expression gives the same result when evaluated
+    on part of the data as on the whole data.
+
+    :param expr: Python expression string
+    :return: Set of names used in the expression, or None if it is not elementwise
+    """
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError:
+        return None
+
+    names = set()
+    constants = tuple([getattr(ast, cls) for cls in ("Constant", "Num", "NameConstant") if hasattr(ast, cls)])
+    operators = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Load,
+                 ast.operator, ast.unaryop, ast.cmpop)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            func = node.func
+            if not isinstance(func, ast.Attribute) or not isinstance(func.value, ast.Name) or func.value.id != "np":
+                return None
+            if not isinstance(getattr(np, func.attr, None), np.ufunc) and func.attr not in ELEMENTWISE_FUNCTIONS:
+                return None
+            if node.keywords or any([isinstance(arg, getattr(ast, "Starred", ())) for arg in node.args]):
+                return None
+        elif isinstance(node, ast.Attribute):
+            # Only allowed as the function of a call, checked above
+            if not isinstance(node.value, ast.Name) or node.value.id != "np":
+                return None
+        elif isinstance(node, ast.Name):
+            if node.id not in ("np", "True", "False", "None"):
+                names.add(node.id)
+        elif not isinstance(node, constants + operators):
+            return None
+
+    return names
+
+def _depends_on(qpd, name):
+    """
+    :return: True if data is computed, directly or indirectly, from the data item ``name``
+    """
+    if not isinstance(qpd, ExpressionData):
+        return False
+    return any([input_name == name or _depends_on(qpd._data.get(input_name), name)
+                for input_name in qpd._names])
+
+class _ExpressionSliceProxy(object):
+    """
+    Numpy-style access to a volume of an expression for extracting slices
+
+    Indexing evaluates the expression on the same part of each input
+    """
+    def __init__(self, qpd, vol):
+        self._qpd = qpd
+        self._vol = vol
+        self.shape = tuple(qpd.grid.shape)
+
+    def __getitem__(self, slices):
+        return self._qpd._evaluate(dict([
+            (name, np.asarray(data._volume_for_slicing(self._vol)[slices]))
+            for name, data in self._qpd.inputs.items()
+        ]))
+
+    def __array__(self, dtype=None):
+        data = self._qpd.volume(self._vol)
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+class ExpressionData(QpData):
+    """
+    QpData whose voxel values are computed on demand from an expression
+
+    The expression must act on each voxel independently (see ``elementwise_names()``)
+    and all the data items it uses must be defined on the same grid with the same
+    number of volumes. Slices, volumes and voxel values are then computed from the
+    corresponding parts of the inputs. The whole data set is only computed if
+    ``raw()`` is called. It is then computed in chunks and kept until ``uncache()``
+    is called or one of the inputs changes. The array returned by ``raw()`` is
+    read-only.
+
+    Inputs are looked up by name whenever the data is evaluated, so if a data item is
+    replaced, e.g. in the IVM, the replacement is used. No reference to the inputs is
+    kept, so if one is deleted its memory is released and evaluating the expression
+    fails.
+    """
+
+    def __init__(self, expr, data, grid, name, namespace=None, **kwargs):
+        """
+        :param expr: Python expression string
+        :param data: Mapping from name to QpData, e.g. ``ivm.data``, in which the names
+                     used in the expression are looked up
+        :param grid: :class:`DataGrid` the data is defined on. All inputs must be
+                     defined on this grid
+        :param name: Name of the data item
+        :param namespace: Optional dictionary of additional names available to the expression
+        """
+        names = elementwise_names(expr)
+        if names is None:
+            raise QpException("'%s' cannot be evaluated on parts of the data" % expr)
+        if not names:
+            raise QpException("'%s' does not use any data" % expr)
+        missing = [input_name for input_name in names if input_name not in data]
+        if missing:
+            raise QpException("'%s' uses unknown data: %s" % (expr, ", ".join(missing)))
+        if name in names or any([_depends_on(data[input_name], name) for input_name in names]):
+            raise QpException("'%s' uses the data it defines" % expr)
+        nvols = set([data[input_name].nvols for input_name in names])
+        if len(nvols) > 1:
+            raise QpException("'%s' uses data with different numbers of volumes" % expr)
+        for input_name in names:
+            if not data[input_name].grid.matches(grid):
+                raise QpException("'%s' uses data which is not defined on the output grid" % expr)
+
+        self.expr = expr
+        self._data = data
+        self._names = sorted(names)
+        self._code = compile(expr.strip(), "<expression>", "eval")
+        self._namespace = {"np" : np}
+        if namespace:
+            self._namespace.update(namespace)
+        self._rawdata = None
+        self._input_generations = self._generations()
+        QpData.__init__(self, name, grid, nvols.pop(), **kwargs)
+
+    @property
+    def inputs(self):
+        """
+        Dictionary from name used in the expression to the data item it currently refers to
+
+        :raises QpException: if an input no longer exists
+        """
+        missing = [name for name in self._names if name not in self._data]
+        if missing:
+            raise QpException("'%s' uses data which no longer exists: %s" % (self.expr, ", ".join(missing)))
+        return dict([(name, self._data[name]) for name in self._names])
+
+    @classmethod
+    def create(cls, expr, data, grid, name, namespace=None, **kwargs):
+        """
+        Create an ExpressionData if an expression can be evaluated on demand
+
+        :param expr: Python expression string
+        :param data: Mapping from name to QpData, e.g. ``ivm.data``, in which the names
+                     used in the expression are looked up
+        :param grid: :class:`DataGrid` the data is defined on
+        :param name: Name of the data item
+        :param namespace: Optional dictionary of additional names available to the expression
+        :return: ExpressionData instance, or None if the expression cannot be evaluated
+                 on demand, in which case it should be evaluated directly
+        """
+        names = elementwise_names(expr)
+        if not names or any([name not in data for name in names]):
+            return None
+        try:
+            return cls(expr, data, grid, name, namespace, **kwargs)
+        except QpException as exc:
+            LOG.debug("Not evaluating on demand: %s", exc)
+            return None
+
+    def raw(self):
+        self._check_inputs()
+        with self._load_lock:
+            if self._rawdata is None:
+                LOG.debug("Evaluating %s", self.expr)
+                shape = list(self.grid.shape)
+                if self.nvols > 1:
+                    shape.append(self.nvols)
+                rows = max(1, EXPRESSION_CHUNK_SIZE // max(1, self.grid.nvoxels // shape[0] * self.nvols))
+                rawdata = None
+                for start in range(0, shape[0], rows):
+                    chunk = self._evaluate(dict([
+                        (name, data.raw()[start:start+rows]) for name, data in self.inputs.items()
+                    ]))
+                    if rawdata is None:
+                        rawdata = np.empty(shape, dtype=chunk.dtype)
+                    rawdata[start:start+rows] = chunk
+                rawdata.flags.writeable = False
+                self._rawdata = rawdata
+            return self._rawdata
+
+    def volume(self, vol, qpdata=False):
+        self._check_inputs()
+        vol = min(vol, self.nvols-1)
+        if self._rawdata is not None:
+            return QpData.volume(self, vol, qpdata)
+
+        ret = self._evaluate(dict([(name, data.volume(vol)) for name, data in self.inputs.items()]))
+        if qpdata:
+            return NumpyData(ret, grid=self.grid, name="%s_vol_%i" % (self.name, vol))
+        else:
+            return ret
+
+    def value(self, pos, grid=None, as_str=False):
+        data_pos = self._data_pos(pos, grid)
+        if data_pos is None:
+            value = 0
+        else:
+            vol = pos[3] if len(pos) > 3 else 0
+            value = self._timeseries_at(data_pos)[0, min(vol, self.nvols-1)]
+
+        if as_str:
+            return sf(value)
+        else:
+            return value
+
+    def timeseries(self, pos, grid=None):
+        data_pos = self._data_pos(pos, grid)
+        if data_pos is None:
+            return [0] if self.nvols == 1 else []
+        return list(self._timeseries_at(data_pos)[0])
+
+    def slice_data(self, plane, vol=0, interp_order=0):
+        self._check_inputs()
+        return QpData.slice_data(self, plane, vol, interp_order)
+
+    def stats(self, vol=None):
+        self._check_inputs()
+        return QpData.stats(self, vol)
+
+    def uncache(self):
+        """
+        Discard the computed data. It will be recomputed when next required
+        """
+        with self._load_lock:
+            QpData.uncache(self)
+            self._rawdata = None
+
+    @property
+    def reloadable(self):
+        return True
+
+    def memory_usage(self):
+        usage = QpData.memory_usage(self)
+        if self._rawdata is not None:
+            usage += self._rawdata.nbytes
+        return usage
+
+    def preload(self):
+        # Data is computed when it is displayed
+        pass
+
+    def set_2dt(self):
+        raise QpException("Data computed from an expression cannot be interpreted as a 2D timeseries")
+
+    def _timeseries_at(self, data_pos):
+        self._check_inputs()
+        if self._rawdata is not None:
+            return QpData._timeseries_at(self, data_pos)
+        return self._evaluate(dict([(name, data._timeseries_at(data_pos)) for name, data in self.inputs.items()]))
+
+    def _volume_for_slicing(self, vol):
+        if self._rawdata is not None:
+            return QpData._volume_for_slicing(self, vol)
+        return _ExpressionSliceProxy(self, min(vol, self.nvols-1))
+
+    def _data_pos(self, pos, grid):
+        """
+        :return: Numpy array of shape [1, 3] containing the voxel index nearest to a
+                 position, or None if it is outside the data
+        """
+        if grid is None:
+            grid = WORLD_GRID
+        data_pos = [int(math.floor(v+0.5)) for v in self.grid.grid_to_grid(pos[:3], from_grid=grid)]
+        if min(data_pos) < 0 or any([p >= s for p, s in zip(data_pos, self.grid.shape)]):
+            return None
+        return np.array([data_pos])
+
+    def _evaluate(self, arrays):
+        """
+        Evaluate the expression on corresponding parts of the inputs
+
+        Floating point results are returned as float32 as for :class:`NumpyData`
+        """
+        namespace = dict(self._namespace)
+        namespace.update(arrays)
+        try:
+            result = np.asarray(eval(self._code, namespace))
+        except Exception as exc:
+            raise QpException("Failed to evaluate '%s' (Reason: %s)" % (self.expr, exc))
+        if result.dtype.kind == "f" and result.dtype != np.float32:
+            result = result.astype(np.float32)
+        elif result.dtype.kind == "b":
+            result = result.astype(np.uint8)
+        return result
+
+    def _generations(self):
+        """
+        :return: List of weak reference to and generation of each input
+        """
+        inputs = self.inputs
+        return [(weakref.ref(inputs[name]), inputs[name]._generation) for name in self._names]
+
+    def _changed(self):
+        """
+        :return: True if any of the inputs have been modified or replaced since
+                 ``_input_generations`` was last set
+        """
+        for name, (ref, generation) in zip(self._names, self._input_generations):
+            data = self._data.get(name)
+            if data is None or ref() is not data or data._generation != generation:
+                return True
+        return False
+
+    def _check_inputs(self):
+        """
+        Discard computed data if any of the inputs have changed
+
+        :raises QpException: if an input no longer exists or has been replaced by
+                             data which is not compatible with the expression
+        """
+        if self._changed():
+            LOG.debug("Inputs of %s have changed", self.name)
+            self._rawdata = None
+            self.invalidate()
+            for data in self.inputs.values():
+                if not data.grid.matches(self.grid) or data.nvols != self.nvols:
+                    raise QpException("'%s' uses data which is not compatible with the output: %s" % (self.expr, data.name))
+            self._input_generations = self._generations()
@@ -0,0 +1,169 @@
+"""
+Quantiphyse - Writing of gzip files using multiple threads
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import division
+
+import time
+import zlib
+import struct
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+#: Number of threads used to compress data. Set to 1 to compress in the calling thread
+GZIP_THREADS = min(8, multiprocessing.cpu_count())
+
+#: Size in bytes of the blocks of uncompressed data which are compressed independently
+GZIP_BLOCK_SIZE = 1024*1024
+
+#: Default compression level - the same as nibabel uses for .gz files
+GZIP_LEVEL = 1
+
+class ParallelGzipWriter(object):
+    """
+    Write-only file object which gzip-compresses data in blocks using multiple threads
+
+    Each block is compressed independently as raw deflate data ending on a byte boundary,
+    in the same way as ``pigz``. The blocks are written in order as a single gzip member,
+    so the output can be read by any gzip reader. zlib releases the GIL while compressing
+    so the threads run concurrently.
+
+    Only sequential writing is supported - ``seek()`` raises ``IOError`` unless the
+    position is the current position.
+    """
+
+    def __init__(self, fname, level=None, nthreads=None, block_size=None):
+        """
+        :param fname: Output file name
+        :param level: Compression level. Defaults to ``GZIP_LEVEL``
+        :param nthreads: Number of compression threads. Defaults to ``GZIP_THREADS``
+        :param block_size: Uncompressed block size in bytes. Defaults to ``GZIP_BLOCK_SIZE``
+        """
+        self.name = fname
+        self.mode = "wb"
+        self._level = level if level is not None else GZIP_LEVEL
+        self._nthreads = nthreads if nthreads is not None else GZIP_THREADS
+        self._block_size = block_size if block_size is not None else GZIP_BLOCK_SIZE
+        self._file = open(fname, "wb")
+        self._buffer = []
+        self._buffered = 0
+        self._size = 0
+        self._crc = 0
+        self._pending = collections.deque()
+        self._pool = ThreadPool(self._nthreads) if self._nthreads > 1 else None
+        self.closed = False
+
+        # Gzip header: magic, deflate method, no flags, modification time, no extra flags, unknown OS
+        self._file.write(struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, int(time.time()), 0, 255))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        """
+        Write uncompressed data
+
+        :param data: bytes-like object
+        """
+        data = memoryview(data).cast("B") if hasattr(memoryview, "cast") else data
+        nbytes = len(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += nbytes
+
+        offset = 0
+        while offset < nbytes:
+            chunk = data[offset:offset + self._block_size - self._buffered]
+            self._buffer.append(bytes(chunk))
+            self._buffered += len(chunk)
+            offset += len(chunk)
+            if self._buffered >= self._block_size:
+                self._submit_block(final=False)
+        return nbytes
+
+    def read(self, *args):
+        """
+        Not supported - defined so that the object is recognized as a file object
+        """
+        raise IOError("File is open for writing only")
+
+    def tell(self):
+        """
+        :return: Number of uncompressed bytes written
+        """
+        return self._size
+
+    def seek(self, offset, whence=0):
+        """
+        Only a 'seek' to the current position is supported
+        """
+        if whence == 0 and offset == self._size:
+            return self._size
+        raise IOError("Cannot seek in a compressed output file")
+
+    def flush(self):
+        """
+        Write all completed blocks to the underlying file
+        """
+        while self._pending and (self._pool is None or self._pending[0].ready()):
+            self._write_next()
+        self._file.flush()
+
+    def close(self):
+        """
+        Compress remaining data, write the gzip trailer and close the file
+        """
+        if self.closed:
+            return
+        self._submit_block(final=True)
+        while self._pending:
+            self._write_next()
+        self._file.write(struct.pack("<II", self._crc & 0xffffffff, self._size & 0xffffffff))
+        self._file.close()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        self.closed = True
+
+    def _submit_block(self, final):
+        block = b"".join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        if self._pool is None:
+            self._file.write(_compress_block(block, self._level, final))
+        else:
+            # Limit the number of blocks held in memory
+            while len(self._pending) >= 2*self._nthreads:
+                self._write_next()
+            self._pending.append(self._pool.apply_async(_compress_block, (block, self._level, final)))
+
+    def _write_next(self):
+        self._file.write(self._pending.popleft().get())
+
+def _compress_block(block, level, final):
+    """
+    Compress a block of data as raw deflate data which ends on a byte boundary,
+    so blocks can be concatenated. Only the final block is marked as the end of
+    the deflate stream
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block)
+    if final:
+        return data + compressor.flush(zlib.Z_FINISH)
+    else:
+        return data + compressor.flush(zlib.Z_SYNC_FLUSH)
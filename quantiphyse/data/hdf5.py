@@ -0,0 +1,333 @@
+"""
+Quantiphyse - Subclass of QpData for handling chunked HDF5 data
+
+Data is stored as a single 4D dataset (the last dimension being the volume index) which
+is divided into compressed chunks over all four dimensions. Only the chunks which are
+needed are read, so orthogonal slices and single-voxel timeseries can be extracted from
+data sets which are too large to hold in memory.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import division, print_function
+
+import os
+import math
+import logging
+import threading
+import traceback
+
+import numpy as np
+
+HAVE_H5PY = True
+try:
+    import h5py
+except ImportError:
+    HAVE_H5PY = False
+
+from quantiphyse.utils import QpException, sf
+from .qpdata import DataGrid, QpData, NumpyData, WORLD_GRID, as_label_array
+
+LOG = logging.getLogger(__name__)
+
+#: File extensions recognized as HDF5 data
+HDF5_EXTENSIONS = (".h5", ".hdf5")
+
+#: Name of the dataset containing the voxel data
+DATASET_NAME = "data"
+
+#: Maximum chunk size along each of the x, y, z and volume dimensions
+CHUNK_SHAPE = (32, 32, 32, 8)
+
+#: Compression filter and level used for chunks
+COMPRESSION = "gzip"
+COMPRESSION_LEVEL = 4
+
+def is_hdf5(fname):
+    """
+    :return: True if ``fname`` has a file extension recognized as HDF5 data
+    """
+    return fname.lower().endswith(HDF5_EXTENSIONS)
+
+def _require_h5py():
+    if not HAVE_H5PY:
+        raise QpException("The h5py package is required to read and write HDF5 data")
+
+class _VolumeProxy(object):
+    """
+    Numpy-style access to a single volume of a 4D HDF5 dataset
+
+    HDF5 does not support negative strides so these are handled by reading the
+    data in forward order and flipping the result
+    """
+    def __init__(self, dset, vol, lock):
+        self._dset = dset
+        self._vol = vol
+        self._lock = lock
+        self.shape = tuple(dset.shape[:3])
+
+    def __getitem__(self, slices):
+        read_slices, flip_axes = [], []
+        out_axis = 0
+        for dim, slc in enumerate(slices):
+            if isinstance(slc, slice):
+                start, stop, step = slc.indices(self.shape[dim])
+                if step < 0:
+                    start, stop, step = stop+1, start+1, -step
+                    flip_axes.append(out_axis)
+                read_slices.append(slice(start, stop, step))
+                out_axis += 1
+            else:
+                read_slices.append(slc)
+
+        with self._lock:
+            data = self._dset[tuple(read_slices) + (self._vol,)]
+        for axis in flip_axes:
+            data = np.flip(data, axis)
+        return data
+
+    def __array__(self, dtype=None):
+        with self._lock:
+            data = self._dset[..., self._vol]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+class Hdf5Data(QpData):
+    """
+    QpData from a chunked HDF5 file
+
+    The whole data set is only read into memory if ``raw()`` is called. Otherwise
+    ``volume()``, ``value()``, ``timeseries()``, ``timeseries_many()`` and ``slice_data()`` read only the
+    chunks they need.
+    """
+    def __init__(self, fname):
+        _require_h5py()
+        self.rawdata = None
+        self._lock = threading.Lock()
+        self._file = None
+        dset = self._dataset(fname)
+        if dset.ndim != 4:
+            raise QpException("%s: HDF5 dataset '%s' must be 4D" % (fname, DATASET_NAME))
+
+        metadata = None
+        if "metadata" in dset.attrs:
+            import yaml
+            try:
+                metadata = yaml.safe_load(dset.attrs["metadata"])[0]["QpMetadata"]
+            except (KeyError, TypeError, yaml.YAMLError):
+                LOG.warn("Failed to read Quantiphyse metadata")
+                traceback.print_exc()
+
+        xyz_units = dset.attrs.get("units", "mm")
+        vol_units = dset.attrs.get("vol_units", None)
+        vol_scale = dset.attrs.get("vol_scale", 1.0)
+        grid = DataGrid(dset.shape[:3], np.array(dset.attrs["affine"]), units=xyz_units)
+        QpData.__init__(self, fname, grid, dset.shape[3], vol_units=vol_units, vol_scale=vol_scale,
+                        fname=fname, metadata=metadata)
+
+    def __getstate__(self):
+        # Open files and locks cannot be pickled
+        state = QpData.__getstate__(self)
+        state["_file"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        QpData.__setstate__(self, state)
+        self._lock = threading.Lock()
+
+    def _dataset(self, fname=None):
+        if self._file is None:
+            self._file = h5py.File(fname or self.fname, "r")
+        return self._file[DATASET_NAME]
+
+    def raw(self):
+        with self._load_lock:
+            if self.rawdata is None:
+                with self._lock:
+                    self.rawdata = self._correct_dims(self._dataset()[...])
+            return self.rawdata
+
+    def volume(self, vol, qpdata=False):
+        vol = min(vol, self.nvols-1)
+        if self.rawdata is not None or self._meta.get("raw_2dt", False):
+            # Volume shares the data read into memory
+            return QpData.volume(self, vol, qpdata)
+
+        with self._lock:
+            ret = self._dataset()[..., vol]
+        if qpdata:
+            return NumpyData(ret, grid=self.grid, name="%s_vol_%i" % (self.name, vol))
+        else:
+            return ret
+
+    def timeseries(self, pos, grid=None):
+        if self.rawdata is not None or self.nvols == 1 or self._meta.get("raw_2dt", False):
+            return QpData.timeseries(self, pos, grid)
+
+        if grid is None:
+            grid = WORLD_GRID
+
+        data_pos = [int(math.floor(v+0.5)) for v in self.grid.grid_to_grid(pos[:3], from_grid=grid)]
+        if min(data_pos) < 0 or any([p >= s for p, s in zip(data_pos, self.grid.shape)]):
+            return []
+        with self._lock:
+            return list(self._dataset()[data_pos[0], data_pos[1], data_pos[2], :])
+
+    def value(self, pos, grid=None, as_str=False):
+        if self.rawdata is not None or self._meta.get("raw_2dt", False):
+            return QpData.value(self, pos, grid, as_str)
+
+        if grid is None:
+            grid = WORLD_GRID
+        vol = min(pos[3], self.nvols-1) if len(pos) > 3 else 0
+
+        data_pos = [int(math.floor(v+0.5)) for v in self.grid.grid_to_grid(pos[:3], from_grid=grid)]
+        if min(data_pos) < 0 or any([p >= s for p, s in zip(data_pos, self.grid.shape)]):
+            value = 0
+        else:
+            with self._lock:
+                value = self._dataset()[data_pos[0], data_pos[1], data_pos[2], vol]
+
+        if as_str:
+            return sf(value)
+        else:
+            return value
+
+    def _timeseries_at(self, data_pos):
+        if self.rawdata is not None or self._meta.get("raw_2dt", False):
+            return QpData._timeseries_at(self, data_pos)
+
+        # Group the points by the chunk they are in so each chunk is read only once
+        dset = self._dataset()
+        chunks = np.array((dset.chunks or dset.shape)[:3])
+        _, chunk_ids = np.unique(data_pos // chunks, axis=0, return_inverse=True)
+        chunk_ids = chunk_ids.ravel()
+        order = np.argsort(chunk_ids, kind="mergesort")
+        starts = np.flatnonzero(np.diff(chunk_ids[order])) + 1
+
+        ret = np.empty((data_pos.shape[0], dset.shape[3]), dtype=dset.dtype)
+        with self._lock:
+            for members in np.split(order, starts):
+                pos = data_pos[members]
+                lower, upper = pos.min(axis=0), pos.max(axis=0) + 1
+                block = dset[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2], :]
+                pos = pos - lower
+                ret[members] = block[pos[:, 0], pos[:, 1], pos[:, 2]]
+        return ret
+
+    @property
+    def reloadable(self):
+        return os.path.exists(self.fname) and self._unmodified()
+
+    def uncache(self):
+        with self._load_lock:
+            QpData.uncache(self)
+            if self.reloadable:
+                self.rawdata = None
+
+    def memory_usage(self):
+        usage = QpData.memory_usage(self)
+        if self.rawdata is not None:
+            usage += self.rawdata.nbytes
+        return usage
+
+    def preload(self):
+        # Volumes and timeseries are read from the file on demand
+        if self.nvols == 1 or self._meta.get("raw_2dt", False):
+            self.raw()
+
+    def materialize(self):
+        """
+        Read all the data into memory and close the file
+        """
+        self.raw()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _volume_for_slicing(self, vol):
+        if self.rawdata is not None or self._meta.get("raw_2dt", False):
+            return QpData._volume_for_slicing(self, vol)
+        return _VolumeProxy(self._dataset(), min(vol, self.nvols-1), self._lock)
+
+    def _correct_dims(self, arr):
+        if self._meta.get("raw_2dt", False) and arr.shape[3] == 1:
+            # Single-slice, interpret 3rd dimension as time
+            arr = np.transpose(arr, (0, 1, 3, 2))
+        if arr.shape[3] == 1:
+            arr = np.squeeze(arr, axis=-1)
+        return arr
+
+def save(data, fname, grid=None, outdir=""):
+    """
+    Save data to a chunked HDF5 file
+
+    Data is written one volume at a time so a complete copy of the data is not required
+
+    :param data: QpData instance
+    :param fname: File name
+    :param grid: If specified, grid to save the data on
+    :param outdir: Optional output directory if fname is not absolute
+    """
+    _require_h5py()
+    source = data
+    if grid is None:
+        grid = data.grid
+    elif not grid.matches(data.grid):
+        data = data.resample(grid)
+
+    if not fname:
+        fname = data.name + HDF5_EXTENSIONS[0]
+    if not os.path.isabs(fname):
+        fname = os.path.join(outdir, fname)
+
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    if isinstance(source, Hdf5Data) and os.path.abspath(fname) == os.path.abspath(source.fname):
+        # Make sure we are not still reading from the file we are about to overwrite
+        source.materialize()
+
+    shape = list(grid.shape) + [data.nvols]
+    chunks = tuple([min(chunk, dim) for chunk, dim in zip(CHUNK_SHAPE, shape)])
+    LOG.debug("Saving %s as %s (chunks=%s)", data.name, fname, chunks)
+    with h5py.File(fname, "w") as h5file:
+        dset = None
+        converted = False
+        for vol in range(data.nvols):
+            voldata = data.volume(vol)
+            if data.roi:
+                source_dtype = voldata.dtype
+                voldata = as_label_array(voldata)
+                converted = converted or voldata.dtype != source_dtype
+            if dset is None:
+                dset = h5file.create_dataset(DATASET_NAME, shape=shape, dtype=voldata.dtype, chunks=chunks,
+                                             compression=COMPRESSION, compression_opts=COMPRESSION_LEVEL,
+                                             shuffle=True)
+            dset[..., vol] = voldata
+
+        dset.attrs["affine"] = grid.affine
+        dset.attrs["units"] = grid.units
+        dset.attrs["vol_scale"] = data.metadata.get("vol_scale", 1.0)
+        if data.metadata.get("vol_units", None) is not None:
+            dset.attrs["vol_units"] = data.metadata["vol_units"]
+        if data.metadata:
+            from quantiphyse.utils.batch import to_yaml
+            dset.attrs["metadata"] = to_yaml({"QpMetadata" : data.metadata})
+
+    source._saved(fname, data is source and not converted, Hdf5Data)
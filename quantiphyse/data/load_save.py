@@ -29,20 +29,28 @@ import numpy as np
 from quantiphyse.utils import QpException
 from .qpdata import DataGrid, QpData, NumpyData
 from .nifti import NiftiData, save as save_nifti
+from .hdf5 import Hdf5Data, is_hdf5, save as save_hdf5
 from .dicoms import DicomFolder
 
 LOG = logging.getLogger(__name__)
 
-def load(fname):
+def load(fname, mmap=None, progress_cb=None):
     """
     Load a data file
 
+    :param mmap: If True, memory-map the data if the file format supports it. If not
+                 specified the default for the file format is used
+    :param progress_cb: Optional callable taking a progress fraction between 0 and 1.
+                        Only used for formats which take significant time to load,
+                        i.e. DICOM folders
     :return: QpData instance
     """
     if os.path.isdir(fname):
-        return DicomFolder(fname)
+        return DicomFolder(fname, progress_cb=progress_cb)
     elif fname.endswith(".nii") or fname.endswith(".nii.gz"):
-        return NiftiData(fname)
+        return NiftiData(fname, mmap=mmap)
+    elif is_hdf5(fname):
+        return Hdf5Data(fname)
     else:
         raise QpException("%s: Unrecognized file type" % fname)
 
@@ -55,4 +63,7 @@ def save(data, fname, grid=None, outdir=""):
     :param grid: If specified, grid to save the data on
     :param outdir: Optional output directory if fname is not absolute
     """
-    save_nifti(data, fname, grid, outdir)
+    if fname and is_hdf5(fname):
+        save_hdf5(data, fname, grid, outdir)
+    else:
+        save_nifti(data, fname, grid, outdir)
@@ -0,0 +1,265 @@
+"""
+Quantiphyse - Asynchronous loading of data files
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division
+
+import logging
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
+from .load_save import load
+
+LOG = logging.getLogger(__name__)
+
+#: Maximum number of files which are loaded at the same time
+LOAD_THREADS = 4
+
+class LoadRequest(object):
+    """
+    Handle for a request to an AsyncLoader, which can be used as a future
+    """
+
+    def __init__(self, desc):
+        """
+        :param desc: Description of the request, normally the file name
+        """
+        self.desc = desc
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """
+        :return: True if the request has completed, successfully or not
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the request to complete
+
+        :param timeout: Maximum time to wait in seconds. If not specified, wait indefinitely
+        :return: Return value of the request. If the request failed, the exception is raised
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for %s" % self.desc)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the request to complete
+
+        :param timeout: Maximum time to wait in seconds. If not specified, wait indefinitely
+        :return: Exception raised by the request, or None if it succeeded
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for %s" % self.desc)
+        return self._exception
+
+class AsyncLoader(QtCore.QObject):
+    """
+    Loads data in a pool of background threads
+
+    Requests are run concurrently, but completion callbacks are always called in the
+    thread which owns the loader (normally the GUI thread), so they can safely add data
+    to the IVM. Callbacks are called in the order in which the requests were made so
+    when several files are loaded at once, the data is added in a predictable order.
+
+    Delivering callbacks requires a Qt event loop. If there is no QCoreApplication,
+    requests are run synchronously when they are submitted.
+    """
+
+    # Progress of a request - emits description and fraction complete
+    sig_progress = QtCore.Signal(str, float)
+
+    # Number of requests which have not yet completed
+    sig_pending = QtCore.Signal(int)
+
+    # A request has completed in a background thread - used internally
+    _sig_done = QtCore.Signal()
+
+    def __init__(self, nthreads=None):
+        """
+        :param nthreads: Number of background threads. If not specified, use ``LOAD_THREADS``
+        """
+        super(AsyncLoader, self).__init__()
+        self._nthreads = nthreads if nthreads is not None else LOAD_THREADS
+        self._pool = None
+        self._requests = collections.deque()
+        self._delivering = False
+        self._sig_done.connect(self._deliver, QtCore.Qt.QueuedConnection)
+
+    @property
+    def pending(self):
+        """ Number of requests whose callbacks have not yet been called """
+        return len(self._requests)
+
+    def submit(self, desc, func, callback=None, errback=None):
+        """
+        Run a function in a background thread
+
+        :param desc: Description of the request, normally the file name
+        :param func: Callable to run. It is passed a single argument: a callable taking a
+                     progress fraction between 0 and 1
+        :param callback: Optional callable which is passed the return value of ``func``
+        :param errback: Optional callable which is passed the exception if ``func`` fails.
+                        If not specified, the exception is raised from the loader thread so
+                        it is reported by the default exception handler
+        :return: LoadRequest
+        """
+        if self._pool is None and QtCore.QCoreApplication.instance() is not None:
+            self._pool = ThreadPool(self._nthreads)
+
+        request = LoadRequest(desc)
+        def _progress(frac):
+            self.sig_progress.emit(desc, frac)
+
+        def _run():
+            try:
+                request._result = func(_progress)
+            except Exception as exc: # pylint: disable=broad-except
+                LOG.debug("Failed to load %s", desc, exc_info=True)
+                request._exception = exc
+            request._done.set()
+            self._sig_done.emit()
+
+        self._requests.append((request, callback, errback))
+        self.sig_pending.emit(len(self._requests))
+        if QtCore.QCoreApplication.instance() is None:
+            # No event loop to deliver results, e.g. when used as a library - load synchronously
+            _run()
+            self._deliver()
+        else:
+            self._pool.apply_async(_run)
+        return request
+
+    def load(self, fname, callback=None, errback=None, preload=True, **kwargs):
+        """
+        Load a data file
+
+        :param fname: File name
+        :param callback: Optional callable which is passed the loaded QpData
+        :param errback: Optional callable which is passed the exception if loading fails
+        :param preload: If True, also read the data into memory in the background (see ``QpData.preload``)
+        :param kwargs: Additional keyword arguments for :func:`load`
+        :return: LoadRequest
+        """
+        def _load(progress_cb):
+            qpdata = load(fname, progress_cb=progress_cb, **kwargs)
+            if preload:
+                qpdata.preload()
+            return qpdata
+        return self.submit(fname, _load, callback, errback)
+
+    def preload(self, qpdata, callback=None, errback=None):
+        """
+        Read data into memory in the background (see ``QpData.preload``)
+
+        :param qpdata: QpData instance
+        :param callback: Optional callable which is passed ``qpdata`` when it has been read
+        :param errback: Optional callable which is passed the exception if reading fails
+        :return: LoadRequest
+        """
+        def _preload(_progress_cb):
+            qpdata.preload()
+            return qpdata
+        return self.submit(getattr(qpdata, "fname", None) or qpdata.name, _preload, callback, errback)
+
+    def wait(self, requests=None):
+        """
+        Wait for requests to complete and call their callbacks
+
+        Callbacks are still called in the order in which the requests were made, so the
+        callbacks of any earlier requests are also called. Later requests are not waited
+        for. This may be called from a completion callback, in which case the callbacks
+        are called directly rather than when the current callback returns.
+
+        :param requests: Sequence of LoadRequest instances returned by ``submit()``. If not
+                         specified, wait for all requests which have been made so far
+        """
+        if requests is None:
+            requests = [request for request, _, _ in self._requests]
+        waiting = set(requests)
+
+        delivering, self._delivering = self._delivering, True
+        try:
+            while any([request in waiting for request, _, _ in self._requests]):
+                self._requests[0][0].exception()
+                self._deliver_completed()
+        finally:
+            self._delivering = delivering
+
+    def stop(self):
+        """
+        Discard requests which have not yet started and shut down the background threads
+
+        Callbacks will not be called for any outstanding requests
+        """
+        pool, self._pool = self._pool, None
+        self._requests.clear()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def _deliver(self):
+        """
+        Call the callbacks of completed requests, in the order they were made
+        """
+        if self._delivering:
+            # Callback is running a nested event loop, e.g. a modal dialog. Remaining requests
+            # will be delivered when it returns
+            return
+
+        self._delivering = True
+        try:
+            self._deliver_completed()
+        finally:
+            self._delivering = False
+
+    def _deliver_completed(self):
+        while self._requests and self._requests[0][0].done():
+            request, callback, errback = self._requests.popleft()
+            self.sig_pending.emit(len(self._requests))
+            if request._exception is None:
+                if callback is not None:
+                    callback(request._result)
+            elif errback is not None:
+                errback(request._exception)
+            else:
+                # Make sure any remaining completed requests are not left behind
+                QtCore.QTimer.singleShot(0, self._deliver)
+                raise request._exception
+
+_LOADER = None
+
+def default_loader():
+    """
+    :return: Shared AsyncLoader instance
+    """
+    global _LOADER
+    if _LOADER is None:
+        _LOADER = AsyncLoader()
+    return _LOADER
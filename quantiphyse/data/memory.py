@@ -0,0 +1,145 @@
+"""
+Quantiphyse - Memory accounting for data held by the IVM
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division
+
+import logging
+from collections import OrderedDict
+
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
+LOG = logging.getLogger(__name__)
+
+#: Default memory budget in bytes for data held by the IVM. When this is exceeded,
+#: data items which have not been used recently are asked to release their memory.
+#: Set to 0 for no limit
+MEMORY_BUDGET = 4 * 1024 * 1024 * 1024
+
+def format_size(nbytes):
+    """
+    :return: Human-readable string describing a number of bytes, e.g. '1.2 GB'
+    """
+    for units in ("bytes", "kB", "MB", "GB"):
+        if nbytes < 1024 or units == "GB":
+            break
+        nbytes /= 1024
+    if units == "bytes":
+        return "%i %s" % (nbytes, units)
+    return "%.1f %s" % (nbytes, units)
+
+class MemoryManager(QtCore.QObject):
+    """
+    Tracks the memory held by data items in an ImageVolumeManagement and keeps it
+    within a budget
+
+    Items are kept in order of use. When the total usage exceeds the budget, items
+    are ``uncache()``-d starting with the least recently used. This releases cached
+    resampled copies and slices of any item, and the main data array of items which
+    can re-read it from a file and have not been modified since it was read (see
+    ``QpData.reloadable``). The main data, current data and current ROI are never
+    evicted.
+    """
+
+    # Change in memory usage - emits (usage in bytes, budget in bytes)
+    sig_usage = QtCore.Signal(object, object)
+
+    def __init__(self, ivm, budget=None):
+        """
+        :param ivm: ImageVolumeManagement
+        :param budget: Memory budget in bytes. If not specified, use ``MEMORY_BUDGET``
+        """
+        super(MemoryManager, self).__init__()
+        self._ivm = ivm
+        self._budget = budget if budget is not None else MEMORY_BUDGET
+        self._order = OrderedDict()
+
+    @property
+    def budget(self):
+        """ Memory budget in bytes, 0 for no limit """
+        return self._budget
+
+    @budget.setter
+    def budget(self, budget):
+        self._budget = budget
+        self.enforce()
+
+    def usage(self):
+        """
+        :return: Dictionary of data item name : memory usage in bytes
+        """
+        return dict([(name, qpd.memory_usage()) for name, qpd in self._ivm.data.items()])
+
+    def total(self):
+        """
+        :return: Total memory usage of all data items in bytes
+        """
+        return sum(self.usage().values())
+
+    def reset(self):
+        """
+        Forget the order of use of all data items, e.g. when the IVM is cleared
+        """
+        self._order.clear()
+
+    def touch(self, name):
+        """
+        Mark a data item as the most recently used
+        """
+        self._order.pop(name, None)
+        self._order[name] = True
+
+    def forget(self, name):
+        """
+        Stop tracking a data item, e.g. when it is deleted
+        """
+        self._order.pop(name, None)
+
+    def enforce(self):
+        """
+        Release memory from least recently used data items until usage is within the budget
+
+        :return: Total memory usage after any items have been released
+        """
+        usage = self.usage()
+        total = sum(usage.values())
+        if self._budget > 0 and total > self._budget:
+            for name in self._lru_names():
+                if self._protected(name) or usage.get(name, 0) == 0:
+                    continue
+                qpd = self._ivm.data[name]
+                LOG.debug("Memory usage %s over budget - releasing %s", format_size(total), name)
+                qpd.uncache()
+                total += qpd.memory_usage() - usage[name]
+                if total <= self._budget:
+                    break
+
+        self.sig_usage.emit(total, self._budget)
+        return total
+
+    def _lru_names(self):
+        # Items never touched are treated as least recently used
+        names = [name for name in self._ivm.data if name not in self._order]
+        names += [name for name in self._order if name in self._ivm.data]
+        return names
+
+    def _protected(self, name):
+        qpd = self._ivm.data[name]
+        return self._ivm.is_main_data(qpd) or self._ivm.is_current_data(qpd) or self._ivm.is_current_roi(qpd)
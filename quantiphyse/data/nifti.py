@@ -19,22 +19,64 @@ from __future__ import division, print_function
 
 import os
 import logging
+import threading
 import traceback
 
 import nibabel as nib
 import numpy as np
 
-from .qpdata import DataGrid, QpData, NumpyData
+HAVE_INDEXED_GZIP = True
+try:
+    import indexed_gzip
+except ImportError:
+    HAVE_INDEXED_GZIP = False
+
+from .qpdata import DataGrid, QpData, NumpyData, as_label_array, _readonly_view
+from .gzip_writer import ParallelGzipWriter
 
 LOG = logging.getLogger(__name__)
 
 QP_NIFTI_EXTENSION_CODE = 42
 
+#: Default for whether uncompressed Nifti files are memory-mapped rather than
+#: read into memory. Can be overridden for individual files when loading
+MMAP = False
+
+#: Whether to read volumes from compressed Nifti files using an index of seek points
+#: so the whole file does not need to be decompressed. Requires ``indexed_gzip``
+GZIP_INDEX = True
+
+#: Whether to save the index of seek points to a file alongside the compressed Nifti
+#: file so it does not need to be rebuilt when the file is next loaded
+GZIP_INDEX_SAVE = False
+
+#: Extension added to the Nifti file name to give the name of the index file
+GZIP_INDEX_EXT = ".gzidx"
+
 class NiftiData(QpData):
     """
     QpData from a Nifti file
+
+    By default data is read into memory when first required. Alternatively uncompressed
+    files can be memory-mapped, in which case ``raw()`` and ``volume()`` return read-only
+    views onto the file and data is paged in by the operating system as it is accessed.
+    This allows data sets larger than the available memory to be viewed, however random
+    access may be slow, e.g. on network storage, so ``materialize()`` can be used to
+    read the data into memory when required.
+
+    Compressed files are a single gzip stream so reading a volume normally requires
+    decompressing everything before it. If ``indexed_gzip`` is available, individual
+    volumes are instead read using an index of seek points which is built on first
+    access (and optionally saved, see ``GZIP_INDEX_SAVE``).
     """
-    def __init__(self, fname):
+    def __init__(self, fname, mmap=None):
+        """
+        :param fname: File name
+        :param mmap: If True, memory-map the data if possible. If not specified, use
+                     the value of the module-level ``MMAP`` setting
+        """
+        if mmap is None:
+            mmap = MMAP
         nii = nib.load(fname)
         shape = list(nii.shape)
         while len(shape) < 3:
@@ -48,13 +90,25 @@ class NiftiData(QpData):
         self.rawdata = None
         self.voldata = None
         self.nifti_header = nii.header
-        metadata = None
+        self._img_class = type(nii)
+        self._indexed_img = None
+        self._indexed_file = None
+        self._file_lock = threading.Lock()
+
+        # Memory mapping is only possible for uncompressed data with no scaling
+        self._mmap = bool(mmap) and fname.endswith(".nii") and \
+                     getattr(nii.dataobj, "slope", 1) == 1 and getattr(nii.dataobj, "inter", 0) == 0
+        metadata, stats = None, None
         for ext in self.nifti_header.extensions:
             if ext.get_code() == QP_NIFTI_EXTENSION_CODE:
                 import yaml
                 LOG.debug("Found QP metadata: %s", ext.get_content())
                 try:
-                    metadata = yaml.load(ext.get_content())[0]["QpMetadata"]
+                    content = {}
+                    for item in yaml.load(ext.get_content()):
+                        content.update(item)
+                    metadata = content["QpMetadata"]
+                    stats = _stats_from_yaml(content.get("QpStats", None), shape[:3] + [nvols,])
                     LOG.debug(metadata)
                 except (KeyError, yaml.YAMLError):
                     LOG.warn("Failed to read Quantiphyse metadata")
@@ -74,38 +128,156 @@ class NiftiData(QpData):
             vol_scale = zooms[3]
 
         grid = DataGrid(shape[:3], nii.header.get_best_affine(), units=xyz_units)
-        QpData.__init__(self, fname, grid, nvols, vol_unit=vol_units, vol_scale=vol_scale, fname=fname, metadata=metadata)
+        QpData.__init__(self, fname, grid, nvols, vol_unit=vol_units, vol_scale=vol_scale, fname=fname,
+                        metadata=metadata, stats=stats)
+
+    @property
+    def mmap(self):
+        """ True if data is accessed through a memory map rather than read into memory """
+        return self._mmap
 
     def raw(self):
-        # NB: copy() converts data to an in-memory array instead of a numpy file memmap.
-        # Appears to improve speed drastically as well as stop a bug with accessing the subset of the array
-        # memmap has been designed to save space on ram by keeping the array on the disk but does
-        # horrible things with performance, and analysis especially when the data is on the network.
-        if self.rawdata is None:
-            nii = nib.load(self.fname)
-            #self.rawdata = nii.get_data().copy()
-            self.rawdata = nii.get_data()
-            self.rawdata = self._correct_dims(self.rawdata)
+        # NB: Unless memory mapping has been requested, make sure we read the data into an in-memory
+        # array rather than a numpy file memmap. Appears to improve speed drastically as well as stop a
+        # bug with accessing the subset of the array. memmap has been designed to save space on ram by
+        # keeping the array on the disk but does horrible things with performance, and analysis
+        # especially when the data is on the network.
+        with self._load_lock:
+            if self.rawdata is None:
+                if self._mmap:
+                    nii = nib.load(self.fname, mmap="r")
+                else:
+                    nii = nib.load(self.fname, mmap=False)
+                self.rawdata = self._correct_dims(np.asanyarray(nii.dataobj))
+
+            self.voldata = None
+            return self.rawdata
+
+    def materialize(self):
+        """
+        Read all the data into memory
+
+        Subsequent access will not use the file, i.e. memory-mapping or indexed
+        reading of volumes will no longer be used.
+        """
+        with self._load_lock:
+            if self._mmap:
+                self.rawdata = np.array(self.raw())
+                self._mmap = False
+            else:
+                self.raw()
+            self._close_indexed_img()
+
+    def writeable_raw(self):
+        if self._mmap:
+            # Memory map is read-only so modifications need an in-memory copy
+            self.materialize()
+        return QpData.writeable_raw(self)
+
+    @property
+    def reloadable(self):
+        return os.path.exists(self.fname) and self._unmodified()
+
+    def uncache(self):
+        """
+        Discard data read from the file. It will be re-read when next required
+        """
+        with self._load_lock:
+            QpData.uncache(self)
+            if self.reloadable:
+                self.rawdata = None
+                self.voldata = None
+                self._close_indexed_img()
+
+    def memory_usage(self):
+        usage = QpData.memory_usage(self)
+        if self.rawdata is not None and not self._mmap:
+            usage += self.rawdata.nbytes
+        if self.voldata is not None:
+            usage += sum([voldata.nbytes for voldata in self.voldata if voldata is not None])
+        return usage
+
+    def preload(self):
+        """
+        Read the data into memory, unless it is memory mapped or volumes of compressed
+        data can be read individually - in which case just make sure the index is ready
+        """
+        if self._mmap or self.rawdata is not None:
+            return
+        if self.nvols > 1 and not self._meta.get("raw_2dt", False):
+            with self._file_lock:
+                if self._get_indexed_img() is not None:
+                    return
+        self.raw()
+
+    def __getstate__(self):
+        # Open files and locks cannot be pickled
+        state = QpData.__getstate__(self)
+        state["_indexed_img"] = None
+        state["_indexed_file"] = None
+        del state["_file_lock"]
+        return state
+
+    def __setstate__(self, state):
+        QpData.__setstate__(self, state)
+        self._file_lock = threading.Lock()
+
+    def _get_indexed_img(self):
+        """
+        Get a Nifti image which reads a compressed file using an index of seek points
+
+        :return: nibabel image or None if an index cannot be used for this file
+        """
+        if self._indexed_img is None and GZIP_INDEX and HAVE_INDEXED_GZIP and self.fname.endswith(".gz"):
+            idxfile = self.fname + GZIP_INDEX_EXT
+            fileobj = indexed_gzip.IndexedGzipFile(self.fname, drop_handles=False)
+            if os.path.exists(idxfile) and os.path.getmtime(idxfile) >= os.path.getmtime(self.fname):
+                LOG.debug("Importing gzip index from %s", idxfile)
+                fileobj.import_index(idxfile)
+            else:
+                LOG.debug("Building gzip index for %s", self.fname)
+                fileobj.build_full_index()
+                if GZIP_INDEX_SAVE:
+                    try:
+                        fileobj.export_index(idxfile)
+                    except (IOError, OSError):
+                        LOG.warn("Failed to save gzip index to %s", idxfile)
+            holder = nib.FileHolder(self.fname, fileobj)
+            self._indexed_img = self._img_class.from_file_map({"header" : holder, "image" : holder})
+            self._indexed_file = fileobj
+        return self._indexed_img
+
+    def _close_indexed_img(self):
+        """
+        Discard the image used for indexed reading of volumes and close its file
+        """
+        with self._file_lock:
+            self._indexed_img = None
+            if self._indexed_file is not None:
+                self._indexed_file.close()
+                self._indexed_file = None
 
-        self.voldata = None
-        return self.rawdata
-        
     def volume(self, vol, qpdata=False):
         vol = min(vol, self.nvols-1)
-        if self.nvols == 1:
-            ret = self.raw()
-        elif self.rawdata is not None:
-            ret = self.rawdata[:, :, :, vol]
-        else:
-            if self.voldata is None:
-                self.voldata = [None,] * self.nvols
-            if self.voldata[vol] is None:
-                nii = nib.load(self.fname)
-                self.voldata[vol] = self._correct_dims(nii.dataobj[..., vol])
-            ret = self.voldata[vol]
+        with self._load_lock:
+            if self.nvols == 1:
+                ret = self.raw()
+            elif self.rawdata is not None or self._mmap:
+                # Memory-mapped volumes are views so there is no need to cache them separately
+                ret = self.raw()[:, :, :, vol]
+            else:
+                if self.voldata is None:
+                    self.voldata = [None,] * self.nvols
+                if self.voldata[vol] is None:
+                    with self._file_lock:
+                        nii = self._get_indexed_img()
+                        if nii is None:
+                            nii = nib.load(self.fname)
+                        self.voldata[vol] = self._correct_dims(nii.dataobj[..., vol])
+                ret = self.voldata[vol]
 
         if qpdata:
-            return NumpyData(ret, grid=self.grid, name="%s_vol_%i" % (self.name, vol))
+            return NumpyData(_readonly_view(ret), grid=self.grid, name="%s_vol_%i" % (self.name, vol))
         else:
             return ret
 
@@ -121,50 +293,96 @@ class NiftiData(QpData):
             arr = np.squeeze(arr, axis=-1)
         return arr
 
+def _stats_to_yaml(data):
+    """
+    :return: Cached statistics summaries of a data item in a YAML-compatible form
+    """
+    stats = {"shape" : list(data.shape)}
+    for vol, summary in data.cached_stats().items():
+        stats["all" if vol is None else vol] = summary
+    return stats
+
+def _stats_from_yaml(stats, shape):
+    """
+    :return: Statistics summaries in the form used by ``QpData.stats()``, or None if
+             they are missing or were not saved from data with the given shape
+    """
+    if not stats or stats.pop("shape", None) != shape:
+        return None
+    return dict([(None if vol == "all" else vol, summary) for vol, summary in stats.items()])
+
 def save(data, fname, grid=None, outdir=""):
     """
     Save data to a file
+
+    The data array is not copied. The header is written first and the data is then
+    written slab by slab. Compressed files are written using multiple threads.
     
     :param data: QpData instance
     :param fname: File name
     :param grid: If specified, grid to save the data on
     :param outdir: Optional output directory if fname is not absolute
     """
+    if not fname:
+        fname = data.name
+        
+    _, extension = os.path.splitext(fname)
+    if extension == "":
+        fname += ".nii"
+        
+    if not os.path.isabs(fname):
+        fname = os.path.join(outdir, fname)
+
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    if isinstance(data, NiftiData) and os.path.abspath(fname) == os.path.abspath(data.fname):
+        # Make sure we are not still reading from the file we are about to overwrite
+        data.materialize()
+
     if grid is None:
         grid = data.grid
-        arr = data.raw().copy()
+    if grid.matches(data.grid):
+        arr = data.raw()
     else:
-        arr = data.resample(grid).raw().copy()
-        
+        arr = data.resample(grid).raw()
+    source_dtype = arr.dtype
+
     if hasattr(data, "nifti_header"):
         header = data.nifti_header.copy()
     else:
         header = None
 
+    if data.roi:
+        # Preserve the compact integer type used for ROI labels
+        arr = as_label_array(arr)
+
     img = nib.Nifti1Image(arr, grid.affine, header=header)
+    if data.roi:
+        # Header copied from the source file may specify a different data type
+        img.header.set_data_dtype(arr.dtype)
     img.update_header()
     if data.metadata:
         from quantiphyse.utils.batch import to_yaml
-        yaml_metadata = to_yaml({"QpMetadata" : data.metadata})
+        content = {"QpMetadata" : data.metadata}
+        if grid is data.grid:
+            # Save any statistics summaries we have so they do not need to be recomputed on load
+            content["QpStats"] = _stats_to_yaml(data)
+        yaml_metadata = to_yaml(content)
         LOG.debug("Writing metadata: %s", yaml_metadata)
         extensions = nib.nifti1.Nifti1Extensions([ext for ext in img.header.extensions if ext.get_code() != QP_NIFTI_EXTENSION_CODE])
         extensions.append(nib.nifti1.Nifti1Extension(QP_NIFTI_EXTENSION_CODE, yaml_metadata.encode('utf-8')))
         img.header.extensions = extensions
 
-    if not fname:
-        fname = data.name
-        
-    _, extension = os.path.splitext(fname)
-    if extension == "":
-        fname += ".nii"
-        
-    if not os.path.isabs(fname):
-        fname = os.path.join(outdir, fname)
-
-    dirname = os.path.dirname(fname)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-
     LOG.debug("Saving %s as %s", data.name, fname)
-    img.to_filename(fname)
-    data.fname = fname
+    if fname.endswith(".gz"):
+        fileobj = ParallelGzipWriter(fname)
+    else:
+        fileobj = open(fname, "wb")
+    with fileobj:
+        holder = nib.FileHolder(fname, fileobj)
+        img.to_file_map({"header" : holder, "image" : holder})
+
+    exact = grid.matches(data.grid) and arr.dtype == source_dtype and img.get_data_dtype() == arr.dtype
+    data._saved(fname, exact, NiftiData)
@@ -29,8 +29,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import copy
+import hashlib
 import logging
 import math
+import threading
 
 import numpy as np
 import scipy
@@ -48,6 +51,40 @@ from . import functions as pg
 
 # FIXME hack to ensure extras is frozen!
 from . import extras
+from .cache import LruCache
+from .roi_index import RoiIndex
+
+#: Maximum memory in bytes used by each data item to cache resampled copies of itself.
+#: Set to 0 to disable caching of resampled data
+RESAMPLE_CACHE_SIZE = 512 * 1024 * 1024
+
+#: Maximum memory in bytes used by each data item to cache slices extracted for display.
+#: Set to 0 to disable caching of slices
+SLICE_CACHE_SIZE = 32 * 1024 * 1024
+
+#: Number of histogram bins in the cached statistics summary of each data item and volume.
+#: Approximate percentiles are obtained from this histogram
+STATS_BINS = 256
+
+#: Minimum number of voxels in a volume for a multi-resolution pyramid to be used
+#: when displaying it. Smaller data is always displayed at full resolution
+PYRAMID_MIN_VOXELS = 32 * 1024 * 1024
+
+#: Maximum number of reduced resolution levels in the pyramid. Set to 0 to disable pyramids
+PYRAMID_MAX_LEVELS = 5
+
+#: Pyramid levels are not reduced below this number of voxels along the longest axis
+PYRAMID_MIN_SIZE = 64
+
+#: Maximum number of voxels in the pyramid level used to summarize a volume, e.g. for
+#: histograms and colour map ranges
+OVERVIEW_VOXELS = 1024 * 1024
+
+#: Maximum number of bytes hashed at once when computing the fingerprint of a data item
+FINGERPRINT_CHUNK_SIZE = 16 * 1024 * 1024
+
+#: Maximum number of grid-to-grid transformation matrices cached by each grid
+GRID_TO_GRID_CACHE_SIZE = 32
 
 #: Tolerance for treating values as equal
 #: Used to determine if matrices are diagonal or identity
@@ -92,6 +129,155 @@ def remove_nans(x, replace_val=0):
     x[~np.isfinite(x)] = replace_val
     return x
 
+def label_dtype(vmin, vmax):
+    """
+    Get the integer type used to store ROI / label data with a given range of values
+
+    This is the smallest unsigned integer type which can hold the values, or the
+    smallest signed integer type if there are negative values
+
+    :param vmin: Minimum label value
+    :param vmax: Maximum label value
+    :return: Numpy dtype
+    """
+    if vmin >= 0:
+        dtypes = (np.uint8, np.uint16, np.uint32, np.uint64)
+    else:
+        dtypes = (np.int8, np.int16, np.int32, np.int64)
+    for dtype in dtypes:
+        if np.iinfo(dtype).min <= vmin and vmax <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise QpException("Label values out of range: %s to %s" % (vmin, vmax))
+
+def as_label_array(data):
+    """
+    Convert ROI / label data to the integer type given by ``label_dtype``
+
+    :param data: Numpy array. Boolean arrays are converted to 0/1 labels. Arrays
+                 containing non-integer values are returned unchanged
+    :return: Numpy array, which will be ``data`` if no conversion was required
+    """
+    if data.dtype.kind not in "biuf":
+        return data
+    if data.size == 0:
+        vmin, vmax = 0, 0
+    else:
+        vmin, vmax = np.min(data), np.max(data)
+    if data.dtype.kind == "f" and (not np.isfinite(vmin) or not np.isfinite(vmax) or
+                                   not np.all(np.equal(np.mod(data, 1), 0))):
+        return data
+
+    dtype = label_dtype(int(vmin), int(vmax))
+    if data.dtype == dtype:
+        return data
+    return data.astype(dtype)
+
+def _qpdata_nbytes(qpd):
+    """
+    :return: Size of the raw data of a QpData instance in bytes
+    """
+    return qpd.raw().nbytes
+
+def _slice_nbytes(slice_data):
+    """
+    :return: Size of the arrays returned by ``QpData.slice_data`` in bytes
+    """
+    return sum([arr.nbytes for arr in slice_data])
+
+def _hist_percentile(stats, percentile):
+    """
+    :return: Approximate percentile of data from its statistics summary (see ``QpData.stats``)
+    """
+    hist = np.asarray(stats["hist"])
+    cumulative = np.cumsum(hist)
+    if cumulative[-1] == 0:
+        return stats["max"]
+    idx = np.searchsorted(cumulative, cumulative[-1] * percentile / 100.0)
+    bin_width = (stats["max"] - stats["min"]) / len(hist)
+    return min(stats["min"] + (idx+1) * bin_width, stats["max"])
+
+def _readonly(arr):
+    """
+    Make a Numpy array read-only so it can be returned without copying
+
+    :return: ``arr``
+    """
+    arr.flags.writeable = False
+    return arr
+
+def _readonly_view(arr):
+    """
+    :return: Read-only view of a Numpy array. The array itself is not affected
+    """
+    view = arr.view()
+    view.flags.writeable = False
+    return view
+
+def _apply_affine(mat, coords, direction=False):
+    """
+    Apply a 4x4 affine transformation to an array of points
+
+    :param mat: 4x4 affine matrix
+    :param coords: Array of shape [N, 3] or [N, 4], or a single point. If 4D, the last column
+                   is copied unchanged
+    :param direction: If True, coords are direction vectors so the offset is not applied
+    :return: Float Numpy array of the same shape as ``coords``
+    """
+    coords = np.asarray(coords, dtype=float)
+    ret = np.array(coords)
+    ret[..., :3] = np.dot(coords[..., :3], mat[:3, :3].T)
+    if not direction:
+        ret[..., :3] += mat[:3, 3]
+    return ret
+
+def _to_list(coords, orig):
+    """
+    Convert a transformed point back to a list, preserving an unchanged 4th entry
+    """
+    ret = list(coords[:3])
+    if len(orig) == 4:
+        ret.append(orig[3])
+    return ret
+
+def _reduce_resolution(arr, roi):
+    """
+    Halve the resolution of a 3D array along each axis with more than one voxel
+
+    Data is averaged over blocks of 2x2x2 voxels (smaller at the upper edges if the
+    size is odd). ROIs are subsampled instead so the labels are preserved.
+
+    :return: Tuple of reduced Numpy array, 4x4 matrix from reduced to original voxel co-ordinates
+    """
+    mat = np.identity(4)
+    for axis in range(3):
+        size = arr.shape[axis]
+        if size == 1:
+            continue
+        mat[axis, axis] = 2
+        if roi:
+            arr = np.take(arr, np.arange(0, size, 2), axis=axis)
+        else:
+            starts = np.arange(0, size, 2)
+            counts = np.diff(np.append(starts, size)).astype(np.float32)
+            counts_shape = [1, 1, 1]
+            counts_shape[axis] = len(counts)
+            arr = np.add.reduceat(arr, starts, axis=axis, dtype=np.float32) / counts.reshape(counts_shape)
+            # Reduced voxel centres are at the centres of the blocks
+            mat[axis, 3] = 0.5
+    return arr, mat
+
+def _new_resample_cache():
+    """
+    :return: Empty cache for resampled copies of a data item
+    """
+    return LruCache(RESAMPLE_CACHE_SIZE, sizeof=_qpdata_nbytes)
+
+def _new_slice_cache():
+    """
+    :return: Empty cache for slices extracted from a data item
+    """
+    return LruCache(SLICE_CACHE_SIZE, sizeof=_slice_nbytes)
+
 class DataGrid(object):
     """
     Defines a regular 3D grid in some 'world' space
@@ -113,10 +299,10 @@ class DataGrid(object):
         if len(affine.shape) != 2 or affine.shape[0] != 4 or affine.shape[1] != 4:
             raise RuntimeError("Grid affine must be 4x4 matrix")
 
-        self._affine = np.copy(affine)
-        self._shape = list(shape)[:]
-        self._affine_orig = np.copy(affine)
+        self._shape = _readonly(np.array(shape, dtype=int))
+        self._affine_orig = _readonly(np.array(affine, dtype=float))
         self._units = units
+        self.affine = affine
 
     @property
     def units(self):
@@ -125,37 +311,49 @@ class DataGrid(object):
 
     @property
     def affine(self):
-        """ 4D affine matrix which describes the transformation from grid co-ordinates to world space co-ordinates"""
-        return np.copy(self._affine)
+        """
+        4D affine matrix which describes the transformation from grid co-ordinates to world space co-ordinates.
+        This is read-only - to change the transformation assign a new matrix
+        """
+        return self._affine
 
     @affine.setter
     def affine(self, mat):
-        self._affine = np.copy(mat)
+        self._affine = _readonly(np.array(mat, dtype=float))
+        self._inv_affine = None
+        self._grid_to_grid_cache = {}
 
     @property
     def affine_orig(self):
-        """ Original 4D affine matrix from the initial creation of the grid. """
-        return np.copy(self._affine_orig)
+        """ Original 4D affine matrix from the initial creation of the grid (read-only) """
+        return self._affine_orig
 
     @property
     def shape(self):
-        """ Sequence of 3 integers giving number of voxels along each axis"""
-        return np.copy(self._shape)
+        """ Read-only array of 3 integers giving number of voxels along each axis"""
+        return self._shape
 
     @property
     def transform(self):
         """ 3x3 submatrix of ``affine`` used to transform grid space directions to world space """
-        return np.copy(self._affine[:3, :3])
+        return self._affine[:3, :3]
+
+    @property
+    def inv_affine(self):
+        """ Inverse of ``affine``, i.e. the transformation from world space to grid co-ordinates """
+        if self._inv_affine is None:
+            self._inv_affine = _readonly(np.linalg.inv(self._affine))
+        return self._inv_affine
 
     @property
     def inv_transform(self):
         """ 3x3 submatrix of ``affine`` used to transform world space directions to grid space"""
-        return np.linalg.inv(self.transform)
+        return self.inv_affine[:3, :3]
 
     @property
     def origin(self):
         """ 3D origin of grid in world co-ordinates (last column of ``affine``)"""
-        return np.copy(self._affine[:3, 3])
+        return self._affine[:3, 3]
 
     @property
     def spacing(self):
@@ -167,13 +365,32 @@ class DataGrid(object):
         """ Total number of voxels in the grid"""
         nvoxels = 1
         for dim in range(3):
-            nvoxels *= self._shape[dim]
+            nvoxels *= int(self._shape[dim])
         return nvoxels
 
     def reset(self):
         """ Reset to original orientation """
         self.affine = self._affine_orig
 
+    def grid_to_grid_matrix(self, from_grid):
+        """
+        Get the affine transformation from another grid's co-ordinates to this grid's
+        co-ordinates
+
+        Matrices are cached until the affine of this grid is changed.
+
+        :param from_grid: DataGrid
+        :return: Read-only 4x4 Numpy array
+        """
+        key = from_grid.affine.tobytes()
+        mat = self._grid_to_grid_cache.get(key, None)
+        if mat is None:
+            if len(self._grid_to_grid_cache) >= GRID_TO_GRID_CACHE_SIZE:
+                self._grid_to_grid_cache.clear()
+            mat = _readonly(np.dot(self.inv_affine, from_grid.affine))
+            self._grid_to_grid_cache[key] = mat
+        return mat
+
     def grid_to_grid(self, coord, from_grid=None, to_grid=None, direction=False):
         """
         Transform grid co-ordinates to another grid's co-ordinates
@@ -185,15 +402,7 @@ class DataGrid(object):
                    co-ordinates are assumed to be relative to this grid
         :return: List containing 3D or 4D co-ordinates
         """
-        if from_grid is not None and to_grid is None:
-            to_grid = self
-        elif from_grid is None and to_grid is not None:
-            from_grid = self
-        else:
-            raise RuntimeError("Exactly one of from_grid and to_grid must be specified")
-
-        world = from_grid.grid_to_world(coord, direction=direction)
-        return to_grid.world_to_grid(world, direction=direction)
+        return _to_list(self.grid_to_grid_many(np.array(coord, dtype=float), from_grid, to_grid, direction), coord)
 
     def grid_to_world(self, coords, direction=False):
         """
@@ -202,15 +411,7 @@ class DataGrid(object):
         :param coords: 3D or 4D grid co-ordinates. If 4D, last entry is returned unchanged
         :return: List containing 3D or 4D world co-ordinates
         """
-        vec = np.array(coords[:3])
-        world_coords = np.dot(self.transform, vec)
-        if not direction:
-            world_coords += np.array(self.origin, dtype=world_coords.dtype)
-
-        if len(coords) == 4:
-            return list(world_coords) + [coords[3]]
-        else:
-            return list(world_coords)
+        return _to_list(self.grid_to_world_many(np.array(coords, dtype=float), direction), coords)
 
     def world_to_grid(self, coords, direction=False):
         """
@@ -219,15 +420,47 @@ class DataGrid(object):
         :param coords: 3D world co-ordinates. If 4D, last entry is returned unchanged
         :return: List containing 3D or 4D grid co-ordinates
         """
-        vec = np.array(coords[:3])
-        if not direction:
-            vec -= np.array(self.origin, dtype=vec.dtype)
-        grid_coords = np.dot(self.inv_transform, vec)
+        return _to_list(self.world_to_grid_many(np.array(coords, dtype=float), direction), coords)
+
+    def grid_to_grid_many(self, coords, from_grid=None, to_grid=None, direction=False):
+        """
+        Transform an array of points from one grid's co-ordinates to another's
 
-        if len(coords) == 4:
-            return list(grid_coords) + [coords[3]]
+        :param coords: Numpy array of shape [N, 3] or [N, 4] (or a single 3D or 4D point). If
+                       4D, last column is returned unchanged
+        :param from_grid: DataGrid the input co-ordinates are relative to. They will be returned
+                     relative to this grid
+        :param to_grid: DataGrid the input co-ordinates are to be transformed into. The input
+                   co-ordinates are assumed to be relative to this grid
+        :return: Numpy array of the same shape as ``coords``
+        """
+        if from_grid is not None and to_grid is None:
+            mat = self.grid_to_grid_matrix(from_grid)
+        elif from_grid is None and to_grid is not None:
+            mat = to_grid.grid_to_grid_matrix(self)
         else:
-            return list(grid_coords)
+            raise RuntimeError("Exactly one of from_grid and to_grid must be specified")
+        return _apply_affine(mat, coords, direction)
+
+    def grid_to_world_many(self, coords, direction=False):
+        """
+        Transform an array of points from grid co-ordinates to world co-ordinates
+
+        :param coords: Numpy array of shape [N, 3] or [N, 4] (or a single 3D or 4D point). If
+                       4D, last column is returned unchanged
+        :return: Numpy array of the same shape as ``coords``
+        """
+        return _apply_affine(self._affine, coords, direction)
+
+    def world_to_grid_many(self, coords, direction=False):
+        """
+        Transform an array of points from world co-ordinates to grid co-ordinates
+
+        :param coords: Numpy array of shape [N, 3] or [N, 4] (or a single 3D or 4D point). If
+                       4D, last column is returned unchanged
+        :return: Numpy array of the same shape as ``coords``
+        """
+        return _apply_affine(self.inv_affine, coords, direction)
 
     def get_standard(self):
         """
@@ -347,6 +580,10 @@ class OrthoSlice(DataGrid):
         """ 3D normal vector to the plane in world co-ordinates"""
         return self._normal
 
+#: Grid whose co-ordinates are world co-ordinates, used when positions are given in world
+#: space. This is shared and must not be modified
+WORLD_GRID = DataGrid([1, 1, 1], np.identity(4))
+
 DEFAULT_DATA_VIEW = {
     "visible" : Visibility.SHOW,
     "roi" : None,
@@ -454,15 +691,45 @@ class QpData(object):
     """
 
     def __init__(self, name, grid, nvols, roi=False, metadata=None, view=None, **kwargs):
+        # Held by subclasses while reading data from their source or discarding it, so
+        # background threads (e.g. prefetching slices) do not race with loading or
+        # ``uncache()`` on the GUI thread
+        self._load_lock = threading.RLock()
+
         self.name = name
         self.grid = grid
 
         # Number of volumes (1=3D data)
         self._nvols = nvols
 
+        # Resampled copies of this data, keyed by source/target grid and interpolation order
+        self._resample_cache = _new_resample_cache()
+
+        # Slices extracted by slice_data(), keyed by plane, volume and interpolation order
+        self._slice_cache = _new_slice_cache()
+
+        # Statistics summaries keyed by volume index, or None for the whole data set
+        self._stats = dict(kwargs.get("stats", None) or {})
+
+        # Incremented whenever the data changes, so derived structures such as the
+        # ROI index can tell when they need to be rebuilt
+        self._generation = 0
+        self._roi_index = None
+        # Generation at which the raw data was last known to be the same as its source
+        # file, or None once it may have been modified. See ``_unmodified()``
+        self._source_generation = 0
+        self._fingerprint = None
+
+        # Reduced resolution levels keyed by volume index and level, see pyramid_level().
+        # Levels do not have pyramids of their own
+        self._pyramid = {}
+        self._use_pyramid = kwargs.get("pyramid", True)
+
         self._meta = Metadata()
         if metadata is not None:
             self._meta.update(metadata)
+        # Data range was previously cached in the metadata and could be out of date
+        self._meta.pop("range", None)
         md_roi = self._meta.pop("roi", False)
         if roi is None:
             roi = md_roi
@@ -484,6 +751,16 @@ class QpData(object):
         else:
             self.roi = roi
 
+    def __getstate__(self):
+        # Locks cannot be pickled
+        state = dict(self.__dict__)
+        state.pop("_load_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_lock = threading.RLock()
+
     @property
     def metadata(self):
         """ Metadata dictionary """
@@ -542,8 +819,7 @@ class QpData(object):
             raise TypeError("Only ROIs have distinct regions")
 
         if self._meta.get("roi_regions", None) is None:
-            regions = np.unique(self.raw().astype(np.int))
-            regions = np.delete(regions, np.where(regions == 0))
+            regions = [int(region) for region in self.roi_index().labels]
             if len(regions) == 0:
                 # Always have at least one region defined
                 regions = [1]
@@ -558,6 +834,22 @@ class QpData(object):
                 self._meta["roi_regions"] = roi_regions
         return self._meta["roi_regions"]
 
+    def roi_index(self):
+        """
+        Get the index of the voxels in each ROI region
+
+        The index is built in one pass over the data when first required and rebuilt
+        if the data changes (see ``invalidate()``)
+
+        :return: :class:`RoiIndex`
+        """
+        if not self.roi:
+            raise TypeError("Only ROIs have distinct regions")
+
+        if self._roi_index is None or self._roi_index.generation != self._generation:
+            self._roi_index = RoiIndex(self.raw(), self._generation)
+        return self._roi_index
+
     @property
     def fname(self):
         """
@@ -582,10 +874,11 @@ class QpData(object):
 
         self._meta["raw_2dt"] = True
         self._nvols = self.grid.shape[2]
+        self.invalidate()
 
         # The grid transform can't be properly interpreted because basically the file is broken,
         # so just make it 2D and hope the remaining transform is sensible
-        self.grid.shape[2] = 1
+        self.grid = DataGrid(list(self.grid.shape[:2]) + [1], self.grid.affine, units=self.grid.units)
 
     def raw(self):
         """
@@ -596,6 +889,38 @@ class QpData(object):
         """
         raise NotImplementedError("Internal Error: raw() has not been implemented.")
 
+    def writeable_raw(self):
+        """
+        Return the raw data as a Numpy array which may be modified in place
+
+        Raw data may be read-only when it is shared with another data item, e.g.
+        following ``resample()`` or ``volume(qpdata=True)``. Subclasses which
+        can do so replace it with a private copy in this case. ``invalidate()``
+        must be called after modifying the data.
+
+        :raises QpException: if the data cannot be modified
+        """
+        rawdata = self.raw()
+        if not rawdata.flags.writeable:
+            raise QpException("Data %s cannot be modified" % self.name)
+        # Caller may modify the array at any time so it can no longer be re-read from the source
+        self._source_generation = None
+        return rawdata
+
+    def invalidate(self):
+        """
+        Discard cached information derived from the raw data
+
+        This must be called whenever the raw data is replaced or modified in place so
+        that subsequent calls to, e.g. ``resample()`` do not return stale results
+        """
+        self._resample_cache.clear()
+        self._slice_cache.clear()
+        self._stats.clear()
+        self._generation += 1
+        self._roi_index = None
+        self._pyramid = {}
+
     def volume(self, vol, qpdata=False):
         """
         Get the specified volume from a multi-volume data set
@@ -607,13 +932,15 @@ class QpData(object):
         that we do not copy metadata as it may be related to the whole 4D data set.
 
         :param vol: Volume number (0=first)
+        :param qpdata: If True, return a :class:`NumpyData` object. This shares the volume
+                       data with this item rather than copying it, so its raw data is read-only
         """
         rawdata = self.raw()
         if self.ndim == 4:
             rawdata = rawdata[:, :, :, min(vol, self.nvols-1)]
 
         if qpdata:
-            return NumpyData(rawdata, grid=self.grid, name="%s_vol_%i" % (self.name, vol))
+            return NumpyData(_readonly_view(rawdata), grid=self.grid, name="%s_vol_%i" % (self.name, vol))
         else:
             return rawdata
 
@@ -627,7 +954,7 @@ class QpData(object):
         :param str: If True, return value as string to appropriate number of decimal places.
         """
         if grid is None:
-            grid = DataGrid([1, 1, 1], np.identity(4))
+            grid = WORLD_GRID
         if len(pos) == 3:
             pos = list(pos) + [0,]
 
@@ -660,7 +987,7 @@ class QpData(object):
             return [self.value(pos, grid), ]
 
         if grid is None:
-            grid = DataGrid([1, 1, 1], np.identity(4))
+            grid = WORLD_GRID
 
         data_pos = [int(math.floor(v+0.5)) for v in self.grid.grid_to_grid(pos[:3], from_grid=grid)]
         if min(data_pos) < 0:
@@ -673,6 +1000,47 @@ class QpData(object):
             except IndexError:
                 return []
 
+    def timeseries_many(self, points, grid=None):
+        """
+        Return the time/volume series at multiple points
+
+        All the positions are transformed in a single operation and the curves are
+        extracted together, so this is much faster than calling ``timeseries()``
+        for each point.
+
+        :param points: Sequence of N 3D or 4D positions, e.g. an Nx3 or Nx4 array. If
+                       ``grid`` not specified, positions are in world space
+        :param grid: If specified, interpret positions in this ``DataGrid`` co-ordinate space.
+        :return: Numpy float array of shape [N, nvols]. Rows for points outside the
+                 data are NaN
+        """
+        points = np.atleast_2d(np.array(points, dtype=float))
+        if points.size == 0:
+            return np.zeros((0, self.nvols))
+        if grid is None:
+            grid = WORLD_GRID
+
+        data_pos = np.floor(self.grid.grid_to_grid_many(points[:, :3], from_grid=grid) + 0.5).astype(np.intp)
+        inside = np.all(np.logical_and(data_pos >= 0, data_pos < self.grid.shape), axis=1)
+        ret = np.full((points.shape[0], self.nvols), np.nan)
+        if np.any(inside):
+            ret[inside] = self._timeseries_at(data_pos[inside])
+        return ret
+
+    def _timeseries_at(self, data_pos):
+        """
+        Get the time/volume series at voxels within the grid
+
+        The default implementation uses a single indexing operation on ``raw()``.
+        Subclasses may override this, e.g. to read only the required data from a file.
+
+        :param data_pos: Numpy integer array of shape [N, 3] containing voxel indices
+        :return: Numpy array of shape [N, nvols]
+        """
+        rawdata = self.raw()
+        curves = rawdata[data_pos[:, 0], data_pos[:, 1], data_pos[:, 2]]
+        return curves.reshape(data_pos.shape[0], self.nvols)
+
     def uncache(self):
         """
         Remove large stored data arrays from memory
@@ -683,14 +1051,238 @@ class QpData(object):
         data from a file might implement the method to write the data out to a temporary
         file which is then re-read on the next call to ``raw()`` or ``volume()``
 
-        This method is optional and does not have to be implemented"""
-        pass
+        This method is optional and does not have to be implemented. Subclasses which
+        implement it should call the base class method which discards cached resampled
+        copies and slices of the data, and should hold ``_load_lock`` while discarding
+        and re-reading their data"""
+        self._resample_cache.clear()
+        self._slice_cache.clear()
+        self._pyramid = {}
+
+    @property
+    def reloadable(self):
+        """
+        True if ``uncache()`` releases the main data array, i.e. the data can be
+        re-read from its source when next required
+        """
+        return False
+
+    def _saved(self, fname, exact, reader):
+        """
+        Record that the data has been saved to a file
+
+        The data is only associated with the file if it is an exact copy, and it can
+        only be re-read from it if it is in the format this class reads. Otherwise
+        the file may have replaced the source the data was read from, so it can no
+        longer be re-read.
+
+        :param fname: File name
+        :param exact: True if the file contains the data on the same grid with the same data type
+        :param reader: QpData subclass which reads the file format
+        """
+        if exact and isinstance(self, reader):
+            self.fname = fname
+            self._source_generation = self._generation
+        elif exact and not self.reloadable:
+            self.fname = fname
+        else:
+            self._source_generation = None
+
+    def _unmodified(self):
+        """
+        :return: True if the raw data is still the same as the data read from its source,
+                 i.e. it has not been returned by ``writeable_raw()`` and ``invalidate()``
+                 has not been called since it was read. Subclasses which re-read data
+                 from a file must not release it otherwise, as changes would be lost
+        """
+        return self._source_generation == self._generation
+
+    def memory_usage(self):
+        """
+        Estimate the memory held by this data item
+
+        The base class only counts cached resampled copies and slices. Subclasses
+        should add the size of any data arrays they hold in memory. Memory-mapped
+        data is not counted as it is managed by the operating system.
+
+        :return: Number of bytes
+        """
+        usage = self._resample_cache.size + self._slice_cache.size
+        usage += sum([level.raw().nbytes for level in list(self._pyramid.values())])
+        return usage
+
+    def pyramid_levels(self):
+        """
+        Get the number of reduced resolution levels available for display
+
+        Each level halves the resolution of the previous one along each axis. Data
+        with fewer than ``PYRAMID_MIN_VOXELS`` voxels per volume has no levels and is
+        always displayed at full resolution.
+
+        :return: Number of levels, not counting the full resolution data
+        """
+        if not self._use_pyramid or self.grid.nvoxels < PYRAMID_MIN_VOXELS:
+            return 0
+        levels, size = 0, max(self.grid.shape)
+        while levels < PYRAMID_MAX_LEVELS and size // 2 >= PYRAMID_MIN_SIZE:
+            levels += 1
+            size = (size + 1) // 2
+        return levels
+
+    def pyramid_level(self, level, vol=0, build=True):
+        """
+        Get a reduced resolution copy of a volume of the data
+
+        Levels are computed from the previous level when first required and cached
+        until the data changes. They may be built in a background thread, e.g. while
+        the full resolution data is being displayed.
+
+        :param level: Level index. 0 is the full resolution volume, each subsequent
+                      level halves the resolution along each axis
+        :param vol: Volume index
+        :param build: If False, return None rather than computing a level which is not
+                      already available
+        :return: 3D :class:`NumpyData` on a correspondingly coarser grid. Its raw data is
+                 shared and read-only
+        """
+        vol = min(vol, self.nvols-1)
+        if level <= 0:
+            return self.volume(vol, qpdata=True)
+
+        # Take a reference so levels computed from data which changes in the meantime
+        # are not stored alongside those for the new data
+        pyramid = self._pyramid
+        if (vol, level) not in pyramid:
+            if not build:
+                return None
+            if level == 1:
+                previous, previous_grid = self.volume(vol), self.grid
+            else:
+                previous_level = self.pyramid_level(level-1, vol)
+                previous, previous_grid = previous_level.raw(), previous_level.grid
+            LOG.debug("Building level %i for volume %i of %s", level, vol, self.name)
+            data, mat = _reduce_resolution(previous, self.roi)
+            grid = DataGrid(data.shape, np.dot(previous_grid.affine, mat), units=self.grid.units)
+            qpd = NumpyData(data, grid=grid, name="%s_level_%i" % (self.name, level), roi=self.roi,
+                            pyramid=False)
+            qpd.rawdata.flags.writeable = False
+            pyramid[(vol, level)] = qpd
+        return pyramid[(vol, level)]
+
+    def overview(self, vol=0):
+        """
+        Get a reduced resolution copy of a volume for summarizing it, e.g. as a histogram
+
+        :param vol: Volume index
+        :return: 3D :class:`NumpyData` of the finest pyramid level with no more than
+                 ``OVERVIEW_VOXELS`` voxels, or the full resolution volume if the data
+                 has no pyramid levels
+        """
+        return self.pyramid_level(self._overview_level(), vol)
+
+    def _overview_level(self):
+        """
+        :return: Pyramid level used by ``overview()``
+        """
+        levels = self.pyramid_levels()
+        level = 0
+        while level < levels and self.grid.nvoxels // (8 ** level) > OVERVIEW_VOXELS:
+            level += 1
+        return level
+
+    def preload(self):
+        """
+        Read data which will be needed for display into memory
+
+        This is called in a background thread after data is loaded so the GUI
+        does not block the first time the data is used. The default implementation
+        reads the raw data. Subclasses which read volumes or slices on demand may
+        override it to do less.
+        """
+        self.raw()
+
+    def stats(self, vol=None):
+        """
+        Get a summary of the statistics of the data
+
+        The summary is computed in a single pass when first requested and cached until
+        the data is changed (see ``invalidate()``). It contains:
+
+         - ``min``, ``max``: Range of finite values
+         - ``count``: Number of finite values
+         - ``hist``: Histogram of finite values with ``STATS_BINS`` equal bins between
+           ``min`` and ``max``
+
+        :param vol: Index of volume to use, if not specified use whole data set
+        :return: Dictionary containing statistics summary
+        """
+        if self.nvols == 1:
+            vol = None
+        elif vol is not None:
+            vol = min(vol, self.nvols-1)
+
+        if vol not in self._stats:
+            if vol is None and self.nvols > 1:
+                data = self.raw()
+            else:
+                data = self.volume(vol or 0)
+
+            # This ignores infinite values too unlike np.nanmin/np.nanmax
+            data = data[np.isfinite(data)]
+            if data.dtype.kind == "b":
+                data = data.astype(np.uint8)
+            dmin, dmax = np.min(data), np.max(data)
+            hist, _ = np.histogram(data, bins=STATS_BINS, range=(dmin, dmax))
+            self._stats[vol] = {
+                "min" : dmin.item(),
+                "max" : dmax.item(),
+                "count" : int(data.size),
+                "hist" : hist,
+            }
+        return self._stats[vol]
+
+    def cached_stats(self):
+        """
+        :return: Dictionary of volume index (None for the whole data set) : statistics summary
+                 for the summaries which have been computed so far. This can be passed as the
+                 ``stats`` keyword argument when creating a data item from a saved copy of this
+                 data so the summaries do not need to be recomputed
+        """
+        return dict(self._stats)
+
+    def fingerprint(self):
+        """
+        Get a fingerprint of the contents of the data
+
+        Data items with the same fingerprint have the same grid, number of volumes,
+        ROI flag, data type and voxel values. The name and metadata are not included.
+        The fingerprint is computed from the raw data when first required and kept
+        until the data changes (see ``invalidate()``)
+
+        :return: Hexadecimal string
+        """
+        if self._fingerprint is None or self._fingerprint[0] != self._generation:
+            hasher = getattr(hashlib, "blake2b", hashlib.sha1)()
+            rawdata = np.asarray(self.raw())
+            hasher.update(repr((bool(self.roi), self.nvols, list(self.grid.shape), self.grid.affine.tolist(),
+                                rawdata.dtype.str, rawdata.shape)).encode("utf-8"))
+            if rawdata.ndim > 0 and rawdata.size > 0:
+                rows = max(1, FINGERPRINT_CHUNK_SIZE // max(1, rawdata[0].nbytes))
+                for start in range(0, rawdata.shape[0], rows):
+                    hasher.update(np.ascontiguousarray(rawdata[start:start+rows]).tobytes())
+            else:
+                hasher.update(rawdata.tobytes())
+            self._fingerprint = (self._generation, hasher.hexdigest())
+        return self._fingerprint[1]
 
     def range(self, vol=None, percentile=100, roi=None):
         """
         Return data min and max
 
-        Note that obtaining the range of a large 4D data set may be expensive!
+        Unless an ROI is given this uses the cached statistics summary (see ``stats()``),
+        so the first call for the whole of a large 4D data set may be expensive but
+        subsequent calls are not. Percentiles are then approximate, to within the
+        width of a histogram bin.
 
         :param vol: Index of volume to use, if not specified use whole data set
         :param percentile: If specified, return maximim value as this percentile
@@ -698,23 +1290,21 @@ class QpData(object):
 
         :return: Tuple of min value, max value
         """
-        if vol is None and roi is None and percentile == 100:
-            # Absolute data range which we only compute once
-            if self._meta.get("range", None) is None:
-                # This ignores infinite values too unlike np.nanmin/np.nanmax
-                data = self.raw()
-                nonans = np.isfinite(data)
-                dmin, dmax = np.min(data[nonans]), np.max(data[nonans])
-                self._meta["range"] = dmin, dmax
-            return self._meta["range"]
+        if roi is None:
+            stats = self.stats(vol)
+            dmin, dmax = stats["min"], stats["max"]
+            if percentile < 100:
+                perc_max = _hist_percentile(stats, percentile)
+                if perc_max > dmin:
+                    dmax = perc_max
+            return dmin, dmax
         else:
             if vol is not None:
                 data = self.volume(vol)
             else:
                 data = self.raw()
 
-            if roi is not None:
-                data = data[roi.raw() > 0]
+            data = data[roi.raw() > 0]
 
             nonans = np.isfinite(data)
             dmin, dmax = np.min(data[nonans]), np.max(data[nonans])
@@ -733,11 +1323,21 @@ class QpData(object):
         This differs from range() only by a heuristic which
         tries to make 0 transparent when the data minimum is
         exactly zero (Issue #101)
+
+        Unless the statistics summary is already available the range of a single
+        volume is estimated from its overview (see ``overview()``) for large data.
         """
         if self.roi:
             return 0.1, max(self.regions.keys())
         else:
-            cmin, cmax = self.range(vol, percentile, roi)
+            stats_vol = None if self.nvols == 1 else vol
+            if stats_vol is not None:
+                stats_vol = min(stats_vol, self.nvols-1)
+            if (roi is None and (vol is not None or self.nvols == 1) and
+                    stats_vol not in self._stats and self._overview_level() > 0):
+                cmin, cmax = self.overview(vol or 0).range(percentile=percentile)
+            else:
+                cmin, cmax = self.range(vol, percentile, roi)
             if cmin == 0:
                 cmin = 1e-7*cmax
 
@@ -770,24 +1370,37 @@ class QpData(object):
             else:
                 ret.append(data)
             if output_mask:
-                ret.append(np.ones(data.shape[:3], dtype=np.int))
+                ret.append(np.ones(data.shape[:3], dtype=bool))
         else:
-            roi = roi.resample(self.grid)
-            if region is None:
-                mask = roi.raw() > 0
+            if not roi.grid.matches(self.grid):
+                roi = roi.resample(self.grid)
+            if roi.roi and not invert:
+                # Use the region index so only the voxels in the region are visited
+                coords = roi.roi_index().coords(region)
+                if output_flat:
+                    ret.append(data[coords])
+                else:
+                    masked = np.zeros(data.shape)
+                    masked[coords] = data[coords]
+                    ret.append(masked)
+                if output_mask:
+                    ret.append(roi.roi_index().mask(region))
             else:
-                mask = roi.raw() == region
-            if invert:
-                mask = np.logical_not(mask)
-
-            if output_flat:
-                ret.append(data[mask])
-            else:
-                masked = np.zeros(data.shape)
-                masked[mask] = data[mask]
-                ret.append(masked)
-            if output_mask:
-                ret.append(mask)
+                if region is None:
+                    mask = roi.raw() > 0
+                else:
+                    mask = roi.raw() == region
+                if invert:
+                    mask = np.logical_not(mask)
+
+                if output_flat:
+                    ret.append(data[mask])
+                else:
+                    masked = np.zeros(data.shape)
+                    masked[mask] = data[mask]
+                    ret.append(masked)
+                if output_mask:
+                    ret.append(mask)
 
         if len(ret) > 1:
             return tuple(ret)
@@ -798,9 +1411,24 @@ class QpData(object):
         """
         Resample the data onto a new grid
 
+        Where an affine transformation is required the result is cached (see
+        ``RESAMPLE_CACHE_SIZE``) so repeated resampling onto the same grid is cheap.
+        Otherwise the grids differ at most by flips and transpositions of the axes
+        and the returned object shares the raw data of this item. In either case
+        the raw data of the returned object is read-only - use ``writeable_raw()``
+        to get a private copy which can be modified.
+
         :param grid: :class:`DataGrid` to resample the data on to
         :return: New :class:`QpData` object
         """
+        name = self.name + suffix
+        cache_key = (self.grid.affine.tobytes(), tuple(self.grid.shape),
+                     grid.affine.tobytes(), tuple(grid.shape), order, self.roi)
+        cached = self._resample_cache.get(cache_key)
+        if cached is not None:
+            LOG.debug("Using cached resampled data for %s", self.name)
+            return cached._copy_view(name)
+
         data = self.raw()
 
         LOG.debug("Resampling from:")
@@ -809,7 +1437,7 @@ class QpData(object):
         LOG.debug(grid.affine)
 
         # Affine transformation matrix from current grid to new grid
-        tmatrix = np.dot(np.linalg.inv(grid.affine), self.grid.affine)
+        tmatrix = grid.grid_to_grid_matrix(self.grid)
         reorder, flip, tmatrix = self.grid.simplify_transforms(tmatrix)
 
         # Perform the flips and transpositions which simplify the transformation and
@@ -851,22 +1479,46 @@ class QpData(object):
 
             if self.roi:
                 # If source data was ROI, output should be, however resampling could have
-                # led to non-integer data
-                data = data.astype(np.int32)
-
-        return NumpyData(data=data, grid=grid, name=self.name + suffix, roi=self.roi, 
+                # led to non-integer data. Interpolation cannot create new labels outside
+                # the source range
+                vmin, vmax = np.min(self.raw()), np.max(self.raw())
+                data = np.clip(data, vmin, vmax).astype(label_dtype(int(vmin), int(vmax)))
+
+            resampled = NumpyData(data=data, grid=grid, name=name, roi=self.roi,
+                                  metadata=self._meta, view=self.view)
+            resampled.rawdata.flags.writeable = False
+            self._resample_cache.put(cache_key, resampled)
+            return resampled._copy_view(name)
+
+        return NumpyData(data=_readonly_view(data), grid=grid, name=name, roi=self.roi,
                          metadata=self._meta, view=self.view)
 
     def slice_data(self, plane, vol=0, interp_order=0):
         """
         Extract a data slice in raw data resolution
 
+        Recently extracted slices are cached (see ``SLICE_CACHE_SIZE``) so the returned
+        arrays may be shared and are read-only. This method may be called from a
+        background thread, e.g. to prefetch slices from neighbouring volumes.
+
         :param plane: OrthoSlice representing the slice to be extracted. Note that this
                       slice will not in general be defined on the same grid as the data
         :param vol: volume index for use if this is a 4D data set
         :param interp_order: Order of interpolation for non-orthogonal slices
+        :return: Tuple of slice data, slice mask, 2D transformation and 2D offset
         """
-        rawdata = self.volume(vol)
+        cache_key = (self.grid.affine.tobytes(), plane.affine.tobytes(), tuple(plane.shape),
+                     min(vol, self.nvols-1), interp_order)
+        cached = self._slice_cache.get(cache_key)
+        if cached is None:
+            cached = self._slice_data(plane, vol, interp_order)
+            for arr in cached:
+                arr.flags.writeable = False
+            self._slice_cache.put(cache_key, cached)
+        return cached
+
+    def _slice_data(self, plane, vol, interp_order):
+        rawdata = self._volume_for_slicing(vol)
 
         data_origin = np.array(self.grid.grid_to_grid([0, 0, 0], from_grid=plane))
         data_normal = np.array(self.grid.grid_to_grid([0, 0, 1], from_grid=plane, direction=True))
@@ -907,7 +1559,7 @@ class QpData(object):
             if pos >= 0 and pos < rawdata.shape[data_naxis]:
                 slices[data_naxis] = pos
                 LOG.debug("Using Numpy slice: %s %s", slices, rawdata.shape)
-                sdata = rawdata[slices]
+                sdata = np.asarray(rawdata[tuple(slices)])
                 smask = np.ones(slice_shape)
             else:
                 # Requested slice is outside the data range
@@ -916,6 +1568,7 @@ class QpData(object):
                 smask = np.zeros(slice_shape)
         else:
             LOG.debug("Full affine slice")
+            rawdata = np.asarray(rawdata)
 
             #LOG.debug("OrthoSlice: plane origin: %s" % str(plane.origin))
             #LOG.debug("OrthoSlice: plane v1: %s" % str(plane.basis[0]))
@@ -956,6 +1609,16 @@ class QpData(object):
 
         return remove_nans(sdata), smask, trans_v, offset
 
+    def _volume_for_slicing(self, vol):
+        """
+        Get a volume in a form suitable for extracting slices
+
+        The return value must provide ``shape`` and support Numpy-style indexing. The
+        default implementation returns the Numpy array from ``volume()`` but subclasses
+        may return a proxy which only reads the data required for an orthogonal slice.
+        """
+        return self.volume(vol)
+
     def _get_slice(self, length, sign):
         if sign == 1:
             return slice(0, length, 1)
@@ -996,6 +1659,10 @@ class QpData(object):
 class NumpyData(QpData):
     """
     QpData instance with in-memory Numpy data
+
+    The array is not copied unless it needs to be converted to the storage type
+    (float32 for floating point data, the smallest suitable integer type for ROIs),
+    so it should not be modified by the caller afterwards.
     """
     def __init__(self, data, grid, name, **kwargs):
         # Unlikely but possible that first data is added from the console. In this
@@ -1003,20 +1670,67 @@ class NumpyData(QpData):
         if grid is None:
             grid = DataGrid(data.shape[:3], np.identity(4))
 
+        if kwargs.get("roi", False):
+            # Store ROIs using the smallest integer type that can hold the labels
+            data = as_label_array(data)
         if data.dtype.kind in np.typecodes["AllFloat"]:
             # Use float32 rather than default float64 to reduce storage
-            data = data.astype(np.float32)
-        self.rawdata = data
+            data = data.astype(np.float32, copy=False)
+        self._rawdata = data
 
         if data.ndim > 3:
             nvols = data.shape[3]
             if nvols == 1:
-                self.rawdata = np.squeeze(self.rawdata, axis=-1)
+                self._rawdata = np.squeeze(self._rawdata, axis=-1)
         else:
             nvols = 1
 
         QpData.__init__(self, name, grid, nvols, **kwargs)
 
+    @property
+    def rawdata(self):
+        """ Numpy array containing the data """
+        return self._rawdata
+
+    @rawdata.setter
+    def rawdata(self, data):
+        self._rawdata = data
+        self.invalidate()
+
+    def _copy_view(self, name):
+        """
+        Return a new NumpyData which shares the raw data array of this item
+
+        Metadata and view parameters are copied so the new item can be renamed or
+        added to the IVM without affecting this one
+        """
+        qpd = copy.copy(self)
+        qpd.name = name
+        qpd._meta = Metadata(self._meta)
+        qpd.view = Metadata(self.view)
+        qpd._resample_cache = _new_resample_cache()
+        qpd._slice_cache = _new_slice_cache()
+        qpd._stats = dict(self._stats)
+        qpd._pyramid = {}
+        return qpd
+
+    def writeable_raw(self):
+        if not self._rawdata.flags.writeable:
+            # Shared with another data item so take a private copy
+            LOG.debug("Copying read-only data for %s", self.name)
+            self._rawdata = np.array(self._rawdata)
+        return self.raw()
+
+    def memory_usage(self):
+        usage = QpData.memory_usage(self)
+        if isinstance(self._rawdata, np.memmap):
+            # Memory-mapped data is managed by the operating system
+            pass
+        elif self._rawdata.base is None or self._rawdata.flags.writeable:
+            # Read-only views are counted by the data item they were taken from
+            usage += self._rawdata.nbytes
+        return usage
+
     def raw(self):
         if self._meta.get("raw_2dt", False) and self.rawdata.ndim == 3:
             # Single-slice, interpret 3rd dimension as time
@@ -0,0 +1,147 @@
+"""
+Quantiphyse - Index of the voxels in each region of an ROI
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import division
+
+import numpy as np
+
+from quantiphyse.utils import QpException
+
+class RoiIndex(object):
+    """
+    Index of the voxels in each region (label) of a 3D ROI array
+
+    The index is built in a single pass over the data by sorting the flattened voxel
+    indices by label. Extracting the voxels of a region then takes time proportional
+    to the size of the region rather than the size of the volume.
+
+    Flat indices refer to the ROI array flattened in C order, i.e. they can be
+    converted to voxel co-ordinates using ``np.unravel_index(indices, shape)``
+
+    :ivar shape: 3D shape of the ROI array
+    :ivar labels: Sorted Numpy array of the distinct non-zero labels
+    :ivar generation: Generation of the data item which the index was built from, used to
+                      detect when it needs to be rebuilt
+    """
+
+    def __init__(self, data, generation=0):
+        """
+        :param data: 3D Numpy array of integer labels
+        :param generation: Generation of the source data
+        :raises QpException: if the data contains values which are not integers
+        """
+        self._build(data.shape[:3], None, np.ravel(data), generation)
+
+    @classmethod
+    def from_sparse(cls, shape, indices, values, generation=0):
+        """
+        Build the index from the non-zero voxels of an ROI without creating the full array
+
+        :param shape: 3D shape of the ROI array
+        :param indices: Numpy array of flat voxel indices in ascending order
+        :param values: Numpy array of labels at each of the voxels in ``indices``
+        :param generation: Generation of the source data
+        """
+        index = cls.__new__(cls)
+        index._build(shape, indices, values, generation)
+        return index
+
+    def _build(self, shape, indices, values, generation):
+        from .qpdata import as_label_array
+        values = as_label_array(np.asarray(values))
+        if values.dtype.kind not in "biu":
+            # Labels are used as integer keys so non-integer values would be merged
+            raise QpException("ROI labels must be integers")
+
+        self.shape = tuple(shape[:3])
+        self.generation = generation
+
+        # Stable sort so indices within each region are in ascending order. For the
+        # small integer types used for ROIs numpy uses a linear time radix sort
+        order = np.argsort(values, kind="mergesort")
+        ordered = values[order]
+        if indices is not None:
+            order = np.asarray(indices, dtype=np.intp)[order]
+        starts = np.concatenate([[0], np.flatnonzero(ordered[1:] != ordered[:-1]) + 1]) if values.size else []
+        labels = ordered[starts]
+        counts = np.diff(np.append(starts, values.size))
+
+        self._indices = {}
+        self._counts = {}
+        for label, start, count in zip(labels, starts, counts):
+            if label == 0:
+                continue
+            label = int(label)
+            self._indices[label] = order[start:start+count]
+            self._counts[label] = int(count)
+        self.labels = np.array(sorted(self._indices.keys()), dtype=np.int64)
+        self._bboxes = {}
+
+    def count(self, region=None):
+        """
+        :param region: Region label. If not specified, count voxels in all regions with positive labels
+        :return: Number of voxels in the region, zero if the label is not present
+        """
+        if region is None:
+            return sum([count for label, count in self._counts.items() if label > 0])
+        return self._counts.get(int(region), 0)
+
+    def indices(self, region=None):
+        """
+        :param region: Region label. If not specified, return voxels in all regions with positive
+                       labels, i.e. the voxels where the ROI is > 0
+        :return: Numpy array of flat voxel indices in ascending order
+        """
+        if region is None:
+            positive = [self._indices[label] for label in self.labels if label > 0]
+            if not positive:
+                return np.zeros((0,), dtype=np.intp)
+            elif len(positive) == 1:
+                return positive[0]
+            return np.sort(np.concatenate(positive))
+        return self._indices.get(int(region), np.zeros((0,), dtype=np.intp))
+
+    def coords(self, region=None):
+        """
+        :param region: Region label. If not specified, use all regions with positive labels
+        :return: Tuple of three Numpy arrays of voxel co-ordinates, suitable for indexing
+                 a 3D or 4D data array on the same grid
+        """
+        return np.unravel_index(self.indices(region), self.shape)
+
+    def bbox(self, region):
+        """
+        :param region: Region label
+        :return: Tuple of 3 slices giving the bounding box of the region, or None if the
+                 label is not present
+        """
+        region = int(region)
+        if region not in self._bboxes:
+            if region not in self._indices:
+                return None
+            coords = np.unravel_index(self._indices[region], self.shape)
+            self._bboxes[region] = tuple([slice(int(np.min(c)), int(np.max(c))+1) for c in coords])
+        return self._bboxes[region]
+
+    def mask(self, region=None):
+        """
+        :param region: Region label. If not specified, use all regions with positive labels
+        :return: Boolean Numpy array with the shape of the ROI which is True within the region
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.indices(region)] = True
+        return mask
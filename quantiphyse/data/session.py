@@ -0,0 +1,337 @@
+"""
+Quantiphyse - Saving and restoring all the data in the IVM as a single session file
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A session file contains:
+
+ - An 8 byte identifier (``SESSION_MAGIC``)
+ - The position and length in bytes of the index, as little-endian 64 bit integers
+ - The arrays, uncompressed in C order, each starting at a multiple of ``SESSION_ALIGNMENT``
+   bytes from the start of the file
+ - The index, describing each data item (grid, metadata, view parameters, statistics
+   summaries and the position of its arrays) and containing the extras
+
+Because the arrays are stored uncompressed and aligned they can be memory-mapped
+when the session is restored, so restoring does not read the data until it is used.
+
+The index is stored as YAML, restricted to the basic types used for metadata (strings,
+numbers, lists and dictionaries), so restoring a session never runs code from the file.
+Tuples are restored as lists. Only extras of the types defined in :mod:`quantiphyse.data.extras`
+can be saved.
+"""
+from __future__ import division
+
+import os
+import struct
+import logging
+import tempfile
+
+import six
+import yaml
+import numpy as np
+
+from quantiphyse.utils import QpException
+
+from .qpdata import DataGrid, NumpyData
+from .sparse import SparseRoiData
+from .extras import NumberListExtra, MatrixExtra, DataFrameExtra
+
+LOG = logging.getLogger(__name__)
+
+#: Identifier at the start of a session file
+SESSION_MAGIC = b"QPSESSN\x00"
+
+#: Version of the session file format
+SESSION_VERSION = 2
+
+#: Arrays in a session file start at a multiple of this number of bytes, so they
+#: are aligned to memory pages when mapped
+SESSION_ALIGNMENT = 4096
+
+#: Maximum number of bytes written at once when saving an array
+SESSION_WRITE_CHUNK_SIZE = 16*1024*1024
+
+def is_session(fname):
+    """
+    :return: True if ``fname`` is a session file
+    """
+    try:
+        with open(fname, "rb") as sfile:
+            return sfile.read(len(SESSION_MAGIC)) == SESSION_MAGIC
+    except (IOError, OSError):
+        return False
+
+def _pad(sfile):
+    """
+    Write zeros up to the next aligned position in the file
+
+    :return: Aligned position
+    """
+    pos = sfile.tell()
+    padding = (SESSION_ALIGNMENT - pos % SESSION_ALIGNMENT) % SESSION_ALIGNMENT
+    sfile.write(b"\x00" * padding)
+    return pos + padding
+
+def _write_array(sfile, arr):
+    """
+    Write an array at the next aligned position in the file, without copying it all at once
+
+    :return: Description of the array for the index
+    """
+    offset = _pad(sfile)
+    arr = np.asanyarray(arr)
+    if arr.ndim == 0 or arr.size == 0:
+        sfile.write(np.ascontiguousarray(arr).tobytes())
+    else:
+        rows = max(1, SESSION_WRITE_CHUNK_SIZE // max(1, arr[0].nbytes))
+        for start in range(0, arr.shape[0], rows):
+            sfile.write(np.ascontiguousarray(arr[start:start+rows]).tobytes())
+    return {"offset" : offset, "dtype" : arr.dtype.str, "shape" : list(arr.shape)}
+
+def _read_array(fname, desc, mmap):
+    """
+    :return: Array from a session file, memory-mapped if requested
+    """
+    dtype = np.dtype(str(desc["dtype"]))
+    shape = tuple(desc["shape"])
+    if mmap and int(np.prod(shape)) > 0:
+        # Copy-on-write so tools which modify data in place do not change the file
+        return np.memmap(fname, dtype=dtype, mode="c", offset=desc["offset"], shape=shape)
+    with open(fname, "rb") as sfile:
+        sfile.seek(desc["offset"])
+        count = int(np.prod(shape))
+        return np.fromfile(sfile, dtype=dtype, count=count).reshape(shape)
+
+def _plain(value):
+    """
+    :return: Copy of a value with Numpy arrays and scalars, and dictionary subclasses such
+             as ``Metadata``, converted to the basic types which are stored in the index
+    """
+    if isinstance(value, dict):
+        return dict([(_plain(key), _plain(item)) for key, item in value.items()])
+    elif isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    elif isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif value is None or isinstance(value, (bool, int, float) + six.string_types):
+        return value
+    raise QpException("Cannot save value of type %s in a session" % type(value).__name__)
+
+def _extra_to_index(name, extra):
+    """
+    :return: Description of an extra for the index
+    :raises QpException: if the type of extra cannot be saved
+    """
+    item = {"name" : name, "extra_name" : extra.name, "metadata" : extra.metadata}
+    if isinstance(extra, NumberListExtra):
+        item["type"] = "numbers"
+        item["values"] = list(extra.values)
+    elif isinstance(extra, MatrixExtra):
+        item["type"] = "matrix"
+        item["arr"] = [list(row) for row in extra.arr]
+        item["row_headers"] = extra.row_headers
+        item["col_headers"] = extra.col_headers
+    elif isinstance(extra, DataFrameExtra):
+        item["type"] = "dataframe"
+        item["df"] = extra.df.to_json(orient="split")
+    else:
+        raise QpException("Extra %s of type %s cannot be saved in a session" % (name, type(extra).__name__))
+    return _plain(item)
+
+def _extra_from_index(item):
+    """
+    :return: Tuple of name, Extra from its description in the index
+    """
+    if item["type"] == "numbers":
+        extra = NumberListExtra(item["extra_name"], item["values"])
+    elif item["type"] == "matrix":
+        extra = MatrixExtra(item["extra_name"], item["arr"], item["row_headers"], item["col_headers"])
+    elif item["type"] == "dataframe":
+        import pandas as pd
+        extra = DataFrameExtra(item["extra_name"], pd.read_json(six.StringIO(item["df"]), orient="split"))
+    else:
+        raise QpException("Unknown type of extra in session: %s" % item["type"])
+    extra.metadata = item["metadata"]
+    return item["name"], extra
+
+def save_items(fname, data, extras=(), info=None):
+    """
+    Save data items and extras to a file in session format
+
+    The file is written to a temporary file first and then renamed, so it is safe
+    to overwrite a file which data has been restored from.
+
+    :param fname: File name
+    :param data: Sequence of QpData instances. They are saved in full, including
+                 unsaved changes such as ROI edits, along with their metadata
+                 and view parameters. Items which can re-read their data from a file
+                 or recompute it are released again after saving if saving loaded it
+    :param extras: Sequence of (name, Extra) tuples
+    :param info: Optional dictionary of additional information to store in the index.
+                 Values must be strings, numbers, lists or dictionaries
+    """
+    index = dict(info or {})
+    index["version"] = SESSION_VERSION
+    index["data"] = []
+
+    dirname = os.path.dirname(os.path.abspath(fname))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".qpsession")
+    try:
+        with os.fdopen(fd, "wb") as sfile:
+            # The index is written after the arrays and the header then updated to point to it
+            sfile.write(SESSION_MAGIC)
+            sfile.write(struct.pack("<QQ", 0, 0))
+            for qpd in data:
+                LOG.debug("Saving %s to session", qpd.name)
+                item = {
+                    "name" : qpd.name,
+                    "grid" : {
+                        "shape" : list(qpd.grid.shape),
+                        "affine" : np.array(qpd.grid.affine),
+                        "units" : qpd.grid.units,
+                    },
+                    "roi" : qpd.roi,
+                    "metadata" : qpd.metadata,
+                    "view" : qpd.view,
+                    "stats" : qpd.cached_stats(),
+                }
+                if isinstance(qpd, SparseRoiData):
+                    indices, values = qpd.sparse()
+                    item["type"] = "sparse"
+                    item["indices"] = _write_array(sfile, indices)
+                    item["values"] = _write_array(sfile, values)
+                else:
+                    usage = qpd.memory_usage()
+                    item["type"] = "array"
+                    item["data"] = _write_array(sfile, qpd.raw())
+                    if qpd.reloadable and qpd.memory_usage() > usage:
+                        # Do not keep data which was only loaded to save it
+                        qpd.uncache()
+                index["data"].append(_plain(item))
+            index["extras"] = [_extra_to_index(name, extra) for name, extra in extras]
+
+            index_offset = sfile.tell()
+            sfile.write(yaml.safe_dump(_plain(index)).encode("utf-8"))
+            index_length = sfile.tell() - index_offset
+            sfile.seek(len(SESSION_MAGIC))
+            sfile.write(struct.pack("<QQ", index_offset, index_length))
+        # Data memory-mapped from a file being replaced remains valid
+        getattr(os, "replace", os.rename)(tmpname, fname)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def load_items(fname, mmap=True):
+    """
+    Load data items and extras from a file in session format
+
+    :param fname: File name
+    :param mmap: If True, memory-map the data arrays rather than reading them into memory.
+                 The arrays are mapped copy-on-write so modifying the data does not
+                 change the file
+    :return: Tuple of list of QpData instances, list of (name, Extra) tuples and
+             the index dictionary, which contains any additional information saved
+    """
+    with open(fname, "rb") as sfile:
+        if sfile.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+            raise QpException("%s is not a session file" % fname)
+        index_offset, index_length = struct.unpack("<QQ", sfile.read(16))
+        sfile.seek(index_offset)
+        index = None
+        try:
+            index = yaml.safe_load(sfile.read(index_length).decode("utf-8"))
+        except (UnicodeDecodeError, yaml.YAMLError):
+            pass
+        if not isinstance(index, dict) or index.get("version", 0) < SESSION_VERSION:
+            # Version 1 index was pickled, which is not safe to restore
+            raise QpException("%s was saved by an older version and cannot be restored" % fname)
+        if index["version"] > SESSION_VERSION:
+            raise QpException("%s was saved by a newer version and cannot be restored" % fname)
+
+    data = []
+    for item in index["data"]:
+        grid = DataGrid(item["grid"]["shape"], np.array(item["grid"]["affine"]), units=item["grid"]["units"])
+        metadata = item["metadata"]
+        kwargs = {
+            "metadata" : metadata,
+            "stats" : item["stats"],
+            "fname" : metadata.get("fname", None),
+            "vol_scale" : metadata.get("vol_scale", 1.0),
+            "vol_units" : metadata.get("vol_units", None),
+        }
+        if item["type"] == "sparse":
+            qpd = SparseRoiData(_read_array(fname, item["indices"], mmap), _read_array(fname, item["values"], mmap),
+                                grid, item["name"], **kwargs)
+        else:
+            qpd = NumpyData(_read_array(fname, item["data"], mmap), grid, item["name"], roi=item["roi"], **kwargs)
+        qpd.view.update(item["view"])
+        data.append(qpd)
+    return data, [_extra_from_index(item) for item in index["extras"]], index
+
+def save_session(ivm, fname):
+    """
+    Save all the data and extras in the IVM to a session file
+
+    Data items are saved in full, including unsaved changes such as ROI edits, along
+    with their metadata and view parameters. The file is written to a temporary file
+    first and then renamed, so it is safe to overwrite the file the current session
+    was restored from. Extras of types which cannot be saved are skipped with a warning.
+
+    :param ivm: ImageVolumeManagement instance
+    :param fname: File name
+    """
+    info = {
+        "main" : ivm.main.name if ivm.main is not None else None,
+        "current_data" : ivm.current_data.name if ivm.current_data is not None else None,
+        "current_roi" : ivm.current_roi.name if ivm.current_roi is not None else None,
+    }
+    extras = []
+    for name, extra in ivm.extras.items():
+        if isinstance(extra, (NumberListExtra, MatrixExtra, DataFrameExtra)):
+            extras.append((name, extra))
+        else:
+            LOG.warn("Extra %s of type %s cannot be saved in a session", name, type(extra).__name__)
+    save_items(fname, list(ivm.data.values()), extras, info)
+
+def load_session(ivm, fname, mmap=True):
+    """
+    Restore a session file, replacing all the data and extras in the IVM
+
+    :param ivm: ImageVolumeManagement instance
+    :param fname: File name
+    :param mmap: If True, memory-map the data arrays rather than reading them into memory.
+                 The arrays are mapped copy-on-write so modifying the data does not
+                 change the file
+    """
+    data, extras, index = load_items(fname, mmap)
+
+    ivm.reset()
+    for qpd in data:
+        view = dict(qpd.view)
+        ivm.add(qpd, make_main=qpd.name == index["main"], make_current=False)
+        # Restore view parameters which adding data may change, e.g. visibility of main data
+        qpd.view.update(view)
+    if index["current_data"] in ivm.data:
+        ivm.set_current_data(index["current_data"])
+    if index["current_roi"] in ivm.data:
+        ivm.set_current_roi(index["current_roi"])
+    for name, extra in extras:
+        ivm.add_extra(name, extra)
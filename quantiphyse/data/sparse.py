@@ -0,0 +1,331 @@
+"""
+Quantiphyse - Subclass of QpData for ROIs stored as lists of non-zero voxels
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import division
+
+import math
+import logging
+
+import numpy as np
+
+from quantiphyse.utils import sf, QpException
+
+from .qpdata import QpData, WORLD_GRID, DEFAULT_ROI_VIEW, STATS_BINS, as_label_array
+from .roi_index import RoiIndex
+
+LOG = logging.getLogger(__name__)
+
+#: Maximum number of target grid voxels visited at once when resampling
+RESAMPLE_CHUNK_SIZE = 1024*1024
+
+def _index_dtype(nvoxels):
+    """
+    :return: Smallest integer type which can hold flat voxel indices for a grid
+    """
+    if nvoxels < 2**32:
+        return np.dtype(np.uint32)
+    return np.dtype(np.int64)
+
+class _SparseSliceProxy(object):
+    """
+    Numpy-style access to a sparse ROI for extracting orthogonal slices
+
+    Only the voxels which lie on the requested plane are written into the slice
+    """
+    def __init__(self, qpd):
+        self._qpd = qpd
+        self.shape = tuple(qpd.grid.shape)
+
+    def __getitem__(self, slices):
+        axes = [dim for dim, slc in enumerate(slices) if isinstance(slc, slice)]
+        naxis = [dim for dim, slc in enumerate(slices) if not isinstance(slc, slice)][0]
+
+        indices, values = self._qpd.sparse()
+        coords = np.unravel_index(indices, self.shape)
+        on_plane = coords[naxis] == slices[naxis]
+        plane = np.zeros([self.shape[axis] for axis in axes], dtype=values.dtype)
+        plane[coords[axes[0]][on_plane], coords[axes[1]][on_plane]] = values[on_plane]
+        return plane[slices[axes[0]], slices[axes[1]]]
+
+    def __array__(self, dtype=None):
+        data = self._qpd.raw()
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+class SparseRoiData(QpData):
+    """
+    ROI stored as a list of its non-zero voxels
+
+    The flat indices (in C order) of the non-zero voxels are stored in ascending
+    order along with the label at each one. For ROIs which cover a small part of a
+    large grid this uses much less memory than a full array.
+
+    The full array is only created if ``raw()`` is called. Region indexing, masking,
+    nearest neighbour resampling, orthogonal slicing, statistics and single voxel
+    values are computed directly from the voxel list.
+
+    The full array returned by ``raw()`` may be modified in place, provided that
+    ``invalidate()`` is called afterwards. The voxel list is then rebuilt from the
+    modified array. Once the full array has been returned by ``writeable_raw()`` it
+    is never discarded, because the caller may continue to modify it.
+    """
+
+    def __init__(self, indices, values, grid, name, **kwargs):
+        """
+        :param indices: Sequence of flat voxel indices of the non-zero voxels
+        :param values: Sequence of integer labels at each voxel in ``indices``
+        :param grid: :class:`DataGrid` the ROI is defined on
+        :param name: Name of the data item
+        """
+        self._dense = None
+        self._set_sparse(indices, values, grid.nvoxels)
+        kwargs["roi"] = True
+        QpData.__init__(self, name, grid, 1, **kwargs)
+
+    @classmethod
+    def from_array(cls, data, grid, name, **kwargs):
+        """
+        Create a sparse ROI from a full array of labels
+
+        :param data: 3D Numpy array containing integer labels
+        :param grid: :class:`DataGrid` the ROI is defined on
+        :param name: Name of the data item
+        """
+        if data.ndim > 3 and (data.ndim > 4 or data.shape[3] != 1):
+            raise QpException("This data set cannot be an ROI - it is 4D")
+        flat = np.ravel(data)
+        indices = np.flatnonzero(flat)
+        return cls(indices, flat[indices], grid, name, **kwargs)
+
+    @property
+    def roi(self):
+        """ Always True - sparse data is only used for ROIs """
+        return True
+
+    @roi.setter
+    def roi(self, is_roi):
+        if not is_roi:
+            raise QpException("Sparse ROI data must be an ROI")
+        if not self._meta.get("roi", False):
+            self._meta["roi"] = True
+            self.view.update(DEFAULT_ROI_VIEW)
+            self.view.cmap_range = self.suggest_cmap_range()
+
+    @property
+    def rawdata(self):
+        """ Full Numpy array containing the data. Setting this replaces the ROI data """
+        return self.raw()
+
+    @rawdata.setter
+    def rawdata(self, data):
+        self._dense = np.asarray(data).reshape(self.grid.shape)
+        self.invalidate()
+
+    def sparse(self):
+        """
+        :return: Tuple of Numpy array of flat voxel indices of the non-zero voxels in
+                 ascending order and Numpy array of the label at each one. These
+                 are shared with this object and must not be modified
+        """
+        return self._indices, self._values
+
+    def raw(self):
+        with self._load_lock:
+            if self._dense is None:
+                dense = np.zeros(self.grid.shape, dtype=self._values.dtype)
+                dense.flat[self._indices] = self._values
+                self._dense = dense
+            return self._dense
+
+    def invalidate(self):
+        if self._dense is not None:
+            # Full array may have been modified in place
+            flat = np.ravel(self._dense)
+            indices = np.flatnonzero(flat)
+            self._set_sparse(indices, flat[indices], self.grid.nvoxels)
+        QpData.invalidate(self)
+        if self._source_generation is not None:
+            # Voxel list is up to date so the full array can still be recreated from it
+            self._source_generation = self._generation
+
+    def uncache(self):
+        """
+        Discard the full array if it has been created. It will be recreated from
+        the voxel list when next required
+        """
+        with self._load_lock:
+            QpData.uncache(self)
+            if self.reloadable:
+                self._dense = None
+
+    @property
+    def reloadable(self):
+        return self._dense is None or self._unmodified()
+
+    def memory_usage(self):
+        usage = QpData.memory_usage(self) + self._indices.nbytes + self._values.nbytes
+        if self._dense is not None:
+            usage += self._dense.nbytes
+        return usage
+
+    def preload(self):
+        # Nothing to read and the full array is not required for display
+        pass
+
+    def set_2dt(self):
+        raise QpException("Sparse ROI data cannot be interpreted as a 2D timeseries")
+
+    def roi_index(self):
+        if self._roi_index is None or self._roi_index.generation != self._generation:
+            self._roi_index = RoiIndex.from_sparse(self.grid.shape, self._indices, self._values, self._generation)
+        return self._roi_index
+
+    def value(self, pos, grid=None, as_str=False):
+        if grid is None:
+            grid = WORLD_GRID
+
+        data_pos = [int(math.floor(v+0.5)) for v in self.grid.grid_to_grid(pos[:3], from_grid=grid)]
+        if min(data_pos) < 0 or any([p >= s for p, s in zip(data_pos, self.grid.shape)]):
+            value = 0
+        else:
+            value = self._lookup(np.ravel_multi_index(data_pos, self.grid.shape))[()]
+
+        if as_str:
+            return sf(value)
+        else:
+            return value
+
+    def _timeseries_at(self, data_pos):
+        return self._lookup(np.ravel_multi_index(data_pos.T, self.grid.shape))[:, np.newaxis]
+
+    def stats(self, vol=None):
+        if None not in self._stats:
+            nzeros = self.grid.nvoxels - self._values.size
+            values = self._values
+            if nzeros > 0:
+                # Include a single zero in the range calculation and histogram it separately
+                values = np.append(values, np.zeros(1, dtype=values.dtype))
+            dmin, dmax = np.min(values), np.max(values)
+            hist, _ = np.histogram(self._values, bins=STATS_BINS, range=(dmin, dmax))
+            if nzeros > 0:
+                zero_hist, _ = np.histogram([0], bins=STATS_BINS, range=(dmin, dmax))
+                hist += zero_hist * nzeros
+            self._stats[None] = {
+                "min" : dmin.item(),
+                "max" : dmax.item(),
+                "count" : int(self.grid.nvoxels),
+                "hist" : hist,
+            }
+        return self._stats[None]
+
+    def resample(self, grid, order=0, suffix="_resampled"):
+        """
+        Resample the ROI onto a new grid
+
+        Nearest neighbour resampling only visits the voxels of the new grid which lie
+        within the bounding box of the ROI and returns a new sparse ROI. Other
+        interpolation orders use the full array.
+
+        :param grid: :class:`DataGrid` to resample the data on to
+        :return: New :class:`QpData` object
+        """
+        if order != 0:
+            return QpData.resample(self, grid, order, suffix)
+
+        name = self.name + suffix
+        if grid.matches(self.grid):
+            return SparseRoiData(self._indices, self._values, grid, name, metadata=self._meta, view=self.view)
+
+        indices, values = [], []
+        if self._indices.size > 0:
+            # Bounding box of the ROI voxels in the target grid
+            coords = np.array(np.unravel_index(self._indices, self.grid.shape))
+            src_lo, src_hi = coords.min(axis=1) - 0.5, coords.max(axis=1) + 0.5
+            corners = np.array([[x, y, z, 1] for x in (src_lo[0], src_hi[0])
+                                for y in (src_lo[1], src_hi[1])
+                                for z in (src_lo[2], src_hi[2])]).T
+            to_target = grid.grid_to_grid_matrix(self.grid)
+            target_corners = np.dot(to_target, corners)[:3]
+            lo = np.maximum(np.floor(target_corners.min(axis=1)).astype(int), 0)
+            hi = np.minimum(np.ceil(target_corners.max(axis=1)).astype(int), np.array(grid.shape) - 1)
+
+            # Map target voxels back to the nearest source voxel, a slab at a time
+            from_target = np.linalg.inv(to_target)
+            src_shape = np.array(self.grid.shape)[:, np.newaxis]
+            slab_size = max(1, RESAMPLE_CHUNK_SIZE // max(1, (hi[1] - lo[1] + 1) * (hi[2] - lo[2] + 1)))
+            for start in range(lo[0], hi[0] + 1, slab_size):
+                stop = min(start + slab_size, hi[0] + 1)
+                if stop <= start or np.any(hi[1:] < lo[1:]):
+                    break
+                target_coords = np.indices((stop - start, hi[1] - lo[1] + 1, hi[2] - lo[2] + 1)).reshape(3, -1)
+                target_coords += np.array([start, lo[1], lo[2]])[:, np.newaxis]
+                src_coords = np.floor(np.dot(from_target[:3, :3], target_coords) + from_target[:3, 3:] + 0.5).astype(np.intp)
+                inside = np.all(np.logical_and(src_coords >= 0, src_coords < src_shape), axis=0)
+                slab_values = self._lookup(np.ravel_multi_index(src_coords[:, inside], self.grid.shape))
+                nonzero = slab_values != 0
+                indices.append(np.ravel_multi_index(target_coords[:, inside][:, nonzero], grid.shape))
+                values.append(slab_values[nonzero])
+
+        if indices:
+            indices, values = np.concatenate(indices), np.concatenate(values)
+        else:
+            indices, values = np.zeros((0,), dtype=np.intp), np.zeros((0,), dtype=self._values.dtype)
+        return SparseRoiData(indices, values, grid, name, metadata=self._meta, view=self.view)
+
+    def get_bounding_box(self, ndim=3):
+        if self._indices.size == 0:
+            # Consistent with the full array implementation
+            raise IndexError("ROI is empty")
+
+        slices = [slice(None)] * ndim
+        coords = np.unravel_index(self._indices, self.grid.shape)
+        for dim in range(min(ndim, 3)):
+            slices[dim] = slice(int(np.min(coords[dim])), int(np.max(coords[dim]))+1)
+        return slices
+
+    def _volume_for_slicing(self, vol):
+        if self._dense is not None:
+            return self._dense
+        return _SparseSliceProxy(self)
+
+    def _lookup(self, flat_indices):
+        """
+        :param flat_indices: Numpy array of flat voxel indices
+        :return: Numpy array of the labels at each voxel, zero for voxels not in the ROI
+        """
+        flat_indices = np.asarray(flat_indices)
+        ret = np.zeros(flat_indices.shape, dtype=self._values.dtype)
+        if self._indices.size > 0:
+            pos = np.minimum(np.searchsorted(self._indices, flat_indices), self._indices.size-1)
+            found = self._indices[pos] == flat_indices
+            ret[found] = self._values[pos[found]]
+        return ret
+
+    def _set_sparse(self, indices, values, nvoxels):
+        indices = np.asarray(indices).ravel()
+        values = np.asarray(values).ravel()
+        if values.size > 0 and not np.all(np.equal(np.mod(values, 1), 0)):
+            raise QpException("This data set cannot be an ROI - it does not contain integers")
+        nonzero = values != 0
+        indices, values = indices[nonzero], values[nonzero]
+        if indices.size > 1 and not np.all(indices[1:] > indices[:-1]):
+            order = np.argsort(indices, kind="mergesort")
+            indices, values = indices[order], values[order]
+
+        self._indices = indices.astype(_index_dtype(nvoxels))
+        self._values = as_label_array(values)
@@ -36,9 +36,18 @@ from quantiphyse.utils.enums import Visibility
 from .qpdata import QpData
 from .load_save import NumpyData
 from .extras import Extra
+from .memory import MemoryManager
+from .sparse import SparseRoiData
 
 LOG = logging.getLogger(__name__)
 
+#: ROIs added as in-memory arrays with ``sparse=True`` are stored as a list of their non-zero
+#: voxels if these are less than this fraction of the grid. Set to 0 to always store the full array
+SPARSE_ROI_FRACTION = 0.01
+
+#: Minimum number of grid voxels for an ROI to be stored as a list of non-zero voxels
+SPARSE_ROI_MIN_VOXELS = 1024*1024
+
 class ImageVolumeManagement(QtCore.QObject):
     """
     Holds all image datas used in analysis
@@ -54,6 +63,7 @@ class ImageVolumeManagement(QtCore.QObject):
       ``current_roi`` QpData with ``roi=True`` used as the current ROI
       ``extras`` Mapping from name to object for miscellaneous extra data.
                  Extras must support string-conversion for writing to files.
+      ``memory`` MemoryManager which keeps the memory used by data items within a budget
     """
     # Signals
 
@@ -74,6 +84,7 @@ class ImageVolumeManagement(QtCore.QObject):
 
     def __init__(self):
         super(ImageVolumeManagement, self).__init__()
+        self.memory = MemoryManager(self)
         self.reset()
 
     def reset(self):
@@ -83,11 +94,13 @@ class ImageVolumeManagement(QtCore.QObject):
         self.current_data = None
         self.current_roi = None
         self.extras = OrderedDict()
+        self.memory.reset()
 
         self.sig_main_data.emit(None)
         self.sig_current_data.emit(None)
         self.sig_current_roi.emit(None)
         self.sig_all_data.emit([])
+        self.memory.enforce()
 
     @property
     def rois(self):
@@ -124,6 +137,15 @@ class ImageVolumeManagement(QtCore.QObject):
         if name is None or not re.match(r'[a-z_]\w*$', name, re.I) or keyword.iskeyword(name):
             raise QpException("'%s' is not a valid name" % name)
 
+    def _use_sparse(self, data):
+        """
+        :return: True if an in-memory ROI covers a small enough part of a large grid
+                 that it should be stored as a list of its non-zero voxels
+        """
+        if not data.roi or SPARSE_ROI_FRACTION <= 0 or data.grid.nvoxels < SPARSE_ROI_MIN_VOXELS:
+            return False
+        return np.count_nonzero(data.rawdata) < SPARSE_ROI_FRACTION * data.grid.nvoxels
+
     def set_main_data(self, name):
         """
         Set the named data item as the main data
@@ -132,9 +154,10 @@ class ImageVolumeManagement(QtCore.QObject):
         """
         self._data_exists(name)
         self.main = self.data[name]
+        self.memory.touch(name)
         self.sig_main_data.emit(self.main)
 
-    def add(self, data, name=None, grid=None, make_current=None, make_main=None, roi=None):
+    def add(self, data, name=None, grid=None, make_current=None, make_main=None, roi=None, sparse=False):
         """
         Add data item to IVM
 
@@ -149,6 +172,10 @@ class ImageVolumeManagement(QtCore.QObject):
         :param make_current: If True, make this the current data item
         :param make_main: If True, make this the main data.
         :param roi: If providing Numpy array, optionally specifies whether the data is an ROI or not
+        :param sparse: If True, an in-memory ROI covering a small part of a large grid is stored
+                       as a :class:`SparseRoiData`. The caller must then not keep using the data
+                       item or array it passed in, as these are no longer the ones stored
+        :return: The data item stored in the IVM
         """
         if isinstance(data, np.ndarray):
             if grid is None or name is None:
@@ -162,6 +189,16 @@ class ImageVolumeManagement(QtCore.QObject):
 
         self._valid_name(data.name)
 
+        if sparse and isinstance(data, NumpyData) and self._use_sparse(data):
+            LOG.debug("Storing %s as a sparse ROI", data.name)
+            data = SparseRoiData.from_array(data.rawdata, data.grid, data.name, metadata=data.metadata,
+                                            view=data.view, fname=data.fname,
+                                            stats=data.cached_stats())
+        elif isinstance(data, NumpyData) and not data.rawdata.flags.writeable:
+            # Data may be shared with a cache, e.g. a resampled copy. Tools may modify data
+            # in the IVM in-place so it needs its own copy
+            data.rawdata = np.array(data.rawdata)
+
         # If replacing existing data, delete the old one first
         if data.name in self.data:
             if self.current_data is not None and self.current_data.name == data.name:
@@ -200,6 +237,11 @@ class ImageVolumeManagement(QtCore.QObject):
             else:
                 self.set_current_data(data.name)
 
+        # New data is most recently used, so older data may be released if we are over budget
+        self.memory.touch(data.name)
+        self.memory.enforce()
+        return data
+
     def _data_exists(self, name):
         if name not in self.data:
             raise RuntimeError("Data '%s' does not exist" % name)
@@ -238,6 +280,7 @@ class ImageVolumeManagement(QtCore.QObject):
         if name is not None:
             self._data_exists(name)
             self.current_data = self.data[name]
+            self.memory.touch(name)
         else:
             self.current_data = None
         self.sig_current_data.emit(self.current_data)
@@ -268,6 +311,8 @@ class ImageVolumeManagement(QtCore.QObject):
         qpd.name = newname
         del self.data[name]
         self.data[newname] = qpd
+        self.memory.forget(name)
+        self.memory.touch(newname)
         self.sig_all_data.emit(list(self.data.keys()))
 
     def delete(self, name):
@@ -278,6 +323,7 @@ class ImageVolumeManagement(QtCore.QObject):
         """
         self._data_exists(name)
         del self.data[name]
+        self.memory.forget(name)
         if self.current_data is not None and self.current_data.name == name:
             self.current_data = None
             self.sig_current_data.emit(None)
@@ -285,6 +331,7 @@ class ImageVolumeManagement(QtCore.QObject):
             self.main = None
             self.sig_main_data.emit(None)
         self.sig_all_data.emit(list(self.data.keys()))
+        self.memory.enforce()
 
     def set_current_roi(self, name):
         """
@@ -295,6 +342,7 @@ class ImageVolumeManagement(QtCore.QObject):
         if name is not None:
             self._roi_exists(name)
             self.current_roi = self.rois[name]
+            self.memory.touch(name)
         else:
             self.current_roi = None
         self.sig_current_roi.emit(self.current_roi)
@@ -362,3 +410,20 @@ class ImageVolumeManagement(QtCore.QObject):
                 timeseries[qpd.name] = qpd.timeseries(pos, grid)
 
         return timeseries
+
+    def timeseries_many(self, points, grid=None):
+        """
+        Return time/volume series curves at multiple points for all 4D data items
+
+        :param points: Sequence of N 3D or 4D positions. If ``grid`` not specified,
+                       positions are in world space
+        :param grid: If specified, interpret positions in this ``DataGrid`` co-ordinate space.
+        :return: Dictionary of data name : Numpy array of shape [N, nvols]. See
+                 ``QpData.timeseries_many()``
+        """
+        timeseries = {}
+        for qpd in self.data.values():
+            if qpd.nvols > 1:
+                timeseries[qpd.name] = qpd.timeseries_many(points, grid)
+
+        return timeseries
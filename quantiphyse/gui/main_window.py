@@ -29,7 +29,9 @@ except ImportError:
 
 import pyqtgraph.console
 
-from quantiphyse.data import load, save, ImageVolumeManagement
+from quantiphyse.data import save, save_session, load_session, ImageVolumeManagement
+from quantiphyse.data.loader import default_loader
+from quantiphyse.data.memory import format_size
 from quantiphyse.utils import set_default_save_dir, default_save_dir, get_icon, get_local_file, get_version, get_plugins, local_file_from_drop_url, show_help
 from quantiphyse import __contrib__, __acknowledge__
 
@@ -146,6 +148,7 @@ class MainWindow(QtGui.QMainWindow):
         
         self.ivm = ImageVolumeManagement()
         self.ivl = Viewer(self.ivm)
+        self.loader = default_loader()
 
         # Load style sheet
         stylesheet = get_local_file("resources/darkorange.stylesheet")
@@ -257,6 +260,16 @@ class MainWindow(QtGui.QMainWindow):
         save_roi_action.setStatusTip('Save current ROI as a NIFTI file')
         save_roi_action.triggered.connect(self.save_roi)
 
+        # File --> Save session
+        save_session_action = QtGui.QAction(QtGui.QIcon.fromTheme("document-save-as"), 'Save session', self)
+        save_session_action.setStatusTip('Save all data, ROIs and view settings to a single session file')
+        save_session_action.triggered.connect(self.save_session)
+
+        # File --> Restore session
+        load_session_action = QtGui.QAction(QtGui.QIcon.fromTheme("document-open"), 'Restore session', self)
+        load_session_action.setStatusTip('Replace all data with the contents of a saved session file')
+        load_session_action.triggered.connect(self.load_session)
+
         # File --> Clear all
         clear_action = QtGui.QAction(QtGui.QIcon.fromTheme("clear"), '&Clear all data', self)
         clear_action.setStatusTip('Remove all data from the viewer')
@@ -297,6 +310,8 @@ class MainWindow(QtGui.QMainWindow):
         file_menu.addAction(load_action)
         file_menu.addAction(save_ovreg_action)
         file_menu.addAction(save_roi_action)
+        file_menu.addAction(save_session_action)
+        file_menu.addAction(load_session_action)
         file_menu.addAction(clear_action)
         file_menu.addAction(exit_action)
 
@@ -325,6 +340,21 @@ class MainWindow(QtGui.QMainWindow):
 
         # extra info displayed in the status bar
         self.statusBar()
+        self._memory_label = QtGui.QLabel()
+        self.statusBar().addPermanentWidget(self._memory_label)
+        self.ivm.memory.sig_usage.connect(self._memory_usage_changed)
+        self._memory_usage_changed(self.ivm.memory.total(), self.ivm.memory.budget)
+        self.loader.sig_progress.connect(self._load_progress)
+        self.loader.sig_pending.connect(self._load_pending)
+
+    def _memory_usage_changed(self, usage, budget):
+        """
+        Update the status bar readout of memory used by data
+        """
+        text = "Data memory: %s" % format_size(usage)
+        if budget > 0:
+            text += " / %s" % format_size(budget)
+        self._memory_label.setText(text)
 
     def dragEnterEvent(self, drag_data):
         """
@@ -415,27 +445,33 @@ class MainWindow(QtGui.QMainWindow):
     def load_data_interactive(self, fname=None, name=None):
         """
         Load data into the IVM from a file (which may already be known)
+
+        The file is opened in the background and the user is asked how to interpret it
+        when basic metadata is available. The data is then read in the background and
+        added to the IVM when it is ready, so the GUI stays responsive while large files
+        are loading.
         """
         if fname is None:
             fname, _ = QtGui.QFileDialog.getOpenFileName(self, 'Open file', default_save_dir())
             if not fname: return
         set_default_save_dir(os.path.dirname(fname))
 
-        # Data is not loaded at this point, however basic metadata is so we can tailor the
+        # Data is not read at this point, however basic metadata is so we can tailor the
         # options we offer
-        data = load(fname)
+        self.loader.load(fname, callback=self._loaded_interactive, preload=False)
 
+    def _loaded_interactive(self, data):
         # If we have apparently 3d data then we have the 'advanced' option of treating the
         # third dimension as time - some broken NIFTI files require this.
         force_t_option = (data.nvols == 1 and data.grid.shape[2] > 1)
         force_t = False
                 
-        options = DragOptions(self, fname, self.ivm, force_t_option=force_t_option, 
+        options = DragOptions(self, data.fname, self.ivm, force_t_option=force_t_option, 
                               default_main=self.ivm.main is None, possible_roi=(data.nvols ==1))
         if not options.exec_(): return
         
         data.name = options.name
-        data.roi = options.type == "roi"
+        roi = options.type == "roi"
         if force_t_option: force_t = options.force_t
         
         # If we had to do anything evil to make data fit, warn and give user the chance to back out
@@ -447,18 +483,31 @@ class MainWindow(QtGui.QMainWindow):
             if msg_box.exec_() != QtGui.QMessageBox.Ok: return
             data.set_2dt()
         
-        self.ivm.add(data, make_main=options.make_main, make_current=not options.make_main)
+        def _add(data):
+            data.roi = roi
+            self.ivm.add(data, make_main=options.make_main, make_current=not options.make_main)
+        self.loader.preload(data, callback=_add)
 
     def load_data(self, fname):
         """
         Load data non-interactively. The data will not be flagged as an ROI but the user
         can change that later if they want. Any finer control and you need to use interactive
         loading.
+
+        The data is loaded in the background and added to the IVM when it is ready
         """
-        qpdata = load(fname)
-        name = self.ivm.suggest_name(os.path.split(fname)[1].split(".", 1)[0])
-        qpdata.name = name
-        self.ivm.add(qpdata)
+        def _add(qpdata):
+            name = self.ivm.suggest_name(os.path.split(fname)[1].split(".", 1)[0])
+            qpdata.name = name
+            self.ivm.add(qpdata)
+        self.loader.load(fname, callback=_add)
+
+    def _load_progress(self, fname, complete):
+        self.statusBar().showMessage("Loading %s: %i%%" % (os.path.basename(fname), int(complete*100)))
+
+    def _load_pending(self, num_pending):
+        if num_pending == 0:
+            self.statusBar().clearMessage()
 
     def save_data(self):
         """
@@ -497,6 +546,36 @@ class MainWindow(QtGui.QMainWindow):
             else: # Cancelled
                 pass
 
+    def save_session(self):
+        """
+        Dialog for saving all data to a session file
+        """
+        if not self.ivm.data:
+            QtGui.QMessageBox.warning(self, "No data", "No data to save", QtGui.QMessageBox.Close)
+            return
+
+        fname, _ = QtGui.QFileDialog.getSaveFileName(self, 'Save session', dir=os.path.join(default_save_dir(), "session.qps"),
+                                                     filter="Quantiphyse sessions (*.qps)")
+        if fname != '':
+            set_default_save_dir(os.path.dirname(fname))
+            save_session(self.ivm, fname)
+
+    def load_session(self):
+        """
+        Dialog for restoring a session file
+        """
+        if self.ivm.data:
+            ret = QtGui.QMessageBox.warning(self, "Restore session", "Restoring a session will replace all current data. Continue?",
+                                            QtGui.QMessageBox.Yes | QtGui.QMessageBox.Cancel, QtGui.QMessageBox.Cancel)
+            if ret != QtGui.QMessageBox.Yes:
+                return
+
+        fname, _ = QtGui.QFileDialog.getOpenFileName(self, 'Restore session', default_save_dir(),
+                                                     filter="Quantiphyse sessions (*.qps)")
+        if fname != '':
+            set_default_save_dir(os.path.dirname(fname))
+            load_session(self.ivm, fname)
+
     def _clear(self):
         if self.ivm.data:
             ret = QtGui.QMessageBox.warning(self, "Clear all data", "Are you sure you want to clear all data?",
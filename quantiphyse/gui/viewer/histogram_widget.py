@@ -124,7 +124,8 @@ class HistogramWidget(pg.HistogramLUTWidget):
 
     def _update_histogram(self):
         if self._qpdata is not None:
-            arr = remove_nans(self._qpdata.volume(self._vol))
+            # A reduced resolution copy is sufficient for the histogram of large data
+            arr = remove_nans(self._qpdata.overview(self._vol).raw())
             flat = arr.reshape(-1)
             img = pg.ImageItem(flat.reshape([1, -1]))
             hist = img.getHistogram()
@@ -56,8 +56,19 @@ import numpy as np
 import pyqtgraph as pg
 from PIL import Image, ImageDraw
 
+from quantiphyse.data import label_dtype
 from quantiphyse.utils import LogSource
 
+def _points_to_grid(points, grid, from_grid):
+    """
+    Transform a list of 4D points from one grid to another in a single operation
+
+    :return: List of 4D co-ordinate lists
+    """
+    if not points:
+        return []
+    return [list(pos) for pos in grid.grid_to_grid_many(np.array(points, dtype=float), from_grid=from_grid)]
+
 class PickMode(object):
     """
     Enumeration of supported pick modes
@@ -193,7 +204,7 @@ class PaintPicker(Picker):
         :return: The selected point as a sequence of 4D co-ordinates
         """
         if grid is not None:
-            return [grid.grid_to_grid(pos, from_grid=self.ivl.grid) for pos in self._points]
+            return _points_to_grid(self._points, grid, self.ivl.grid)
         else:
             return self._points
             
@@ -219,7 +230,7 @@ class MultiPicker(Picker):
         if grid is not None:
             ret = {}
             for col, pts in self._points.items():
-                ret[col] = [grid.grid_to_grid(pos, from_grid=self.ivl.grid) for pos in pts]
+                ret[col] = _points_to_grid(pts, grid, self.ivl.grid)
             return ret
         else:
             return self._points
@@ -285,7 +296,7 @@ class PolygonPicker(Picker):
         img = Image.new('L', (w, h), 0)
         ImageDraw.Draw(img).polygon(points, outline=label, fill=label)
 
-        ret = np.zeros(grid.shape, dtype=np.int)
+        ret = np.zeros(grid.shape, dtype=label_dtype(0, label))
         slice_mask = np.array(img)
         if gridx < gridy:
             slice_mask = slice_mask.T
@@ -313,14 +324,11 @@ class PolygonPicker(Picker):
         # NB we are assuming here that the supplied grid is orthogonal to the
         # viewer grid, otherwise things will not work.
         self.debug("points in std space are: %s", self._points)
-        points = []
-        for x, y in self._points:
-            std_pt = [0, 0, 0, 0]
-            std_pt[self.view.xaxis] = x
-            std_pt[self.view.yaxis] = y
-            std_pt[self.view.zaxis] = 0
-            grid_pt = grid.grid_to_grid(std_pt, from_grid=self.ivl.grid)
-            points.append((int(grid_pt[gridx]+0.5), int(grid_pt[gridy]+0.5)))
+        std_pts = np.zeros((len(self._points), 3))
+        if self._points:
+            std_pts[:, [self.view.xaxis, self.view.yaxis]] = self._points
+        grid_pts = grid.grid_to_grid_many(std_pts, from_grid=self.ivl.grid)
+        points = [(int(x+0.5), int(y+0.5)) for x, y in grid_pts[:, [gridx, gridy]]]
         self.debug("points in grid space are: %s", points)
         return gridx, gridy, gridz, points
 
@@ -404,7 +412,7 @@ class EllipsePicker(PolygonPicker):
         img = Image.new('L', (w, h), 0)
         ImageDraw.Draw(img).ellipse(points, outline=label, fill=label)
 
-        ret = np.zeros(grid.shape, dtype=np.int)
+        ret = np.zeros(grid.shape, dtype=label_dtype(0, label))
         slice_mask = np.array(img)
         if gridx < gridy:
             slice_mask = slice_mask.T
@@ -0,0 +1,109 @@
+"""
+Quantiphyse - Background prefetching of slices from neighbouring volumes
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import division, unicode_literals, absolute_import
+
+import threading
+import logging
+from multiprocessing.pool import ThreadPool
+
+LOG = logging.getLogger(__name__)
+
+#: Number of volumes either side of the current volume to prefetch. Set to 0 to disable prefetching
+PREFETCH_VOLUMES = 2
+
+#: Number of background threads used for prefetching
+PREFETCH_THREADS = 2
+
+class SlicePrefetcher(object):
+    """
+    Extracts slices from volumes neighbouring the one being displayed in background threads
+
+    The slices are stored in the data item's slice cache (see ``QpData.slice_data``) so
+    when the user steps to a neighbouring volume the slice can usually be drawn without
+    having to read or resample any data on the GUI thread.
+
+    Each requester (e.g. an ortho slice viewer) is identified by an owner key. When a new
+    prefetch is requested for an owner, tasks queued for its previous position which have
+    not yet started are skipped, so scrolling quickly does not build up a backlog of work.
+    """
+
+    def __init__(self, nvols=None, nthreads=None):
+        """
+        :param nvols: Number of volumes either side of the current volume to prefetch.
+                      Defaults to ``PREFETCH_VOLUMES``
+        :param nthreads: Number of background threads. Defaults to ``PREFETCH_THREADS``
+        """
+        self.nvols = nvols if nvols is not None else PREFETCH_VOLUMES
+        self._nthreads = nthreads if nthreads is not None else PREFETCH_THREADS
+        self._pool = None
+        self._lock = threading.Lock()
+        self._generation = {}
+        self._pending = set()
+
+    def prefetch(self, owner, qpdata, plane, vol, interp_order=0):
+        """
+        Queue extraction of slices from the volumes around ``vol``
+
+        Nearer volumes are queued first. Volumes already being extracted are not queued again.
+
+        :param owner: Hashable key identifying the requester
+        :param qpdata: QpData instance
+        :param plane: OrthoSlice being displayed
+        :param vol: Volume currently being displayed
+        :param interp_order: Interpolation order used when extracting the slice
+        """
+        if self.nvols <= 0 or qpdata.nvols <= 1:
+            return
+
+        with self._lock:
+            generation = self._generation.get(owner, 0) + 1
+            self._generation[owner] = generation
+            if self._pool is None:
+                self._pool = ThreadPool(self._nthreads)
+
+            for offset in range(1, self.nvols+1):
+                for nvol in (vol+offset, vol-offset):
+                    if nvol < 0 or nvol >= qpdata.nvols:
+                        continue
+                    key = (id(qpdata), plane.affine.tobytes(), tuple(plane.shape), nvol, interp_order)
+                    if key in self._pending:
+                        continue
+                    self._pending.add(key)
+                    self._pool.apply_async(self._extract, (key, owner, generation, qpdata, plane, nvol, interp_order))
+
+    def stop(self):
+        """
+        Discard queued tasks and shut down the background threads
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._generation.clear()
+        if pool is not None:
+            pool.terminate()
+
+    def _extract(self, key, owner, generation, qpdata, plane, vol, interp_order):
+        try:
+            if self._generation.get(owner, 0) == generation:
+                qpdata.slice_data(plane, vol=vol, interp_order=interp_order)
+        except Exception: # pylint: disable=broad-except
+            # Prefetching is opportunistic - any real problem will be reported
+            # when the slice is extracted for display
+            LOG.debug("Failed to prefetch volume %i of %s", vol, qpdata.name, exc_info=True)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
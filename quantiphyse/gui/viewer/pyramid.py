@@ -0,0 +1,99 @@
+"""
+Quantiphyse - Background building of reduced resolution levels for display
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import division, unicode_literals, absolute_import
+
+import threading
+import logging
+from multiprocessing.pool import ThreadPool
+
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
+LOG = logging.getLogger(__name__)
+
+#: Number of background threads used for building pyramid levels
+PYRAMID_THREADS = 1
+
+class PyramidBuilder(QtCore.QObject):
+    """
+    Builds reduced resolution levels of data items in background threads
+
+    Levels are stored in the data item (see ``QpData.pyramid_level``). While a level
+    is being built the viewer displays the data at full resolution and ``sig_built``
+    is emitted when the level is ready so the view can be redrawn.
+    """
+
+    #: Emitted with the QpData instance and volume index when its levels have been built
+    sig_built = QtCore.Signal(object, int)
+
+    def __init__(self, nthreads=None):
+        """
+        :param nthreads: Number of background threads. Defaults to ``PYRAMID_THREADS``
+        """
+        QtCore.QObject.__init__(self)
+        self._nthreads = nthreads if nthreads is not None else PYRAMID_THREADS
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def build(self, qpdata, vol):
+        """
+        Queue building of all the pyramid levels for a volume
+
+        Does nothing if the volume is already being built.
+
+        :param qpdata: QpData instance
+        :param vol: Volume index
+        """
+        levels = qpdata.pyramid_levels()
+        if levels == 0:
+            return
+
+        with self._lock:
+            key = (id(qpdata), vol)
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._pool is None:
+                self._pool = ThreadPool(self._nthreads)
+            self._pool.apply_async(self._build, (key, qpdata, vol, levels))
+
+    def stop(self):
+        """
+        Discard queued tasks and shut down the background threads
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._pending.clear()
+        if pool is not None:
+            pool.terminate()
+
+    def _build(self, key, qpdata, vol, levels):
+        try:
+            qpdata.pyramid_level(levels, vol)
+            if self._pool is not None:
+                # Viewer may have been destroyed if the builder has been stopped
+                self.sig_built.emit(qpdata, vol)
+        except Exception: # pylint: disable=broad-except
+            # The data will continue to be displayed at full resolution
+            LOG.debug("Failed to build pyramid for volume %i of %s", vol, qpdata.name, exc_info=True)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
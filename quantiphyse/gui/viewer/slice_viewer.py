@@ -23,6 +23,8 @@ try:
 except ImportError:
     from PySide2 import QtGui, QtCore, QtWidgets
 
+import math
+
 import numpy as np
 import pyqtgraph as pg
 
@@ -45,11 +47,13 @@ class SliceDataView(LogSource):
     Draws a slice through a data item
     """ 
 
-    def __init__(self, ivm, qpdata, viewbox, plane, vol, view_metadata=None):
+    def __init__(self, ivm, qpdata, viewbox, plane, vol, view_metadata=None, pyramids=None):
         """
         :param qpdata: QpData instance
         :param viewbox: pyqtgraph ViewBox instance
         :param view_metadata: View parameters
+        :param pyramids: Optional PyramidBuilder. If specified, large data is displayed using
+                         a reduced resolution level when zoomed out
         """
         LogSource.__init__(self)
         self._ivm = ivm
@@ -60,6 +64,10 @@ class SliceDataView(LogSource):
         self._view = self._qpdata.view
         if view_metadata is not None:
             self._view = view_metadata
+        self._pyramids = pyramids
+        self._level = 0
+        # Size of a full resolution data voxel in view co-ordinates, known once it has been drawn
+        self._voxel_size = None
         
         self._redraw_options = [
             "visible",
@@ -75,6 +83,18 @@ class SliceDataView(LogSource):
         self.update()
         self.redraw()
         self._view.sig_changed.connect(self._view_metadata_changed)
+        if self._pyramids is not None:
+            self._viewbox.sigRangeChanged.connect(self._range_changed)
+
+    @property
+    def qpdata(self):
+        """ QpData instance being displayed """
+        return self._qpdata
+
+    @property
+    def visible(self):
+        """ True if the data is currently being drawn, either as an image or a contour """
+        return self._img.isVisible() or bool(self._view.contour)
 
     @property
     def plane(self):
@@ -100,6 +120,47 @@ class SliceDataView(LogSource):
             self._vol = vol
             self.redraw()
 
+    def pyramid_built(self, qpdata, vol):
+        """
+        Called when reduced resolution levels of a data item have been built
+
+        :param qpdata: QpData instance
+        :param vol: Volume index
+        """
+        if qpdata is self._qpdata and vol == min(self._vol, self._qpdata.nvols-1):
+            if self._display_level() != self._level:
+                self.redraw()
+
+    def _range_changed(self, *args):
+        if self._display_level(build=True) != self._level:
+            self.debug("Zoom changed - redrawing")
+            self.redraw()
+
+    def _display_level(self, build=False):
+        """
+        Get the pyramid level to display at the current zoom
+
+        This is the coarsest level whose voxels are no larger than a screen pixel.
+
+        :param build: If True, start building levels in the background if they are
+                      not available yet
+        :return: Level index, 0 if the full resolution data should be displayed
+        """
+        levels = self._qpdata.pyramid_levels() if self._pyramids is not None else 0
+        if levels == 0 or not self._voxel_size:
+            return 0
+
+        pixel_size = min(self._viewbox.viewPixelSize())
+        if pixel_size <= 0 or not np.isfinite(pixel_size):
+            return 0
+        level = min(levels, max(0, int(math.floor(math.log(pixel_size / self._voxel_size, 2)))))
+        vol = min(self._vol, self._qpdata.nvols-1)
+        if level > 0 and self._qpdata.pyramid_level(level, vol, build=False) is None:
+            if build:
+                self._pyramids.build(self._qpdata, vol)
+            return 0
+        return level
+
     def _view_metadata_changed(self, key, value):
         self.debug("View params changed: %s=%s", key, value)
         if key in ("cmap", "lut"):
@@ -141,9 +202,18 @@ class SliceDataView(LogSource):
             # FIXME ROIs always on top - should be option
             self._z_order += MAX_NUM_DATA_SETS
 
+        self._level = self._display_level(build=True)
+        if self._level > 0:
+            self.debug("Using pyramid level %i", self._level)
+            qpdata = self._qpdata.pyramid_level(self._level, self._vol)
+            vol = 0
+        else:
+            qpdata, vol = self._qpdata, self._vol
+
         if self._img.isVisible() or self._view.contour:
-            slicedata, slicemask, scale, offset = self._qpdata.slice_data(self._plane, vol=self._vol,
-                                                                          interp_order=interp_order)
+            slicedata, slicemask, scale, offset = qpdata.slice_data(self._plane, vol=vol,
+                                                                    interp_order=interp_order)
+            self._voxel_size = np.min(np.linalg.norm(scale, axis=0)) / (2 ** self._level)
             self.debug("Image data range: %f, %f", np.min(slicedata), np.max(slicedata))
             qtransform = QtGui.QTransform(scale[0, 0], scale[0, 1],
                                           scale[1, 0], scale[1, 1],
@@ -155,7 +225,7 @@ class SliceDataView(LogSource):
 
             if self._view.roi:
                 roi = self._ivm.data[self._view.roi]
-                resampled_roi = roi.resample(self._qpdata.grid)
+                resampled_roi = roi.resample(qpdata.grid)
                 maskdata, _, _, _ = resampled_roi.slice_data(self._plane)
                 self._img.mask = np.logical_and(maskdata, slicemask)
             else:
@@ -189,6 +259,8 @@ class SliceDataView(LogSource):
         Remove the view from the viewbox
         """
         self.debug("Removing slice view")
+        if self._pyramids is not None:
+            self._viewbox.sigRangeChanged.disconnect(self._range_changed)
         self._viewbox.removeItem(self._img)
         for contour in self._contours:
             self._viewbox.removeItem(contour)
@@ -282,6 +354,7 @@ class OrthoSliceViewer(pg.GraphicsView, LogSource):
         # Connect to data change signals
         self.ivm.sig_all_data.connect(self._data_changed)
         self.ivm.sig_main_data.connect(self._main_data_changed)
+        self._ivl.pyramids.sig_built.connect(self._pyramid_built)
 
         # Need to intercept the default resize event
         # FIXME why can't call superclass method normally?
@@ -365,11 +438,16 @@ class OrthoSliceViewer(pg.GraphicsView, LogSource):
         for name in data_names:
             if name not in self._data_views:
                 qpdata = self.ivm.data[name]
-                self._data_views[name] = SliceDataView(self.ivm, qpdata, self._viewbox, self._plane, self._vol)
+                self._data_views[name] = SliceDataView(self.ivm, qpdata, self._viewbox, self._plane, self._vol,
+                                                       pyramids=self._ivl.pyramids)
 
         self._update_crosshairs()
         self._update_orientation()
 
+    def _pyramid_built(self, qpdata, vol):
+        for view in self._data_views.values():
+            view.pyramid_built(qpdata, vol)
+
     def _main_data_changed(self):
         self._update_main_data()
 
@@ -379,7 +457,8 @@ class OrthoSliceViewer(pg.GraphicsView, LogSource):
             del self._data_views[MAIN_DATA]
 
         if self.ivm.main is not None and self._ivl.opts.main_data == Visibility.SHOW:
-            self._data_views[MAIN_DATA] = SliceDataView(self.ivm, self.ivm.main, self._viewbox, self._plane, self._vol, self._ivl.main_view_md)
+            self._data_views[MAIN_DATA] = SliceDataView(self.ivm, self.ivm.main, self._viewbox, self._plane, self._vol,
+                                                        self._ivl.main_view_md, pyramids=self._ivl.pyramids)
         self.reset()
 
     def _update_crosshairs(self):
@@ -405,9 +484,13 @@ class OrthoSliceViewer(pg.GraphicsView, LogSource):
         self._slicez = self._ivl.focus()[self.zaxis]
         self._vol = self._ivl.focus()[3]
         self._plane = OrthoSlice(self._ivl.grid, self.zaxis, self._slicez)
-        for view in self._data_views.values():
+        for name, view in self._data_views.items():
             view.plane = self._plane
             view.vol = self._vol
+            if view.visible and view.qpdata.nvols > 1:
+                # Each view is a separate requester so prefetching one does not
+                # cancel the others
+                self._ivl.prefetcher.prefetch((self, name), view.qpdata, self._plane, self._vol)
         self.debug("set slice: %f %i", self._slicez, self._vol)
 
     def _update_visible_arrows(self):
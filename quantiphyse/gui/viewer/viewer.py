@@ -34,6 +34,8 @@ from .slice_viewer import OrthoSliceViewer
 from .histogram_widget import HistogramWidget, CurrentDataHistogramWidget
 from .view_params_widget import ViewParamsWidget
 from .navigators import NavigationBox
+from .prefetch import SlicePrefetcher
+from .pyramid import PyramidBuilder
 
 DEFAULT_MAIN_VIEW = {
     "visible" : Visibility.SHOW,
@@ -147,6 +149,17 @@ class Viewer(QtGui.QSplitter, LogSource):
         self.opts.main_data = Visibility.SHOW
         self.opts.interp = 0
 
+        # Extracts slices from neighbouring volumes in the background
+        self.prefetcher = SlicePrefetcher()
+
+        # Builds reduced resolution levels of large data for display when zoomed out
+        self.pyramids = PyramidBuilder()
+
+        # Shut down the background threads when the viewer goes away. Bound methods of
+        # the viewer itself cannot safely be called once it is being destroyed
+        prefetcher, pyramids = self.prefetcher, self.pyramids
+        self.destroyed.connect(lambda *args: (prefetcher.stop(), pyramids.stop()))
+
         # Create three orthogonal slice viewers
         # For each viewer, we pass the xyz axis mappings and the labels
         ax_map = [[0, 1, 2], [0, 2, 1], [1, 2, 0]]
@@ -150,18 +150,12 @@ class AifWidget(QpWidget):
             self._aif = aif / len(points)
 
     def _calc_aif_points(self):
-        aif = None
-        num_points = 0
-        for point in self._aif_points:
-            sig = self.qpdata.timeseries(point, grid=self.ivl.grid)
-            self.debug("AIF signal: %s", sig)
-            if aif is None:
-                aif = np.zeros([len(sig)], dtype=np.float32)
-            aif += sig
-            num_points += 1
-
-        if num_points > 0:
-            self._aif = aif / num_points
+        sigs = self.qpdata.timeseries_many(self._aif_points, grid=self.ivl.grid)
+        # Ignore points outside the data
+        sigs = sigs[~np.all(np.isnan(sigs), axis=1)]
+        self.debug("AIF signals: %s", sigs)
+        if len(sigs) > 0:
+            self._aif = np.mean(sigs, axis=0).astype(np.float32)
 
     def _update_plot(self):
         self._plot.clear()
@@ -21,6 +21,7 @@ import unittest
 import numpy as np
 import pandas as pd
 
+from quantiphyse.data import ExpressionData
 from quantiphyse.processes import Process
 from quantiphyse.test import ProcessTest
 
@@ -208,5 +209,42 @@ class AnalysisProcessTest(ProcessTest):
         self.assertEqual(self.status, Process.SUCCEEDED)
         self.assertTrue("test1" in self.ivm.data)
 
+    def testExecLazy(self):
+        yaml = """
+  - Exec:
+      lazy: True
+      test1: data_4d * 2 + np.exp(-data_4d)
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue(isinstance(self.ivm.data["test1"], ExpressionData))
+        expected = self.data_4d * 2 + np.exp(-self.data_4d)
+        self.assertTrue(np.allclose(self.ivm.data["test1"].volume(1), expected[..., 1]))
+        self.assertTrue(np.allclose(self.ivm.data["test1"].raw(), expected))
+
+    def testExecNotLazy(self):
+        yaml = """
+  - Exec:
+      test1: data_3d * 2
+      test2: data_3d - np.mean(data_3d)
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertFalse(isinstance(self.ivm.data["test1"], ExpressionData))
+        self.assertFalse(isinstance(self.ivm.data["test2"], ExpressionData))
+
+    def testExecComprehension(self):
+        yaml = """
+  - Exec:
+      exec:
+        - vols = [data_4d[..., i] for i in range(2)]
+      test1: np.stack([data_3d * i for i in range(2)], -1).sum(-1)
+      test2: (lambda: vols[1] - data_4d[..., 0])()
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(self.ivm.data["test1"].raw(), self.data_3d))
+        self.assertTrue(np.allclose(self.ivm.data["test2"].raw(), self.data_4d[..., 1] - self.data_4d[..., 0]))
+
 if __name__ == '__main__':
     unittest.main()
@@ -26,7 +26,7 @@ try:
 except ImportError:
     from PySide2 import QtGui, QtCore, QtWidgets
 
-from quantiphyse.data import NumpyData, OrthoSlice
+from quantiphyse.data import NumpyData, OrthoSlice, ExpressionData
 from quantiphyse.utils import QpException, table_to_extra, sf
 from quantiphyse.processes import Process
 
@@ -172,10 +172,17 @@ class DataStatisticsProcess(Process):
         # Separate ROI and non-ROI cases to avoid making additional array copy
         # when there is no ROI
         if roi is not None:
-            roi_arr = roi.resample(data.grid).raw()
+            roi_data = roi.resample(data.grid)
+            if slice_loc is None:
+                roi_index = roi_data.roi_index()
+            else:
+                roi_arr = roi_data.raw()
 
             for region, name in roi.regions.items():
-                region_data = data_arr[roi_arr == region]
+                if slice_loc is None:
+                    region_data = data_arr[roi_index.coords(region)]
+                else:
+                    region_data = data_arr[roi_arr == region]
                 if region_data.size > 0:
                     mean, med, std = np.nanmean(region_data), median(region_data), np.nanstd(region_data)
                     mx, mn = np.nanmax(region_data), np.nanmin(region_data)
@@ -225,7 +232,8 @@ class ExecProcess(Process):
         self.model = QtGui.QStandardItemModel()
 
     def run(self, options):
-        exec_globals = {'np': np, 'scipy' : scipy, 'ivm': self.ivm}
+        # Data is only read when used by the code
+        namespace = _DataNamespace(self.ivm, {'np': np, 'scipy' : scipy, 'ivm': self.ivm})
 
         # For general Numpy operations we will need a grid to put the
         # results back into. This is specified by the 'grid' option.
@@ -234,25 +242,61 @@ class ExecProcess(Process):
         gridfrom = options.pop("grid", None)
         is_roi = options.pop("output-is-roi", False)
 
+        # Optionally, data items defined by an expression which acts on each voxel
+        # independently are computed when required rather than immediately. These
+        # use whatever data currently has the input names, so they fail if an input
+        # is deleted or renamed and change if an input is replaced
+        lazy = options.pop("lazy", False) and not is_roi
+
         if gridfrom is None:
             grid = self.ivm.main.grid
         else:
             grid = self.ivm.data[gridfrom].grid
 
-        for name, data in self.ivm.data.items():
-            exec_globals[name] = data.raw()
-
         for name in list(options.keys()):
             proc = options.pop(name)
             if name in ("exec", "_"):
                 for code in proc:
                     try:
-                        exec(code, exec_globals)
+                        exec(code, namespace)
                     except:
                         raise QpException("'%s' is not valid Python code (Reason: %s)" % (code, sys.exc_info()[1]))
             else:
+                result = None
+                if lazy and not namespace.assigned:
+                    result = ExpressionData.create(str(proc), self.ivm.data, grid, name)
                 try:
-                    result = eval(proc, exec_globals)
+                    if result is None:
+                        result = eval(proc, namespace)
                     self.ivm.add(result, grid=grid, name=name, roi=is_roi)
                 except:
                     raise QpException("'%s' did not return valid data (Reason: %s)" % (proc, sys.exc_info()[1]))
+
+class _DataNamespace(dict):
+    """
+    Namespace for executing code in which the names of data items in the IVM refer
+    to their raw data arrays. Data is only read when the name is used
+
+    This is used as the global namespace so that data items can also be used
+    inside functions, lambdas and comprehensions defined by the code
+    """
+    def __init__(self, ivm, initial):
+        """
+        :param ivm: ImageVolumeManagement instance
+        :param initial: Dictionary of names which are always defined, e.g. modules
+        """
+        dict.__init__(self, initial)
+        self._ivm = ivm
+        # True if the code has defined any names, which might hide data items
+        self.assigned = False
+
+    def __setitem__(self, name, value):
+        self.assigned = True
+        dict.__setitem__(self, name, value)
+
+    def __missing__(self, name):
+        if name in self._ivm.data:
+            value = self._ivm.data[name].raw()
+            dict.__setitem__(self, name, value)
+            return value
+        raise KeyError(name)
@@ -139,20 +139,21 @@ class MultiVoxelAnalysis(QpWidget):
         self.ivl.set_picker(PickMode.MULTIPLE)
         self.ivl.picker.col = self.col
 
-    def _add_point(self, point, col):
+    def _add_points(self, points, col):
         """
-        Add a selected point of the specified colour
+        Add selected points of the specified colour
         """
         data_name = self.options.option("data").value
-        if data_name in self.ivm.data:
+        if points and data_name in self.ivm.data:
             data = self.ivm.data[data_name]
-            sig = data.timeseries(point, grid=self.ivl.grid)
-            if point in self.plots:
-                self.plot.remove(self.plots[point])
-
-            self.plots[point] = self.plot.add_line(sig, line_col=col)
-            if not self.options.option("indiv").value:
-                self.plots[point].hide()
+            sigs = data.timeseries_many(points, grid=self.ivl.grid)
+            for point, sig in zip(points, sigs):
+                if point in self.plots:
+                    self.plot.remove(self.plots[point])
+
+                self.plots[point] = self.plot.add_line(sig, line_col=col)
+                if not self.options.option("indiv").value:
+                    self.plots[point].hide()
             self._update_means()
 
     def _update_means(self):
@@ -177,9 +178,8 @@ class MultiVoxelAnalysis(QpWidget):
         for col, points in picker.selection().items():
             points = [tuple([int(p+0.5) for p in pos]) for pos in points]
             allpoints += points
-            for point in points:
-                if point not in self.plots or self.plots[point].line_col != col:
-                    self._add_point(point, col)
+            self._add_points([point for point in points
+                              if point not in self.plots or self.plots[point].line_col != col], col)
 
         # Remove plots for points no longer in the selection
         for point in list(self.plots.keys()):
@@ -481,6 +481,10 @@ class SimpleMathsWidget(QpWidget):
         self.optbox.add("Command", TextOption(), key="cmd")
         self.optbox.add("Output name", OutputNameOption(src_data=self.optbox.option("grid")), key="output-name")
         self.optbox.add("Output is an ROI", BoolOption(), key="output-is-roi")
+        self.optbox.add("Compute on demand", BoolOption(), key="lazy")
+        self.optbox.option("lazy").setToolTip("Compute the output when it is needed rather than immediately. "
+                                              "The output uses whatever data currently has the input names, so it "
+                                              "will fail if an input is deleted or renamed. Not used for ROI outputs")
         layout.addWidget(self.optbox)
         
         hbox = QtGui.QHBoxLayout()
@@ -496,6 +500,7 @@ class SimpleMathsWidget(QpWidget):
             "Exec" : {
                 "grid" : self.optbox.option("grid").value,
                 "output-is-roi" : self.optbox.option("output-is-roi").value,
+                "lazy" : self.optbox.option("lazy").value,
                 self.optbox.option("output-name").value : self.optbox.option("cmd").value,
             }
         }
@@ -550,8 +555,9 @@ class VoxelAnalysis(QpWidget):
 
     def _update(self, pos=None):
         self._update_table()
-        self._update_rms_table()
-        self._plot()
+        sigs = self.ivm.timeseries(self.ivl.focus(), self.ivl.grid)
+        self._update_rms_table(sigs)
+        self._plot(sigs)
 
     def _update_table(self):
         """
@@ -565,24 +571,25 @@ class VoxelAnalysis(QpWidget):
                 self.values_table.setVerticalHeaderItem(ii, QtGui.QStandardItem(ovl))
                 self.values_table.setItem(ii, 0, QtGui.QStandardItem(sf(data_vals[ovl])))
 
-    def _update_rms_table(self):
+    def _update_rms_table(self, sigs):
         try:
             self.updating = True # Hack to prevent plot being refreshed during table update
             self.rms_table.clear()
             self.rms_table.setHorizontalHeaderItem(0, QtGui.QStandardItem("Name"))
             self.rms_table.setHorizontalHeaderItem(1, QtGui.QStandardItem("RMS (Position)"))
 
-            pos = self.ivl.focus()
-            sigs = self.ivm.timeseries(pos, self.ivl.grid)
             max_length = max([0,] + [len(sig) for sig in sigs.values()])
             if self.ivm.main is not None:
-                main_curve = self.ivm.main.timeseries(pos, grid=self.ivl.grid)
+                if self.ivm.main.name in sigs:
+                    main_curve = list(sigs[self.ivm.main.name])
+                else:
+                    main_curve = self.ivm.main.timeseries(self.ivl.focus(), grid=self.ivl.grid)
                 main_curve.extend([0] * max_length)
                 main_curve = main_curve[:max_length]
 
             for idx, name in enumerate(sorted(sigs.keys())):
-                # Make sure data curve is correct length
-                data_curve = sigs[name]
+                # Make sure data curve is correct length. Copy the curve as it is also plotted
+                data_curve = list(sigs[name])
                 data_curve.extend([0] * max_length)
                 data_curve = data_curve[:max_length]
 
@@ -609,17 +616,16 @@ class VoxelAnalysis(QpWidget):
         if not self.updating:
             # A checkbox has been toggled
             self.data_enabled[item.text()] = item.checkState()
-            self._plot()
+            self._plot(self.ivm.timeseries(self.ivl.focus(), self.ivl.grid))
 
-    def _plot(self):
+    def _plot(self, sigs):
         """
         Regenerate the plot
+
+        :param sigs: Dictionary of data name : timeseries at the focus point
         """
         self.plot.clear() 
 
-        # Get all timeseries signals
-        pos = self.ivl.focus()
-        sigs = self.ivm.timeseries(pos, self.ivl.grid)
         if not sigs:
             return
             
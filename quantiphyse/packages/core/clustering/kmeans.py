@@ -22,7 +22,7 @@ import time
 import numpy as np
 import sklearn.cluster as cl
 
-from quantiphyse.data import NumpyData
+from quantiphyse.data import NumpyData, label_dtype
 from quantiphyse.processes import Process, normalisation, PCA
 from quantiphyse.utils import QpException
 
@@ -68,7 +68,7 @@ class KMeansProcess(Process):
         
         self.log("Elapsed time: %s" % (time.time() - start1))
 
-        label_image = np.zeros(data.grid.shape, dtype=np.int)
+        label_image = np.zeros(data.grid.shape, dtype=label_dtype(0, n_clusters))
         label_image[mask] = kmeans.labels_ + 1
         self.ivm.add(NumpyData(label_image, grid=data.grid, name=output_name, roi=True), make_current=True)
 
@@ -88,10 +88,12 @@ class MeanValuesProcess(Process):
 
         in_data = data.raw()
         out_data = np.zeros(in_data.shape)
+        roi_index = roi.roi_index()
         for region in roi.regions:
+            coords = roi_index.coords(region)
             if data.ndim > 3:
-                out_data[roi.raw() == region] = np.mean(in_data[roi.raw() == region], axis=0)
+                out_data[coords] = np.mean(in_data[coords], axis=0)
             else:
-                out_data[roi.raw() == region] = np.mean(in_data[roi.raw() == region])
+                out_data[coords] = np.mean(in_data[coords])
 
         self.ivm.add(NumpyData(out_data, grid=data.grid, name=output_name), make_current=True)
@@ -262,7 +262,7 @@ PCA reduction is used on 4D data to extract representative curves
                 self.count_table.setHorizontalHeaderItem(col_idx, QtGui.QStandardItem(name))
 
                 # Volume count
-                voxel_count = np.sum(roi.raw() == region)
+                voxel_count = roi.roi_index().count(region)
                 self.count_table.setItem(0, col_idx, QtGui.QStandardItem(str(np.around(voxel_count))))
                 col_idx += 1
 
@@ -29,6 +29,7 @@ class ResampleProcess(Process):
     """
 
     PROCESS_NAME = "Resample"
+    CACHEABLE = True
     
     def run(self, options):
         data = self.get_data(options)
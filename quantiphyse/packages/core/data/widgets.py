@@ -171,7 +171,7 @@ class OrientDataWidget(QpWidget):
 
     def _set(self):
         name = self.gridview.data.name
-        affine = self.gridview.data.grid.affine_orig
+        affine = np.array(self.gridview.data.grid.affine_orig)
         grid_centre = [float(dim) / 2 for dim in self.gridview.data.grid.shape]
         world_centre = np.dot(affine[:3, :3], grid_centre)
         self.debug("Initial affine\n%s", affine)
@@ -269,7 +269,7 @@ class GridView(QtGui.QWidget):
 
     def _changed(self):
         if self.data is not None and not self._updating:
-            affine = self.data.grid.affine
+            affine = np.array(self.data.grid.affine)
             if self.transform.valid():
                 affine[:3, :3] = self.transform.values()
             if self.origin.valid():
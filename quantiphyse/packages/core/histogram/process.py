@@ -65,10 +65,10 @@ class HistogramProcess(Process):
             if dmax is None: hrange[1] = np.max(rawdata)
 
             if roi is None:
-                roi_fordata = np.ones(data.grid.shape)
+                roi_index = None
                 regions = {1 : ""}
             else:
-                roi_fordata = roi.resample(data.grid).raw()
+                roi_index = roi.resample(data.grid).roi_index()
                 regions = roi.regions
 
             for region, region_name in regions.items():
@@ -76,7 +76,10 @@ class HistogramProcess(Process):
                     self.debug("Ignoring region %i", region)
                     continue
 
-                region_data = rawdata[roi_fordata == region]
+                if roi_index is None:
+                    region_data = rawdata
+                else:
+                    region_data = rawdata[roi_index.coords(region)]
                 data_vals, edges = np.histogram(region_data, bins=bins, range=hrange, density=prob)
                     
                 if region_name:
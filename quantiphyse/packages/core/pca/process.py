@@ -27,6 +27,7 @@ class PcaProcess(Process):
     Process to do PCA (Principal Component Analysis) reduction on 4D data
     """
     PROCESS_NAME = "PCA"
+    CACHEABLE = True
 
     def __init__(self, ivm, **kwargs):
         Process.__init__(self, ivm, **kwargs)
@@ -60,7 +60,7 @@ def _normalize_output(reg_data, output_data, output_suffix):
     if reg_data.roi:
         # This is not correct for multi-level ROIs - this would basically require support
         # from within the registration algorithm for roi (integer only) data
-        data = np.rint(output_data.raw()).astype(np.int)
+        data = np.rint(output_data.raw())
         output_data = NumpyData(data, grid=output_data.grid, name=output_data.name, roi=True)
     output_data.name = reg_data.name + output_suffix
     return output_data
@@ -140,6 +140,7 @@ class RegProcess(Process):
     """
 
     PROCESS_NAME = "Reg"
+    CACHEABLE = True
 
     def __init__(self, ivm, **kwargs):
         Process.__init__(self, ivm, worker_fn=_run_reg, **kwargs)
@@ -239,6 +240,7 @@ class ApplyTransformProcess(Process):
     """
 
     PROCESS_NAME = "ApplyTransform"
+    CACHEABLE = True
 
     def run(self, options):
         self.debug("Run")
@@ -27,7 +27,7 @@ try:
 except ImportError:
     from PySide2 import QtGui, QtCore, QtWidgets
 
-from quantiphyse.data import NumpyData
+from quantiphyse.data import NumpyData, label_dtype
 from quantiphyse.gui.widgets import OverlayCombo, RoiCombo, NumericOption, NumericSlider
 from quantiphyse.gui.viewer.pickers import PickMode
 from quantiphyse.utils import LogSource
@@ -264,7 +264,7 @@ class PickTool(Tool):
         picked_region = roi_picked.value(pos, grid=self.builder.grid)
 
         roi_picked_arr = roi_picked.resample(self.builder.grid).raw()
-        self.roi_new = np.zeros(self.builder.grid.shape, dtype=np.int)
+        self.roi_new = np.zeros(self.builder.grid.shape, dtype=label_dtype(0, 1))
         self.roi_new[roi_picked_arr == picked_region] = 1
 
         self.ivm.add(NumpyData(self.roi_new, grid=self.builder.grid, name=self.temp_name, roi=True), make_current=True)
@@ -334,7 +334,7 @@ class WalkerTool(Tool):
         else:
             self.ivl.set_picker(PickMode.SLICE_MULTIPLE)
             
-        self.labels = np.zeros(self.builder.grid.shape, dtype=np.int)
+        self.labels = np.zeros(self.builder.grid.shape, dtype=label_dtype(0, 2))
         self._pick_mode_changed(self.pickmode)
 
     def selected(self):
@@ -401,7 +401,7 @@ class WalkerTool(Tool):
 
         if self.segmode == 0:
             # Create 3D volume using 2D slice
-            seg_3d = np.zeros(self.builder.grid.shape, dtype=np.int)
+            seg_3d = np.zeros(self.builder.grid.shape, dtype=label_dtype(0, 2))
             seg_3d[sl] = seg
             seg = seg_3d
 
@@ -487,7 +487,7 @@ class BucketTool(Tool):
         tile_size = min(50, max_tile_size)
         while 1:
             tile, offset = self._get_tile(src_data, self.point, tile_size, src_data.shape)
-            binarised = ((tile <= thr_hi) & (tile >= thr_lo)).astype(np.int)
+            binarised = (tile <= thr_hi) & (tile >= thr_lo)
             labelled, _ = scipy.ndimage.measurements.label(binarised)
             scipy_label = labelled[self.point[0]-offset[0], self.point[1]-offset[1], self.point[2]-offset[2]]
             labelled[labelled != scipy_label] = 0
@@ -505,7 +505,7 @@ class BucketTool(Tool):
                 break
             tile_size = min(tile_size + 50, max_tile_size)
 
-        self.roi = np.zeros(self.builder.grid.shape, dtype=np.int)
+        self.roi = np.zeros(self.builder.grid.shape, dtype=label_dtype(0, 1))
         tile_shape = labelled.shape
         self.roi[offset[0]:offset[0]+tile_shape[0], offset[1]:offset[1]+tile_shape[1], offset[2]:offset[2]+tile_shape[2]] = labelled
         self.ivm.add(self.roi, name="_temp_bucket", grid=self.builder.grid, roi=True, make_current=True)
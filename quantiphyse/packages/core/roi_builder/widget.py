@@ -29,7 +29,7 @@ try:
 except ImportError:
     from PySide2 import QtGui, QtCore, QtWidgets
 
-from quantiphyse.data import NumpyData
+from quantiphyse.data import NumpyData, label_dtype
 from quantiphyse.gui.options import OptionBox, DataOption, NumericOption, TextOption
 from quantiphyse.gui.widgets import QpWidget, TitleWidget
 from quantiphyse.gui.viewer.pickers import PickMode
@@ -144,6 +144,12 @@ class RoiBuilderWidget(QpWidget):
         label = self.options.option("label").value
         self.debug("label=%i", label)
 
+        if self.roidata.dtype.kind in "iu" and label > np.iinfo(self.roidata.dtype).max:
+            # Label does not fit into the current ROI data type so convert to a larger one
+            roi = self.ivm.data[self.roiname]
+            roi.rawdata = self.roidata.astype(label_dtype(np.min(self.roidata), label))
+            self.roidata = roi.raw()
+
         # For undo functionality: selection is an object specifying which
         # points or ROI region were selected, data_orig is a corresponding
         # object which contains the data before the operation occurred.
@@ -205,6 +211,8 @@ class RoiBuilderWidget(QpWidget):
         ROI regions may have been created or added so regenerate them but put 
         back existing label names
         """
+        # The ROI data has been modified in-place so cached copies derived from it are out of date
+        self.ivm.data[self.roiname].invalidate()
         current_regions = self.ivm.data[self.roiname].metadata.pop("roi_regions", {})
         new_regions = self.ivm.data[self.roiname].regions
         for label, desc in current_regions.items():
@@ -275,7 +283,7 @@ class RoiBuilderWidget(QpWidget):
                 self.options.option("label").value = min(list(regions.keys()) + [1, ])
             self.roiname = roi.name
             self.grid = roi.grid
-            self.roidata = roi.raw()
+            self.roidata = roi.writeable_raw()
 
     def _new_roi(self):
         dialog = QtGui.QDialog(self)
@@ -300,7 +308,7 @@ class RoiBuilderWidget(QpWidget):
             if not roiname or not gridfrom:
                 raise QpException("Must provide a ROI name and a dataset to base it on")
             grid = self.ivm.data[gridfrom].grid
-            roidata = np.zeros(grid.shape, dtype=np.int)
+            roidata = np.zeros(grid.shape, dtype=label_dtype(0, 1))
             self.ivm.add(NumpyData(roidata, grid=grid, roi=True, name=roiname), make_current=True)
 
             # Throw away old history. FIXME is this right, should we keep existing data and history?
@@ -27,6 +27,7 @@ class SmoothingProcess(Process):
     Simple process for Gaussian smoothing
     """
     PROCESS_NAME = "Smooth"
+    CACHEABLE = True
 
     def __init__(self, ivm, **kwargs):
         Process.__init__(self, ivm, **kwargs)
@@ -17,7 +17,8 @@ limitations under the License.
 """
 
 from .process import Process
+from .sharedmem import SharedArray
 from .feat_pca import PcaFeatReduce as PCA
 from . import normalisation
 
-__all__ = ["Process", "PCA", "normalisation"]
+__all__ = ["Process", "SharedArray", "PCA", "normalisation"]
@@ -19,11 +19,13 @@ limitations under the License.
 import os
 
 from quantiphyse.utils import QpException
-from quantiphyse.data import load, save
+from quantiphyse.data import load, save, save_session, load_session
+from quantiphyse.data.loader import default_loader
 
 from .process import Process
 
-__all__ = ["LoadProcess", "LoadDataProcess", "LoadRoisProcess", "SaveProcess", "SaveAllExceptProcess", "SaveDeleteProcess", "SaveArtifactsProcess"]
+__all__ = ["LoadProcess", "LoadDataProcess", "LoadRoisProcess", "SaveProcess", "SaveAllExceptProcess", "SaveDeleteProcess", "SaveArtifactsProcess",
+           "SaveSessionProcess", "LoadSessionProcess"]
 
 class LoadProcess(Process):
     """
@@ -37,27 +39,75 @@ class LoadProcess(Process):
         data = options.pop('data', {})
         # Force 3D data to be multiple 2D volumes 
         force_mv = options.pop('force-multivol', False)
+        # Memory-map data where possible rather than reading it into memory
+        mmap = options.pop('mmap', None)
 
-        for fname, name in list(data.items()) + list(rois.items()):
-            qpdata = self._load_file(fname, name)
-            if qpdata is not None: 
-                if force_mv and qpdata.nvols == 1 and qpdata.grid.shape[2] > 1: 
-                    qpdata.set_2dt()
-                qpdata.roi = fname in rois
-                self.ivm.add(qpdata, make_current=True)
+        # Files are loaded concurrently in the background but are always added to
+        # the IVM in the order they were given
+        files = list(data.items()) + list(rois.items())
+        if not files:
+            return
 
-    def _load_file(self, fname, name):
+        self._file_progress = [0.0] * len(files)
+        self._remaining = len(files)
+        self.status = Process.RUNNING
+        loader = default_loader()
+        requests = []
+        for idx, (fname, name) in enumerate(files):
+            def _load(progress_cb, idx=idx, fname=fname, name=name):
+                def _progress(frac):
+                    progress_cb(frac)
+                    self._file_progress[idx] = frac
+                    self.sig_progress.emit(sum(self._file_progress) / len(files))
+
+                qpdata = self._load_file(fname, name, mmap=mmap, progress_cb=_progress)
+                if qpdata is not None:
+                    if force_mv and qpdata.nvols == 1 and qpdata.grid.shape[2] > 1: 
+                        qpdata.set_2dt()
+                    qpdata.preload()
+                return qpdata
+
+            def _loaded(qpdata, fname=fname, roi=fname in rois):
+                if self.status != Process.RUNNING:
+                    return
+                if qpdata is not None:
+                    try:
+                        if qpdata.name is None:
+                            qpdata.name = self._suggest_name(fname)
+                        qpdata.roi = roi
+                        self.ivm.add(qpdata, make_current=True)
+                    except Exception as exc: # pylint: disable=broad-except
+                        self._load_failed(exc)
+                        return
+                self._remaining -= 1
+                if self._remaining == 0:
+                    self.status = Process.SUCCEEDED
+                    self._complete()
+
+            requests.append(loader.submit(fname, _load, callback=_loaded, errback=self._load_failed))
+
+        if self._sync:
+            loader.wait(requests)
+
+    def _load_failed(self, exc):
+        if self.status == Process.RUNNING:
+            self.status = Process.FAILED
+            self.exception = exc
+            self._complete()
+
+    def _load_file(self, fname, name, mmap=None, progress_cb=None):
         filepath = self._get_filepath(fname)
-        if name is None:
-            name = self.ivm.suggest_name(os.path.split(fname)[1].split(".", 1)[0])
         self.debug("  - Loading data '%s' from %s" % (name, filepath))
         try:
-            data = load(filepath)
+            data = load(filepath, mmap=mmap, progress_cb=progress_cb)
             data.name = name
             return data
         except QpException as exc:
             self.warn("Failed to load data: %s (%s)" % (filepath, str(exc)))
 
+    def _suggest_name(self, fname):
+        return self.ivm.suggest_name(os.path.split(fname)[1].split(".", 1)[0])
+
     def _get_filepath(self, fname, folder=None):
         if os.path.isabs(fname):
             return fname
@@ -176,3 +226,40 @@ class SaveArtifactsProcess(Process):
             if not os.path.exists(dirname): os.makedirs(dirname)
             with open(fname, "w") as text_file:
                 text_file.write(text)
+
+class SaveSessionProcess(Process):
+    """
+    Save all data and extras to a session file, e.g. as a checkpoint in a batch script
+    """
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, **kwargs)
+
+    def run(self, options):
+        fname = options.pop("file", "session.qps")
+        if not os.path.isabs(fname):
+            fname = os.path.join(self.outdir, fname)
+        self.debug("Saving session to %s" % fname)
+        save_session(self.ivm, fname)
+
+class LoadSessionProcess(Process):
+    """
+    Restore a session file, replacing all data and extras
+
+    Relative file names are looked for in the output folder first, so a session saved
+    earlier in a batch script using ``SaveSession`` is found, and then in the input folder
+    """
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, **kwargs)
+
+    def run(self, options):
+        fname = options.pop("file", "session.qps")
+        mmap = options.pop("mmap", True)
+        if not os.path.isabs(fname):
+            if os.path.exists(os.path.join(self.outdir, fname)):
+                fname = os.path.join(self.outdir, fname)
+            else:
+                fname = os.path.join(self.indir, fname)
+        if not os.path.exists(fname):
+            raise QpException("Session file not found: %s" % fname)
+        self.debug("Restoring session from %s" % fname)
+        load_session(self.ivm, fname, mmap=mmap)
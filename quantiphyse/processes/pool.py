@@ -0,0 +1,458 @@
+"""
+Quantiphyse - Shared pool of worker processes for background processes
+
+Starting a pool of worker processes is expensive - each worker must import
+Numpy, Scipy and all the plugins before it can do any work. So rather than
+each background process starting its own pool, a single pool is started when
+first needed and kept for the lifetime of the application.
+
+Progress messages from workers are sent through a single queue which workers
+inherit when they start, rather than a queue managed by a separate server
+process. A background thread in the main process delivers each message to the
+channel of the process which submitted the task.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import atexit
+import itertools
+import logging
+import multiprocessing
+import threading
+
+import six
+from six.moves import queue as singleproc_queue
+
+from quantiphyse.utils import get_plugins, set_local_file_path
+
+LOG = logging.getLogger(__name__)
+
+#: Number of worker processes in the shared pool. If None, the number of CPUs is used
+POOL_SIZE = None
+
+#: Number of cancellation flags shared with the workers. Each open channel uses
+#: one of them. Tasks on channels opened when all are in use cannot be cancelled
+#: until they start
+POOL_CHANNELS = 256
+
+#: Time in seconds allowed for the tasks of a cancelled process to stop before
+#: the worker processes are terminated and replaced, if any of them have started
+CANCEL_TIMEOUT = 0.5
+
+# Queue for progress messages, cancellation flags and the number of tasks running
+# on each channel, inherited by worker processes from the initializer
+_WORKER_QUEUE = None
+_CANCEL_FLAGS = None
+_RUNNING = None
+
+def _worker_initialize(queue=None, cancel_flags=None, running=None):
+    """
+    Initializer function for multiprocessing workers.
+
+    This makes sure plugins are loaded and paths to local files are set
+    """
+    global _WORKER_QUEUE, _CANCEL_FLAGS, _RUNNING
+    _WORKER_QUEUE = queue
+    _CANCEL_FLAGS = cancel_flags
+    _RUNNING = running
+    set_local_file_path()
+    get_plugins()
+
+class TaskCancelled(Exception):
+    """
+    Result of a task which was cancelled before it finished
+    """
+    pass
+
+def _run_task(slot, func, args):
+    """
+    Run a task in a worker process unless it has been cancelled while it was queued
+    """
+    if slot is None or _CANCEL_FLAGS is None:
+        return func(*args)
+
+    # Counted as running before the cancellation flag is checked, so a task is
+    # either seen to be running or will see the flag
+    with _RUNNING.get_lock():
+        _RUNNING[slot] += 1
+    try:
+        if _CANCEL_FLAGS[slot]:
+            raise TaskCancelled()
+        return func(*args)
+    finally:
+        with _RUNNING.get_lock():
+            _RUNNING[slot] -= 1
+
+class WorkerQueue(object):
+    """
+    Queue passed to worker functions for sending progress messages
+
+    Only ``put`` is supported. Instances can be pickled and passed to workers
+    as task arguments. Messages are delivered to the corresponding queue returned
+    by ``WorkerPool.channel()``
+
+    Long-running worker functions should call ``cancelled()`` regularly and return
+    as soon as possible if it returns True.
+    """
+    def __init__(self, channel_id, slot):
+        self._channel_id = channel_id
+        self._slot = slot
+
+    def put(self, msg, *args, **kwargs):
+        """
+        Send a message to the process which submitted the task
+        """
+        if _WORKER_QUEUE is not None:
+            _WORKER_QUEUE.put((self._channel_id, msg))
+
+    def cancelled(self):
+        """
+        :return: True if the process which submitted the task has been cancelled
+        """
+        return _CANCEL_FLAGS is not None and self._slot is not None and bool(_CANCEL_FLAGS[self._slot])
+
+class LocalQueue(singleproc_queue.Queue):
+    """
+    Queue passed to worker functions which are run in the main process
+
+    Supports ``cancelled()`` in the same way as ``WorkerQueue``
+    """
+    def __init__(self):
+        singleproc_queue.Queue.__init__(self)
+        self._cancelled = False
+
+    def cancel(self):
+        """
+        Flag the worker as cancelled
+        """
+        self._cancelled = True
+
+    def cancelled(self):
+        """
+        :return: True if the process running the worker has been cancelled
+        """
+        return self._cancelled
+
+class _SafeCallback(object):
+    """
+    Wrapper for a task callback which catches exceptions
+    """
+    def __init__(self, callback):
+        self._callback = callback
+
+    def __call__(self, result):
+        try:
+            self._callback(result)
+        except Exception: # pylint: disable=broad-except
+            LOG.exception("Error handling result of background task")
+
+class Task(object):
+    """
+    Task submitted to a WorkerPool
+
+    Provides the same methods as ``multiprocessing.pool.AsyncResult``. Tasks remain
+    valid if the worker processes are replaced and the task is resubmitted.
+
+    :ivar restarts: Number of times the task has been interrupted and started again
+                    from the beginning because the worker processes were replaced
+    """
+    def __init__(self, channel_id, slot, func, args, callback):
+        self.channel_id = channel_id
+        self.slot = slot
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.result = None
+        self.pool = None
+        self.cancelled = False
+        self.restarts = 0
+
+    def ready(self):
+        """
+        :return: True if the task has finished or been cancelled
+        """
+        return self.cancelled or self.result.ready()
+
+    def successful(self):
+        """
+        :return: True if the task finished without raising an exception
+        """
+        return not self.cancelled and self.result.successful()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the task to finish or be cancelled
+        """
+        start = time.time()
+        while not self.ready():
+            if timeout is not None and time.time() - start > timeout:
+                break
+            # The result is replaced if the task is resubmitted so wait in short steps
+            self.result.wait(0.1)
+
+    def get(self, timeout=None):
+        """
+        :return: Return value of the task. ``TaskCancelled`` is raised if it was cancelled
+        """
+        self.wait(timeout)
+        if self.cancelled:
+            raise TaskCancelled()
+        return self.result.get(0)
+
+class WorkerPool(object):
+    """
+    Pool of worker processes shared by all background processes
+    """
+
+    def __init__(self, size=None):
+        """
+        :param size: Number of worker processes. Defaults to ``POOL_SIZE`` or the number of CPUs
+        """
+        if size is None:
+            size = POOL_SIZE
+        if size is None:
+            size = multiprocessing.cpu_count()
+        self.size = size
+        self._cancel_flags = multiprocessing.RawArray("b", POOL_CHANNELS)
+        self._free_slots = list(range(POOL_CHANNELS))
+        self._channels = {}
+        self._slots = {}
+        self._channel_ids = itertools.count()
+        self._tasks = []
+        self._lock = threading.RLock()
+        self._start()
+
+    def _start(self):
+        """
+        Start the worker processes and the thread which receives their messages
+        """
+        self._queue = multiprocessing.Queue()
+        # Each set of workers has its own counts, as workers which are terminated
+        # while running a task never decrement them
+        self._running = multiprocessing.Array("i", POOL_CHANNELS)
+        self._pool = multiprocessing.Pool(self.size, initializer=_worker_initialize,
+                                          initargs=(self._queue, self._cancel_flags, self._running))
+        listener = threading.Thread(target=self._listen, args=(self._queue,))
+        listener.daemon = True
+        listener.start()
+
+    def apply_async(self, func, args=(), callback=None, channel=None):
+        """
+        Submit a task to the pool
+
+        :param callback: Called in a background thread of the main process with the
+                         return value of ``func``. Exceptions raised by the callback are
+                         logged rather than stopping the pool from handling further results
+        :param channel: ``WorkerQueue`` for the channel the task belongs to. Tasks on a
+                        channel can be cancelled using ``cancel()``
+        :return: :class:`Task`
+        """
+        if callback is not None:
+            callback = _SafeCallback(callback)
+        if channel is not None:
+            task = Task(channel._channel_id, channel._slot, func, args, callback)
+        else:
+            task = Task(None, None, func, args, callback)
+        with self._lock:
+            if not six.PY3:
+                # No error callback so failed tasks are only removed here
+                for other in [other for other in self._tasks if other.ready()]:
+                    self._finished(other)
+            self._tasks.append(task)
+            self._submit(task)
+        return task
+
+    def _submit(self, task):
+        def _done(result):
+            self._finished(task)
+            if task.callback is not None:
+                task.callback(result)
+
+        kwargs = {"callback" : _done}
+        if six.PY3:
+            kwargs["error_callback"] = lambda exc: self._finished(task)
+        task.pool = self._pool
+        task.result = self._pool.apply_async(_run_task, (task.slot, task.func, task.args), **kwargs)
+
+    def _finished(self, task):
+        """
+        Forget a task which has finished, releasing its arguments
+        """
+        with self._lock:
+            if task in self._tasks:
+                self._tasks.remove(task)
+            task.func, task.args = None, None
+            self._release_slot(task.channel_id)
+
+    def _release_slot(self, channel_id):
+        """
+        Make the cancellation flag of a closed channel available for reuse once
+        none of its tasks are queued or running
+        """
+        if channel_id is None or channel_id in self._channels or channel_id not in self._slots:
+            return
+        if any([task.channel_id == channel_id for task in self._tasks]):
+            return
+        slot = self._slots.pop(channel_id)
+        if slot is not None:
+            self._free_slots.append(slot)
+
+    def channel(self):
+        """
+        Open a channel for progress messages from tasks
+
+        :return: Tuple of ``WorkerQueue`` to pass to worker functions and local queue
+                 from which the messages they send can be read. The channel should be
+                 closed using ``close_channel`` when no longer required
+        """
+        local_queue = singleproc_queue.Queue()
+        with self._lock:
+            channel_id = next(self._channel_ids)
+            self._channels[channel_id] = local_queue
+            if self._free_slots:
+                slot = self._free_slots.pop(0)
+                self._cancel_flags[slot] = 0
+            else:
+                LOG.warning("No cancellation flags available - tasks on channel %i cannot be cancelled until they start", channel_id)
+                slot = None
+            self._slots[channel_id] = slot
+        return WorkerQueue(channel_id, slot), local_queue
+
+    def close_channel(self, worker_queue):
+        """
+        Close a channel. Further messages sent to it are discarded
+        """
+        with self._lock:
+            self._channels.pop(worker_queue._channel_id, None)
+            self._release_slot(worker_queue._channel_id)
+
+    def cancel(self, worker_queue, timeout=None):
+        """
+        Cancel the tasks on a channel
+
+        Tasks which have not started are not run. Running tasks can check for
+        cancellation using ``WorkerQueue.cancelled()``. If any have started and are
+        still running after ``timeout`` seconds (default ``CANCEL_TIMEOUT``) the worker
+        processes are terminated and replaced. Unfinished tasks on other channels are
+        then resubmitted and their ``restarts`` count incremented. Tasks which are
+        only queued finish as cancelled when they reach a worker, so the workers are
+        not replaced for them.
+
+        This method returns immediately
+        """
+        if timeout is None:
+            timeout = CANCEL_TIMEOUT
+        channel_id = worker_queue._channel_id
+        if worker_queue._slot is not None:
+            self._cancel_flags[worker_queue._slot] = 1
+        timer = threading.Timer(timeout, self._terminate_cancelled, args=(channel_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _terminate_cancelled(self, channel_id):
+        with self._lock:
+            running = [task for task in self._tasks if task.channel_id == channel_id and not task.ready()]
+            if not running or self._pool is None:
+                return
+
+            slot = running[0].slot
+            if slot is not None and self._running[slot] == 0:
+                LOG.debug("%i cancelled tasks are queued but none have started", len(running))
+                return
+
+            LOG.debug("%i cancelled tasks still running - replacing worker processes", len(running))
+            for task in running:
+                task.cancelled = True
+                self._finished(task)
+            pool = self._pool
+            self._start()
+
+        # Terminating the pool waits for its result handler, which calls _finished, so
+        # the lock must not be held. A single worker cannot be replaced safely because
+        # it may hold the locks on the pool's internal queues
+        pool.terminate()
+
+        with self._lock:
+            # Tasks which were interrupted are started again from the beginning
+            interrupted = [task for task in self._tasks if task.pool is pool and not task.ready()]
+            if interrupted:
+                LOG.warning("Restarting %i tasks on channels %s which were interrupted by cancelling channel %i",
+                            len(interrupted), sorted(set([task.channel_id for task in interrupted])), channel_id)
+            for task in interrupted:
+                task.restarts += 1
+                self._submit(task)
+
+    def terminate(self):
+        """
+        Stop the worker processes immediately
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            for task in list(self._tasks):
+                if not task.ready():
+                    task.cancelled = True
+                self._finished(task)
+        if pool is not None:
+            pool.terminate()
+            self._queue.put(None)
+
+    def _listen(self, queue):
+        while True:
+            try:
+                item = queue.get(timeout=1)
+            except singleproc_queue.Empty:
+                if queue is not self._queue:
+                    # Worker processes have been replaced
+                    break
+                continue
+            except (EOFError, IOError, OSError, ValueError):
+                break
+            if item is None:
+                break
+            channel_id, msg = item
+            with self._lock:
+                local_queue = self._channels.get(channel_id, None)
+            if local_queue is not None:
+                local_queue.put(msg)
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    """
+    Get the shared worker pool, starting it if required
+
+    :return: ``WorkerPool`` instance
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            LOG.debug("Starting worker pool")
+            _POOL = WorkerPool()
+            atexit.register(shutdown_pool)
+        return _POOL
+
+def shutdown_pool():
+    """
+    Stop the shared worker pool if it has been started. A new pool will be
+    started if it is needed again
+    """
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        LOG.debug("Stopping worker pool")
+        pool.terminate()
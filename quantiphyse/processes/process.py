@@ -13,13 +13,10 @@ Copyright (c) 2013-2018 University of Oxford
 """
 
 import os
-import multiprocessing
-import multiprocessing.pool
 import threading
 import traceback
 import logging
 import re
-from six.moves import queue as singleproc_queue
 
 import numpy as np
 try:
@@ -28,7 +25,11 @@ except ImportError:
     from PySide2 import QtGui, QtCore, QtWidgets
 
 from quantiphyse.data import NumpyData, save
-from quantiphyse.utils import LogSource, QpException, get_plugins, set_local_file_path
+from quantiphyse.utils import LogSource, QpException
+
+from . import result_cache
+from .pool import get_pool, LocalQueue, TaskCancelled
+from .sharedmem import HAVE_SHARED_MEMORY, SharedArray, SharedOutputWorker, can_share
 
 #: Axis to split along when splitting up data sets for multiprocessing
 #: Could be 0, 1 or 2, but 0 is probably optimal for Numpy arrays which are column-major by default
@@ -37,20 +38,17 @@ SPLIT_AXIS = 0
 #: Whether to use multiprocessing - can be disabled for debugging
 MULTIPROC = True
 
+#: Ways of splitting data between background workers. See ``Process.__init__``
+CHUNKING_MODES = ("equal", "slab", "voxels")
+
+#: Number of chunks per worker when data is split into chunks which are scheduled dynamically
+CHUNKS_PER_WORKER = 4
+
 # Guard against processes which fail with massive logfiles
 MAX_LOG_SIZE=100000
 
 LOG = logging.getLogger(__name__)
 
-def _worker_initialize():
-    """
-    Initializer function for multiprocessing workers.
-    
-    This makes sure plugins are loaded and paths to local files are set
-    """
-    set_local_file_path()
-    get_plugins()
-
 class Process(QtCore.QObject, LogSource):
     """
     A data processing task
@@ -126,6 +124,11 @@ class Process(QtCore.QObject, LogSource):
     SUCCEEDED = 3
     CANCELLED = 4
 
+    #: Whether the results of the process can be cached (see ``execute``). This should
+    #: only be set for processes whose output data and extras depend only on their
+    #: options and the data and extras in the IVM, and which do not read or write files
+    CACHEABLE = False
+
     def __init__(self, ivm, **kwargs):
         """
         :param ivm: ImageVolumeManagement object
@@ -142,7 +145,18 @@ class Process(QtCore.QObject, LogSource):
                           It should return ``id``, True/False ``success`` and
                           an output object. If ``success=False`` the output
                           object should be an exception. Otherwise it can
-                          be any pickleable object (e.g. Numpy array)
+                          be any pickleable object (e.g. Numpy array).
+                          Long-running workers should regularly check
+                          ``queue.cancelled()`` and return if it is True
+        :param chunking: How ``start_bg`` splits Numpy arrays between workers. ``equal``
+                         (default) splits them into one equal slab along ``SPLIT_AXIS``
+                         per worker. ``slab`` splits them into ``CHUNKS_PER_WORKER``
+                         times as many slabs, each containing a similar number of
+                         voxels in the ROI. ``voxels`` passes workers lists of voxels
+                         in the ROI, i.e. arrays of shape [NVOXELS, ...], in equal
+                         sized chunks. In both of the latter cases chunks are started as
+                         workers become free, so the work is balanced even if some
+                         chunks take longer than others
         """
         QtCore.QObject.__init__(self)
         LogSource.__init__(self)
@@ -166,6 +180,16 @@ class Process(QtCore.QObject, LogSource):
         self._pool = None
         self._worker_output = []
         self._queue = None
+        self._worker_queue = None
+        self._shared_arrays = []
+        self._chunking = kwargs.get("chunking", "equal")
+        self._chunk_roi = None
+        self._cache_key = None
+        self._cache_state = None
+        self._from_cache = False
+        self._cached_output_items = None
+        if self._chunking not in CHUNKING_MODES:
+            raise QpException("Unknown chunking mode: %s" % self._chunking)
 
     def execute(self, options):
         """
@@ -190,6 +214,12 @@ class Process(QtCore.QObject, LogSource):
         call ``execute()`` instead so all the error handling can be in
         the ``sig_finished`` handler.
 
+        If the ``cache`` option is True and the process is ``CACHEABLE``, the
+        results are stored in the result cache (see
+        :mod:`quantiphyse.processes.result_cache`). If the process has already
+        been run with the same options on the same IVM contents, its output data
+        and extras are restored from the cache instead and ``run()`` is not called.
+
         :param options: Dictionary of process options
         """
         self.debug("Executing %s", self.proc_id)
@@ -197,8 +227,15 @@ class Process(QtCore.QObject, LogSource):
         self._log = ""
         self.exception = object()
         self._completed = False
+        self._cache_key = None
+        self._cache_state = None
+        self._from_cache = False
+        self._cached_output_items = None
         try:
-            self.run(options)
+            if options.pop("cache", False) and self.CACHEABLE:
+                self._restore_cached(options)
+            if not self._from_cache:
+                self.run(options)
             if self.status == self.NOTSTARTED:
                 self.status = self.SUCCEEDED
         except Exception as exc:
@@ -215,6 +252,79 @@ class Process(QtCore.QObject, LogSource):
         else:
             self.debug("Async process running - will wait")
 
+    def _ivm_state(self):
+        """
+        :return: Tuple of dictionaries of the current version of each data item and
+                 extra in the IVM, so changes made by the process can be found
+        """
+        data = dict([(name, (qpd, qpd._generation)) for name, qpd in self.ivm.data.items()])
+        return data, dict(self.ivm.extras)
+
+    def _restore_cached(self, options):
+        """
+        Restore the results of the process from the cache if available. Otherwise
+        record the state of the IVM so the results can be cached when the process
+        completes
+        """
+        try:
+            self._cache_key = result_cache.cache_key(self, options)
+            cached = result_cache.lookup(self._cache_key)
+        except Exception as exc: # pylint: disable=broad-except
+            self.warn("Failed to read cached results: %s", exc)
+            self._cache_key = None
+            return
+
+        if cached is None:
+            self._cache_state = self._ivm_state()
+            return
+
+        self.debug("Restoring cached results for %s", self.proc_id)
+        data, extras, info = cached
+        for name in info["deleted"]:
+            if name in self.ivm.data:
+                self.ivm.delete(name)
+        for qpd in data:
+            view = dict(qpd.view)
+            self.ivm.add(qpd, make_current=False)
+            # Restore view parameters which adding data may change
+            qpd.view.update(view)
+        for name, extra in extras:
+            self.ivm.add_extra(name, extra)
+        if info["main"] in self.ivm.data:
+            self.ivm.set_main_data(info["main"])
+        if info["current_data"] in self.ivm.data:
+            self.ivm.set_current_data(info["current_data"])
+        if info["current_roi"] in self.ivm.data:
+            self.ivm.set_current_roi(info["current_roi"])
+
+        self._cached_output_items = list(info["output_items"])
+        self.log(info["log"])
+        self._cache_key = None
+        self._from_cache = True
+        self.status = self.SUCCEEDED
+
+    def _store_cached(self):
+        """
+        Store the data and extras which the process has added or changed in the cache
+        """
+        try:
+            old_data, old_extras = self._cache_state
+            new_data, new_extras = self._ivm_state()
+            data = [qpd for name, (qpd, generation) in new_data.items()
+                    if name not in old_data or old_data[name][0] is not qpd or old_data[name][1] != generation]
+            extras = [(name, extra) for name, extra in new_extras.items() if old_extras.get(name, None) is not extra]
+            info = {
+                "deleted" : [name for name in old_data if name not in new_data],
+                "main" : self.ivm.main.name if self.ivm.main is not None else None,
+                "current_data" : self.ivm.current_data.name if self.ivm.current_data is not None else None,
+                "current_roi" : self.ivm.current_roi.name if self.ivm.current_roi is not None else None,
+                "output_items" : list(self.get_output_data_items()),
+                "log" : self._log,
+            }
+            result_cache.store(self._cache_key, data, extras, info)
+        except Exception as exc: # pylint: disable=broad-except
+            self.warn("Failed to cache results: %s", exc)
+
     def get_data(self, options, multi=False):
         """ 
         Standard method to get the data object the process is to operate on 
@@ -246,13 +356,13 @@ class Process(QtCore.QObject, LogSource):
             for data_item in multi_data:
                 if grid is None:
                     grid = data_item.grid
-                    data = np.zeros(list(grid.shape) + [nvols,])
+                    # Float data is stored as float32 so avoid a float64 intermediate copy
+                    data = np.empty(list(grid.shape) + [nvols,], dtype=np.float32)
                 data_item = data_item.resample(grid)
                 if data_item.nvols == 1:
-                    rawdata = np.expand_dims(data_item.raw(), 3)
+                    data[..., num_vols] = data_item.raw()
                 else:
-                    rawdata = data_item.raw()
-                data[..., num_vols:num_vols+data_item.nvols] = rawdata
+                    data[..., num_vols:num_vols+data_item.nvols] = data_item.raw()
                 num_vols += data_item.nvols
             data = NumpyData(data, grid=grid, name="multi_data")
         else:
@@ -280,7 +390,7 @@ class Process(QtCore.QObject, LogSource):
             if use_current and self.ivm.current_roi is not None:
                 roidata = self.ivm.current_roi
             elif grid is not None:
-                roidata = NumpyData(np.ones(grid.shape[:3]), grid=grid, name="dummy_roi", roi=True)
+                roidata = NumpyData(np.ones(grid.shape[:3], dtype=np.uint8), grid=grid, name="dummy_roi", roi=True)
             else:
                 return None
         else:
@@ -327,11 +437,27 @@ class Process(QtCore.QObject, LogSource):
         """
         Optional method allowing a Process to indicate what data items it produced after completion
 
+        Code which runs the process should call ``get_output_data_items()`` instead
+
         :return: a sequence of data item names that were output
         """
         return []
 
-    def start_bg(self, args, n_workers=1):
+    def get_output_data_items(self):
+        """
+        Get the data items produced by the last call to ``execute()``
+
+        Subclasses normally find their outputs from attributes set in ``run()``, which is
+        not called when the results are restored from the cache, so this should be used
+        rather than ``output_data_items()`` by code which calls ``execute()``
+
+        :return: a sequence of data item names that were output
+        """
+        if self._cached_output_items is not None:
+            return list(self._cached_output_items)
+        return self.output_data_items()
+
+    def start_bg(self, args, n_workers=1, roi=None):
         """
         Start a set of background workers
         
@@ -339,47 +465,75 @@ class Process(QtCore.QObject, LogSource):
         worker run function.
 
         :param args: Sequence of arguments to the worker run function. All must be pickleable objects
+        :param n_workers: Number of parallel workers. With ``slab`` or ``voxels`` chunking the
+                          data is split into more chunks than this, and the worker ID passed to
+                          the worker function is the index of the chunk
+        :param roi: Numpy array of the ROI being processed, if any. Required for ``voxels``
+                    chunking and used to balance the slabs for ``slab`` chunking. Arrays
+                    are split in the same way whether or not the ROI is one of ``args``.
+                    With ``slab`` chunking, array arguments must be the same size as the
+                    ROI along ``SPLIT_AXIS`` so that every argument is split with the
+                    same slab boundaries
         """
         # Only for background processes
-        self._pool, self._queue = self._init_multiproc(n_workers)
+        self._chunk_roi = np.asarray(roi) if roi is not None else None
+        if self._chunking == "voxels" and self._chunk_roi is None:
+            raise QpException("An ROI is required to split data into voxels")
+        self._pool, self._worker_queue, self._queue = self._init_multiproc(n_workers)
         
         worker_args = self.split_args(n_workers, args)
+        n_workers = len(worker_args)
         self._worker_output = [None, ] * n_workers
         self.status = Process.RUNNING
 
         if self._multiproc:
+            worker_fn = self._worker_fn
+            if HAVE_SHARED_MEMORY:
+                worker_fn = SharedOutputWorker(worker_fn)
             self._workers = []
             for i in range(n_workers):
                 self.debug("Starting task %i/%s...", i+1, n_workers)
-                proc = self._pool.apply_async(self._worker_fn, worker_args[i], callback=self._worker_finished_cb)
+                proc = self._pool.apply_async(worker_fn, worker_args[i], callback=self._worker_finished_cb,
+                                              channel=self._worker_queue)
                 self._workers.append(proc)
             
             if self._sync:
                 self.debug("Running background task synchronously")
-                for i in range(n_workers):
-                    self._workers[i].get()
+                # Finished workers are removed from self._workers by the callback
+                for proc in list(self._workers):
+                    if proc is not None:
+                        try:
+                            proc.get()
+                        except TaskCancelled:
+                            pass
             else:
                 self._restart_timer()
         else:
+            self._workers = [None,] * n_workers
             for i in range(n_workers):
                 result = self._worker_fn(*worker_args[i])
                 self.timeout(self._queue)
-                if QtGui.qApp is not None: QtGui.qApp.processEvents()
+                if QtCore.QCoreApplication.instance() is not None:
+                    QtCore.QCoreApplication.instance().processEvents()
                 self._worker_finished_cb(result)
                 if self.status != Process.RUNNING: 
                     break
 
     def _init_multiproc(self, num_tasks):
+        """
+        :return: Tuple of worker pool, queue to pass to workers and queue to read
+                 their messages from. The pool is shared by all processes and
+                 kept running between them
+        """
         if self._multiproc:
-            LOG.debug("Initializing multiprocessing")
-            queue = multiprocessing.Manager().Queue()
-            pool_size = min(num_tasks, multiprocessing.cpu_count())
-            pool = multiprocessing.Pool(pool_size, initializer=_worker_initialize)
+            LOG.debug("Using shared worker pool")
+            pool = get_pool()
+            worker_queue, queue = pool.channel()
         else:
             LOG.debug("Not using multiprocessing")
-            queue = singleproc_queue.Queue()
-            pool = None
-        return pool, queue
+            queue = LocalQueue()
+            worker_queue, pool = queue, None
+        return pool, worker_queue, queue
 
     def cancel(self):
         """
@@ -388,22 +542,25 @@ class Process(QtCore.QObject, LogSource):
         if self.status == Process.RUNNING:
             self.status = Process.CANCELLED
             self.exception = Exception("Process was cancelled")
-            if self._multiproc:
-                # FIXME this does not work. Not incredibly harmful because
-                # with status set to CANCELLED results are ignored anyway.
-                # But workers will continue to work. Maybe look into
-                # abortable_worker solution?
-                pass
-                #for p in self._workers:
-                #    p.terminate()
-                #    p.join(timeout=1.0)
-            else:
-                # Just setting the status is enough - no more workers
-                # will be started
-                pass
+            self._cancel_workers()
 
         self._complete()
 
+    def _cancel_workers(self):
+        """
+        Stop any workers which are still running
+
+        Workers which have not started are not run. Workers which are running
+        are terminated if they do not return promptly after ``queue.cancelled()``
+        becomes True. Without multiprocessing no more workers will be started
+        once the status is not RUNNING
+        """
+        pool, worker_queue = self._pool, self._worker_queue
+        if pool is not None and worker_queue is not None:
+            pool.cancel(worker_queue)
+        elif isinstance(worker_queue, LocalQueue):
+            worker_queue.cancel()
+
     def timeout(self, queue):
         """
         Called every 1s while the process is running. 
@@ -438,23 +595,103 @@ class Process(QtCore.QObject, LogSource):
 
         Note that this can be overridden to customize splitting behaviour
         
+        Large Numpy arrays are passed to worker processes in shared memory rather than
+        being pickled, if supported. A :class:`SharedArray` can also be passed to
+        allow workers to write their output directly into their part of it. Shared
+        memory is freed when the process completes, however the ``array`` attribute
+        of a SharedArray remains valid.
+
         :param args: Sequence of arguments to the worker run function. All must be pickleable objects.
                      By default Numpy arrays will be split along SPLIT_AXIS and a chunk passed to each
-                     worker.
+                     worker. See the ``chunking`` option to ``Process.__init__`` for other ways of
+                     splitting them.
         :param n_workers: Number of parallel worker processes to use
+        :return: Sequence containing the arguments for each worker
         """
+        n_chunks, sections, axis, length = self._chunks(n_workers)
+
         # First argument is worker ID, second is queue
-        split_args = [list(range(n_workers)), [self._queue,] * n_workers]
+        split_args = [list(range(n_chunks)), [self._worker_queue,] * n_chunks]
 
         for arg in args:
-            if isinstance(arg, (np.ndarray, np.generic)):
-                split_args.append(np.array_split(arg, n_workers, SPLIT_AXIS))
+            if self._chunking == "voxels" and self._on_roi_grid(arg):
+                arg = arg[self._chunk_roi > 0]
+
+            arg_sections = None
+            if isinstance(arg, (np.ndarray, np.generic, SharedArray)):
+                arg_sections = self._arg_sections(arg, n_chunks, sections, axis, length)
+
+            if arg_sections is None:
+                split_args.append([arg,] * n_chunks)
+            elif isinstance(arg, SharedArray):
+                self._shared_arrays.append(arg)
+                if self._multiproc:
+                    split_args.append(arg.split(arg_sections, axis))
+                else:
+                    split_args.append(np.array_split(arg.array, arg_sections, axis))
+            elif self._multiproc and can_share(arg):
+                shared = SharedArray.from_array(arg)
+                self._shared_arrays.append(shared)
+                split_args.append(shared.split(arg_sections, axis))
             else:
-                split_args.append([arg,] * n_workers)
+                split_args.append(np.array_split(arg, arg_sections, axis))
 
         # Transpose list of lists so first element is all the arguments for process 0, etc
         return list(map(list, zip(*split_args)))
 
+    def _chunks(self, n_workers):
+        """
+        Decide how to split arrays between workers
+
+        :return: Tuple of number of chunks, sections to split arrays into as accepted by
+                 ``np.array_split``, axis to split along and the length of arrays along
+                 this axis which the sections apply to, or None if they apply to any array
+        """
+        if self._chunking == "equal":
+            return n_workers, n_workers, SPLIT_AXIS, None
+
+        n_chunks = max(1, n_workers * CHUNKS_PER_WORKER)
+        roi = self._chunk_roi
+        if self._chunking == "voxels":
+            nvoxels = np.count_nonzero(roi)
+            n_chunks = max(1, min(n_chunks, nvoxels))
+            return n_chunks, n_chunks, 0, nvoxels
+        elif roi is None or roi.ndim <= SPLIT_AXIS:
+            return n_chunks, n_chunks, SPLIT_AXIS, None
+
+        # Slabs containing similar numbers of ROI voxels. Every slice has a small
+        # weight so slices outside the ROI are also divided between the chunks
+        other_axes = tuple([axis for axis in range(roi.ndim) if axis != SPLIT_AXIS])
+        weights = np.count_nonzero(roi, axis=other_axes) + 1
+        cumulative = np.cumsum(weights)
+        targets = cumulative[-1] * np.arange(1, n_chunks) / n_chunks
+        bounds = np.unique(np.clip(np.searchsorted(cumulative, targets) + 1, 1, len(weights)-1))
+        bounds = [int(bound) for bound in bounds if 0 < bound < len(weights)]
+        return len(bounds) + 1, bounds, SPLIT_AXIS, len(weights)
+
+    def _arg_sections(self, arg, n_chunks, sections, axis, length):
+        """
+        :return: Sections to split an array argument into, or None if every worker
+                 should get the whole array
+        """
+        shape = np.shape(arg.array if isinstance(arg, SharedArray) else arg)
+        if length is None or (len(shape) > axis and shape[axis] == length):
+            return sections
+        elif self._chunking == "voxels":
+            # Not a list of voxels
+            return None
+        else:
+            # Slabs are balanced for the ROI so would not line up with slabs of this array
+            raise QpException("Array argument with shape %s does not match the ROI so cannot be split into slabs" % list(shape))
+
+    def _on_roi_grid(self, arg):
+        """
+        :return: True if an argument is a Numpy array whose leading dimensions match the ROI
+        """
+        roi = self._chunk_roi
+        return (isinstance(arg, np.ndarray) and roi is not None and arg.ndim >= roi.ndim
+                and arg.shape[:roi.ndim] == roi.shape)
+
     def recombine_data(self, data_list):
         """
         Recombine a sequence of data items into a single data item
@@ -479,6 +716,12 @@ class Process(QtCore.QObject, LogSource):
             else:
                 real_data.append(data_item)
         
+        if self._chunking == "voxels" and self._chunk_roi is not None:
+            # Put voxels back in their positions in the ROI
+            voxels = np.concatenate(real_data, 0)
+            data = np.zeros(self._chunk_roi.shape + voxels.shape[1:], dtype=voxels.dtype)
+            data[self._chunk_roi > 0] = voxels
+            return data
         return np.concatenate(real_data, SPLIT_AXIS)
 
     def save_output(self, save_folder):
@@ -486,11 +729,11 @@ class Process(QtCore.QObject, LogSource):
         Save process output to a folder
 
         In practice this is very process dependent and this method may well need to be
-        overridden. The default implementation uses the ``output_data_items()`` to
+        overridden. The default implementation uses the ``get_output_data_items()`` to
         get the names of the data items the process has created and writes these
         plus the logfile to the output folder
         """
-        data_to_save = self.output_data_items()
+        data_to_save = self.get_output_data_items()
         self.debug("Data to save: %s", data_to_save)    
         for d in data_to_save:
             qpdata = self.ivm.data.get(d, None)
@@ -515,20 +758,32 @@ class Process(QtCore.QObject, LogSource):
         self._completed = True
         if self.status == self.SUCCEEDED:
             try:
-                self.finished(self._worker_output)
+                if not self._from_cache:
+                    self.finished(self._worker_output)
                 self.sig_progress.emit(1)
             except Exception as exc:
                 self.status = self.FAILED
                 self.exception = exc
+
+        if self.status == self.SUCCEEDED and self._cache_key is not None:
+            self._store_cached()
+        self._cache_key = None
+        self._cache_state = None
             
         # Get rid of all references to multprocessing workers and their output
-        # this is necessary to avoid memory and process leakage
+        # this is necessary to avoid memory leakage. The pool itself is shared
+        # and kept running for the next process
         if self._pool is not None:
-            self._pool.close()
+            self._pool.close_channel(self._worker_queue)
         self._pool = None
         self._workers = []
         self._queue = None
+        self._worker_queue = None
         self._worker_output = []
+        for shared in self._shared_arrays:
+            shared.release()
+        self._shared_arrays = []
+        self._chunk_roi = None
         self.debug("Emitting sig_finished")
         self.sig_finished.emit(self.status, self._log, self.exception)
         self._completed = True
@@ -569,10 +824,10 @@ class Process(QtCore.QObject, LogSource):
                     self.status = Process.SUCCEEDED
         else:
             # If one process fails, they all fail. Output is just the first exception to be caught
-            # FIXME cancel other workers?
             # FIXME log capture is ugly - better to have 'sig_failed' callback
             self.status = Process.FAILED
             self.exception = output
+            self._cancel_workers()
             if hasattr(output, "log"):
                 self.log(output.log[:MAX_LOG_SIZE])
                 if len(output.log) > MAX_LOG_SIZE:
@@ -0,0 +1,226 @@
+"""
+Quantiphyse - On-disk cache of the results of processes
+
+Results are keyed by the process class, its options and fingerprints of the
+contents of the data and extras it uses when it is run. These are the items
+named by its options (e.g. ``data``, ``roi`` and ``grid``) and the main data,
+current data and current ROI, which processes use by default. If a process is
+run again with the same options on the same data, its output data and extras
+can be restored from the cache instead of being recomputed.
+
+Each set of results is stored in session format (see
+:mod:`quantiphyse.data.session`) so the data can be memory-mapped when it
+is restored. The least recently used results are removed when the total size
+of the cache exceeds ``RESULT_CACHE_MAX_SIZE``.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import glob
+import pickle
+import hashlib
+import logging
+
+import six
+import numpy as np
+
+from quantiphyse.data import QpData
+from quantiphyse.data.session import save_items, load_items
+
+LOG = logging.getLogger(__name__)
+
+#: Directory in which process results are cached. Set to None to disable the cache
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".quantiphyse", "process_cache")
+
+#: Maximum total size in bytes of cached results
+RESULT_CACHE_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+#: Version of the cache key. Results cached with a different version are not used
+RESULT_CACHE_VERSION = 2
+
+#: File extension of cached results
+RESULT_CACHE_EXT = ".qps"
+
+class _Uncacheable(Exception):
+    """
+    Raised when an option value or extra cannot be fingerprinted
+    """
+    pass
+
+def _hash(data):
+    hasher = getattr(hashlib, "blake2b", hashlib.sha1)()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+def _normalize(value):
+    """
+    :return: String representation of an option value which is the same for
+             equivalent values, e.g. dictionaries with keys in a different order
+    """
+    if isinstance(value, dict):
+        items = sorted(["%s: %s" % (_normalize(key), _normalize(item)) for key, item in value.items()])
+        return "{%s}" % ", ".join(items)
+    elif isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join([_normalize(item) for item in value])
+    elif isinstance(value, QpData):
+        return "QpData(%s)" % value.fingerprint()
+    elif isinstance(value, np.ndarray):
+        return "ndarray(%s, %s, %s)" % (value.dtype.str, list(value.shape),
+                                        _hash(np.ascontiguousarray(value).tobytes()))
+    elif isinstance(value, np.generic):
+        return _normalize(value.item())
+    elif isinstance(value, six.string_types):
+        return "'%s'" % value
+    elif type(value).__repr__ is object.__repr__:
+        # Default representation contains the object's address, not its contents
+        raise _Uncacheable("Cannot fingerprint option value: %s" % type(value).__name__)
+    else:
+        return repr(value)
+
+def _option_strings(value):
+    """
+    :return: Set of all the strings in an option value, e.g. names of data items
+    """
+    if isinstance(value, six.string_types):
+        return set([value])
+    elif isinstance(value, dict):
+        return set().union(*[_option_strings(item) for item in list(value.keys()) + list(value.values())])
+    elif isinstance(value, (list, tuple)):
+        return set().union(*[_option_strings(item) for item in value])
+    return set()
+
+def _ivm_fingerprint(ivm, options):
+    """
+    :return: String containing which items are selected in the IVM and fingerprints
+             of the selected items and the data and extras named by the options
+    """
+    names = _option_strings(options)
+    parts = []
+    for selected in ("main", "current_data", "current_roi"):
+        qpd = getattr(ivm, selected)
+        parts.append("%s: %s" % (selected, qpd.name if qpd is not None else None))
+        if qpd is not None:
+            names.add(qpd.name)
+
+    for name in sorted(names):
+        if name in ivm.data:
+            parts.append("data %s: %s" % (name, ivm.data[name].fingerprint()))
+        if name in ivm.extras:
+            try:
+                parts.append("extra %s: %s" % (name, _hash(pickle.dumps(ivm.extras[name], protocol=2))))
+            except Exception as exc:
+                raise _Uncacheable("Cannot fingerprint extra %s: %s" % (name, exc))
+    return "\n".join(parts)
+
+def cache_key(process, options):
+    """
+    Get the key for caching the results of a process
+
+    :param process: Process instance. Its IVM should contain the data it is to be run on
+    :param options: Process options
+    :return: Key string, or None if the options or the data they use cannot be fingerprinted
+    """
+    try:
+        key = "\n".join([
+            "version: %i" % RESULT_CACHE_VERSION,
+            "process: %s.%s" % (type(process).__module__, type(process).__name__),
+            "options: %s" % _normalize(options),
+            _ivm_fingerprint(process.ivm, options),
+        ])
+    except _Uncacheable as exc:
+        LOG.debug("Results not cacheable: %s", exc)
+        return None
+    return _hash(key.encode("utf-8"))
+
+def _fname(key):
+    return os.path.join(RESULT_CACHE_DIR, key + RESULT_CACHE_EXT)
+
+def _entries():
+    """
+    :return: List of (modification time, size, file name) for all cached results, oldest first
+    """
+    entries = []
+    for fname in glob.glob(os.path.join(RESULT_CACHE_DIR, "*" + RESULT_CACHE_EXT)):
+        try:
+            stat = os.stat(fname)
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        except (IOError, OSError):
+            # Removed by another process
+            pass
+    return sorted(entries)
+
+def lookup(key):
+    """
+    Get cached results
+
+    :param key: Key returned by ``cache_key()``
+    :return: Tuple of list of QpData instances, list of (name, Extra) tuples and
+             dictionary of information stored with the results, or None if there
+             are no cached results for the key
+    """
+    if RESULT_CACHE_DIR is None or key is None or not os.path.exists(_fname(key)):
+        return None
+
+    fname = _fname(key)
+    # Mark as recently used
+    os.utime(fname, None)
+    return load_items(fname)
+
+def store(key, data, extras, info):
+    """
+    Store results in the cache, removing the least recently used results if
+    the total size of the cache exceeds ``RESULT_CACHE_MAX_SIZE``
+
+    :param key: Key returned by ``cache_key()``
+    :param data: Sequence of QpData instances
+    :param extras: Sequence of (name, Extra) tuples
+    :param info: Dictionary of information to store with the results. Values must be
+                 strings, numbers, lists or dictionaries
+    """
+    if RESULT_CACHE_DIR is None or key is None:
+        return
+
+    save_items(_fname(key), data, extras, info)
+    evict()
+
+def evict(max_size=None):
+    """
+    Remove the least recently used results until the cache is within its size limit
+
+    :param max_size: Size limit in bytes. Defaults to ``RESULT_CACHE_MAX_SIZE``
+    """
+    if RESULT_CACHE_DIR is None:
+        return
+    if max_size is None:
+        max_size = RESULT_CACHE_MAX_SIZE
+
+    entries = _entries()
+    total = sum([size for _, size, _ in entries])
+    for _, size, fname in entries:
+        if total <= max_size:
+            break
+        try:
+            LOG.debug("Removing cached results %s", fname)
+            os.remove(fname)
+            total -= size
+        except (IOError, OSError):
+            LOG.debug("Failed to remove cached results %s", fname)
+
+def clear():
+    """
+    Remove all cached results
+    """
+    if RESULT_CACHE_DIR is not None:
+        evict(0)
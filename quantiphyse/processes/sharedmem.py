@@ -0,0 +1,198 @@
+"""
+Quantiphyse - Passing Numpy arrays to and from worker processes in shared memory
+
+Arrays passed to worker processes are normally pickled, sent through a pipe and
+unpickled by the worker, and the same happens to the output. For large data
+this means several full copies of the data. Instead, arrays can be placed in
+a shared memory block. When pickled, only the name of the block is sent and the
+worker receives a Numpy array which uses the same memory.
+
+Shared memory requires Python 3.8 or later. If it is not available arrays are
+pickled as before.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import division
+
+import weakref
+import logging
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+    HAVE_SHARED_MEMORY = True
+except ImportError:
+    shared_memory = None
+    HAVE_SHARED_MEMORY = False
+
+from quantiphyse.utils import QpException
+
+LOG = logging.getLogger(__name__)
+
+#: Numpy arrays smaller than this number of bytes are pickled rather than passed in shared memory
+SHARED_MEMORY_MIN_SIZE = 1024*1024
+
+def _array(shm, shape, dtype):
+    """
+    :return: Numpy array using the memory of a shared memory block. The block is
+             closed when the array and all views of it have been garbage collected
+    """
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    weakref.finalize(arr, shm.close)
+    return arr
+
+def _attach(name, shape, dtype, index=None, unlink=False):
+    """
+    Unpickle a shared array as a Numpy array using the same memory
+
+    :param index: Optional index of the part of the array to return
+    :param unlink: If True, the block is freed once the returned array is no longer used
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    if unlink:
+        shm.unlink()
+    arr = _array(shm, shape, np.dtype(dtype))
+    if index is not None:
+        arr = arr[index]
+    return arr
+
+def can_share(arr):
+    """
+    :return: True if an object is a Numpy array which should be passed in shared memory
+    """
+    return (HAVE_SHARED_MEMORY and type(arr) is np.ndarray and not arr.dtype.hasobject
+            and arr.nbytes >= max(1, SHARED_MEMORY_MIN_SIZE))
+
+class SharedArray(object):
+    """
+    Numpy array in shared memory which can be passed to worker processes without copying
+
+    The array is available as the ``array`` attribute. When a SharedArray is pickled,
+    e.g. as an argument to a worker function, the worker receives a Numpy array
+    which uses the same memory, so it can read the data in place and write its
+    results directly into it.
+
+    ``release()`` should be called when workers no longer need the array. The
+    ``array`` attribute remains valid after it has been called.
+    """
+
+    def __init__(self, shape, dtype=np.float32):
+        """
+        :param shape: Shape of array
+        :param dtype: Numpy data type of array
+        """
+        if not HAVE_SHARED_MEMORY:
+            raise QpException("Shared memory is not available in this version of Python")
+        self.shape = tuple([int(dim) for dim in shape])
+        self.dtype = np.dtype(dtype)
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        self._released = False
+        self.name = self._shm.name
+        self.array = _array(self._shm, self.shape, self.dtype)
+
+    @classmethod
+    def from_array(cls, arr):
+        """
+        :return: New SharedArray containing a copy of a Numpy array
+        """
+        shared = cls(arr.shape, arr.dtype)
+        shared.array[...] = arr
+        return shared
+
+    def split(self, sections, axis=0):
+        """
+        Split the array into parts to pass to workers without copying
+
+        The parts are the same as those returned by ``np.array_split``
+
+        :param sections: Number of parts, or sequence of indices to split at
+        :param axis: Axis to split along
+        :return: Sequence of picklable objects which workers receive as
+                 Numpy arrays using the memory of the corresponding part
+        """
+        bounds = np.cumsum([0] + [len(part) for part in np.array_split(np.arange(self.shape[axis]), sections)])
+        parts = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            index = [slice(None)] * len(self.shape)
+            index[axis] = slice(int(start), int(end))
+            parts.append(SharedArrayPart(self, tuple(index)))
+        return parts
+
+    def release(self):
+        """
+        Free the shared memory once it is no longer in use by any process
+        """
+        if not self._released:
+            self._released = True
+            try:
+                self._shm.unlink()
+            except (IOError, OSError):
+                LOG.debug("Shared memory %s already freed", self.name)
+
+    def __reduce__(self):
+        return (_attach, (self.name, self.shape, self.dtype.str))
+
+class SharedArrayPart(object):
+    """
+    Part of a SharedArray which is received by workers as a Numpy array
+    """
+
+    def __init__(self, shared, index):
+        self.shared = shared
+        self.index = index
+
+    def __reduce__(self):
+        return (_attach, (self.shared.name, self.shared.shape, self.shared.dtype.str, self.index))
+
+class _SharedOutput(object):
+    """
+    Worker output array which is received by the main process as a Numpy array using
+    the same memory. The main process frees the memory when it no longer uses the array
+    """
+
+    def __init__(self, arr):
+        self.shared = SharedArray.from_array(arr)
+
+    def __reduce__(self):
+        return (_attach, (self.shared.name, self.shared.shape, self.shared.dtype.str, None, True))
+
+def share_arrays(obj):
+    """
+    Replace large Numpy arrays in worker output with references to shared memory
+
+    Arrays are found within lists, tuples and dictionaries. Other objects are
+    returned unchanged and will be pickled as normal
+    """
+    if can_share(obj):
+        return _SharedOutput(obj)
+    elif type(obj) in (list, tuple):
+        return type(obj)([share_arrays(item) for item in obj])
+    elif type(obj) is dict:
+        return dict([(key, share_arrays(value)) for key, value in obj.items()])
+    else:
+        return obj
+
+class SharedOutputWorker(object):
+    """
+    Wrapper for a worker function which returns large output arrays in shared memory
+    """
+
+    def __init__(self, worker_fn):
+        self.worker_fn = worker_fn
+
+    def __call__(self, *args):
+        return share_arrays(self.worker_fn(*args))
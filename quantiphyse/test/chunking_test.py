@@ -0,0 +1,134 @@
+"""
+Quantiphyse - Tests for splitting data between background workers
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import ImageVolumeManagement
+from quantiphyse.processes import Process
+from quantiphyse.processes.process import CHUNKS_PER_WORKER
+from quantiphyse.utils import QpException
+
+def _roi_worker(worker_id, queue, data, roi, scale):
+    """
+    Scale the data and count the ROI voxels in this chunk
+    """
+    return worker_id, True, [data * scale, np.count_nonzero(roi)]
+
+def _add_worker(worker_id, queue, data, other):
+    """
+    Add a second per-voxel input to the data
+    """
+    return worker_id, True, [data + other]
+
+class RoiProcess(Process):
+
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, worker_fn=_roi_worker, sync=True, **kwargs)
+
+    def run(self, options):
+        data, roi = options.pop("data"), options.pop("roi")
+        self.start_bg([data, roi, 2], n_workers=options.pop("n-workers", 2), roi=roi)
+
+    def finished(self, worker_output):
+        self.output = self.recombine_data([output[0] for output in worker_output])
+        self.counts = [output[1] for output in worker_output]
+
+class ChunkingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ivm = ImageVolumeManagement()
+        self.data = np.random.rand(40, 10, 10, 3).astype(np.float32)
+        # Small ROI in a few slices at one end of the split axis
+        self.roi = np.zeros((40, 10, 10), dtype=np.int8)
+        self.roi[2:6, 2:8, 2:8] = 1
+
+    def _run(self, chunking, n_workers=2, multiproc=True):
+        process = RoiProcess(self.ivm, chunking=chunking, multiproc=multiproc)
+        process.execute({"data" : self.data, "roi" : self.roi, "n-workers" : n_workers})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        return process
+
+    def testEqual(self):
+        process = self._run("equal")
+        self.assertEqual(len(process.counts), 2)
+        self.assertEqual(process.counts, [np.count_nonzero(self.roi), 0])
+        self.assertTrue(np.allclose(process.output, self.data * 2))
+
+    def testSlab(self):
+        process = self._run("slab")
+        nroi = np.count_nonzero(self.roi)
+        self.assertTrue(len(process.counts) > 2)
+        self.assertTrue(len(process.counts) <= 2 * CHUNKS_PER_WORKER)
+        self.assertEqual(sum(process.counts), nroi)
+        # No chunk contains much more than its share of the ROI
+        self.assertTrue(max(process.counts) <= nroi // 2)
+        self.assertTrue(np.allclose(process.output, self.data * 2))
+
+    def testSlabNoMultiproc(self):
+        process = self._run("slab", multiproc=False)
+        self.assertEqual(sum(process.counts), np.count_nonzero(self.roi))
+        self.assertTrue(np.allclose(process.output, self.data * 2))
+
+    def testSlabUnevenRoi(self):
+        # All of the ROI in a single slice so the slabs are very different sizes
+        self.roi[:] = 0
+        self.roi[37, :, :] = 1
+        other = np.random.rand(*self.data.shape).astype(np.float32)
+        process = Process(self.ivm, worker_fn=_add_worker, sync=True, chunking="slab")
+        process.start_bg([self.data, other], roi=self.roi)
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(len(process._worker_output) > 2)
+        output = process.recombine_data([output[0] for output in process._worker_output])
+        self.assertTrue(np.allclose(output, self.data + other))
+
+    def testSlabNotOnRoiGrid(self):
+        process = Process(self.ivm, worker_fn=_add_worker, sync=True, chunking="slab")
+        with self.assertRaises(QpException):
+            process.start_bg([self.data, self.data[:20]], roi=self.roi)
+
+    def testVoxels(self):
+        process = self._run("voxels")
+        nroi = np.count_nonzero(self.roi)
+        self.assertEqual(len(process.counts), 2 * CHUNKS_PER_WORKER)
+        self.assertEqual(sum(process.counts), nroi)
+        self.assertTrue(max(process.counts) - min(process.counts) <= 1)
+        # Voxels outside the ROI are zero
+        expected = self.data * 2
+        expected[self.roi == 0] = 0
+        self.assertEqual(process.output.shape, self.data.shape)
+        self.assertTrue(np.allclose(process.output, expected))
+
+    def testVoxelsFewVoxels(self):
+        self.roi[:] = 0
+        self.roi[5, 5, 5] = 1
+        process = self._run("voxels")
+        self.assertEqual(process.counts, [1])
+        self.assertTrue(np.allclose(process.output[5, 5, 5], self.data[5, 5, 5] * 2))
+
+    def testVoxelsNoRoi(self):
+        process = Process(self.ivm, worker_fn=_roi_worker, chunking="voxels")
+        with self.assertRaises(QpException):
+            process.start_bg([self.data])
+
+    def testUnknownChunking(self):
+        with self.assertRaises(QpException):
+            Process(self.ivm, chunking="random")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,48 @@
 import os
+import time
+import struct
+import threading
+import shutil
+import tempfile
+import unittest
 
+import yaml
+import numpy as np
 import pandas as pd
 
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
 from quantiphyse.processes import Process
 from quantiphyse.test import ProcessTest
-from quantiphyse.data.extras import DataFrameExtra
+from quantiphyse.data import ImageVolumeManagement, NumpyData, NiftiData, SparseRoiData, DataGrid, save, save_session, load_session
+from quantiphyse.data.extras import DataFrameExtra, NumberListExtra, MatrixExtra
+import quantiphyse.data.session as session
+from quantiphyse.data.loader import AsyncLoader
 
 class IoProcessTest(ProcessTest):
 
+    def testLoad(self):
+        self.run_yaml("")
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertEqual(list(self.ivm.data.keys()), ["data_3d", "data_4d", "data_4d_moving", "mask"])
+        self.assertTrue(self.ivm.data["mask"].roi)
+        self.assertFalse(self.ivm.data["data_4d"].roi)
+        self.assertEqual(self.ivm.data["data_4d"].nvols, self.data_4d.shape[3])
+
+    def testLoadMissing(self):
+        yaml = """
+  - Load:
+        data:
+            not_a_file.nii.gz:
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue("not_a_file" not in self.ivm.data)
+        self.assertTrue("data_3d" in self.ivm.data)
+
     def testSaveAllExcept(self):
         yaml = """
   - SaveAllExcept:
@@ -68,4 +103,212 @@ class IoProcessTest(ProcessTest):
         self.run_yaml(yaml)
         self.assertEqual(self.status, Process.SUCCEEDED)
         self.assertTrue(os.path.exists(os.path.join(self.output_dir, "case", "saved_file.mat")))
-        
+
+    def testSessionCheckpoint(self):
+        yaml = """
+  - SaveSession:
+      file: checkpoint.qps
+
+  - Delete:
+      data_3d:
+
+  - LoadSession:
+      file: checkpoint.qps
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, "case", "checkpoint.qps")))
+        self.assertEqual(list(self.ivm.data.keys()), ["data_3d", "data_4d", "data_4d_moving", "mask"])
+        self.assertTrue(np.allclose(self.ivm.data["data_4d"].raw(), self.data_4d))
+        self.assertTrue(self.ivm.data["mask"].roi)
+
+class SessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="qp")
+        self.fname = os.path.join(self.tempdir, "test.qps")
+        self.shape = [5, 6, 7]
+        self.grid = DataGrid(self.shape, np.diag([1.5, 2, 2.5, 1]))
+        self.floats4d = np.random.rand(*(self.shape + [3,])).astype(np.float32)
+        self.ints = np.random.randint(0, 3, self.shape)
+        self.ivm = ImageVolumeManagement()
+        self.ivm.add(NumpyData(self.floats4d, grid=self.grid, name="data_4d"))
+        self.ivm.add(NumpyData(self.floats4d[..., 0] * 2, grid=self.grid, name="data_3d"), make_current=True)
+        self.ivm.add(NumpyData(self.ints, grid=self.grid, name="mask", roi=True))
+        self.ivm.add(SparseRoiData.from_array(self.ints == 1, grid=self.grid, name="sparse"))
+        self.ivm.add_extra("numbers", NumberListExtra("numbers", [1, 2, 3]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def _restore(self, mmap=True):
+        save_session(self.ivm, self.fname)
+        ivm = ImageVolumeManagement()
+        load_session(ivm, self.fname, mmap=mmap)
+        return ivm
+
+    def testIsSession(self):
+        save_session(self.ivm, self.fname)
+        self.assertTrue(session.is_session(self.fname))
+        self.assertFalse(session.is_session(os.path.join(self.tempdir, "missing.qps")))
+
+    def testRestore(self):
+        ivm = self._restore()
+        self.assertEqual(list(ivm.data.keys()), ["data_4d", "data_3d", "mask", "sparse"])
+        self.assertTrue(np.array_equal(ivm.data["data_4d"].raw(), self.floats4d))
+        self.assertTrue(np.allclose(ivm.data["data_3d"].raw(), self.floats4d[..., 0] * 2))
+        self.assertTrue(np.array_equal(ivm.data["mask"].raw(), self.ints))
+        self.assertTrue(isinstance(ivm.data["sparse"], SparseRoiData))
+        self.assertTrue(np.array_equal(ivm.data["sparse"].raw(), self.ints == 1))
+        self.assertTrue(np.allclose(ivm.data["data_4d"].grid.affine, self.grid.affine))
+        self.assertEqual(ivm.main.name, "data_4d")
+        self.assertEqual(ivm.current_data.name, "data_3d")
+        self.assertEqual(ivm.current_roi.name, "mask")
+        self.assertEqual(ivm.extras["numbers"].values, [1, 2, 3])
+
+    def testMmap(self):
+        ivm = self._restore()
+        self.assertTrue(isinstance(ivm.data["data_4d"].raw(), np.memmap))
+        self.assertEqual(ivm.data["data_4d"].memory_usage(), 0)
+        ivm = self._restore(mmap=False)
+        self.assertFalse(isinstance(ivm.data["data_4d"].raw(), np.memmap))
+
+    def testModifyRestored(self):
+        ivm = self._restore()
+        arr = ivm.data["mask"].writeable_raw()
+        arr[0, 0, 0] = 5
+        ivm.data["mask"].invalidate()
+        # The session file is not changed
+        ivm2 = ImageVolumeManagement()
+        load_session(ivm2, self.fname)
+        self.assertEqual(ivm2.data["mask"].raw()[0, 0, 0], self.ints[0, 0, 0])
+        # Saving over the session the data was restored from
+        save_session(ivm, self.fname)
+        load_session(ivm2, self.fname)
+        self.assertEqual(ivm2.data["mask"].raw()[0, 0, 0], 5)
+        self.assertTrue(np.array_equal(ivm.data["data_4d"].raw(), self.floats4d))
+
+    def testMetadata(self):
+        self.ivm.data["mask"].metadata["roi_regions"] = {1 : "one", 2 : "two"}
+        self.ivm.data["data_3d"].view.cmap = "hot"
+        self.ivm.data["data_3d"].view.cmap_range = (0.2, 0.8)
+        self.ivm.data["data_4d"].stats(1)
+        ivm = self._restore()
+        self.assertEqual(ivm.data["mask"].regions, {1 : "one", 2 : "two"})
+        self.assertEqual(ivm.data["data_3d"].view.cmap, "hot")
+        # Tuples are restored as lists
+        self.assertEqual(list(ivm.data["data_3d"].view.cmap_range), [0.2, 0.8])
+        self.assertTrue(1 in ivm.data["data_4d"].cached_stats())
+
+    def testExtras(self):
+        self.ivm.add_extra("matrix", MatrixExtra("matrix", [[1, 2], [3, 4]], col_headers=["a", "b"]))
+        ivm = self._restore()
+        self.assertEqual(ivm.extras["matrix"].arr, [[1, 2], [3, 4]])
+        self.assertEqual(ivm.extras["matrix"].col_headers, ["a", "b"])
+
+    def testIndexNotPickled(self):
+        save_session(self.ivm, self.fname)
+        with open(self.fname, "rb") as sfile:
+            sfile.seek(len(session.SESSION_MAGIC))
+            index_offset, index_length = struct.unpack("<QQ", sfile.read(16))
+            sfile.seek(index_offset)
+            index = yaml.safe_load(sfile.read(index_length).decode("utf-8"))
+        self.assertEqual(index["version"], session.SESSION_VERSION)
+        self.assertEqual([item["name"] for item in index["data"]], ["data_4d", "data_3d", "mask", "sparse"])
+
+    def testReloadableReleased(self):
+        nifti_fname = os.path.join(self.tempdir, "data.nii")
+        save(self.ivm.data["data_4d"], nifti_fname)
+        self.ivm.add(NiftiData(nifti_fname), name="nifti")
+        save_session(self.ivm, self.fname)
+        self.assertTrue(self.ivm.data["nifti"].rawdata is None)
+
+    def testNotSession(self):
+        with open(self.fname, "w") as sfile:
+            sfile.write("not a session")
+        self.assertRaises(Exception, load_session, self.ivm, self.fname)
+
+
+class AsyncLoaderTest(ProcessTest):
+
+    def setUp(self):
+        ProcessTest.setUp(self)
+        # Results are delivered through the Qt event loop
+        if QtCore.QCoreApplication.instance() is None:
+            self._app = QtCore.QCoreApplication([])
+        self.loader = AsyncLoader()
+        self.loaded, self.failed = [], []
+
+    def tearDown(self):
+        self.loader.stop()
+        ProcessTest.tearDown(self)
+
+    def _wait(self, timeout=30):
+        start = time.time()
+        while self.loader.pending > 0 and time.time() - start < timeout:
+            self.processEvents()
+            time.sleep(0.01)
+        self.assertEqual(self.loader.pending, 0)
+
+    def _fname(self, name):
+        return os.path.join(self.input_dir, name + ".nii.gz")
+
+    def testOrder(self):
+        names = ["data_4d", "data_3d", "mask", "data_4d_moving"]
+        for name in names:
+            self.loader.load(self._fname(name), callback=self.loaded.append, errback=self.failed.append)
+        self._wait()
+        self.assertEqual(len(self.failed), 0)
+        self.assertEqual([qpd.fname for qpd in self.loaded], [self._fname(name) for name in names])
+
+    def testPreload(self):
+        self.loader.load(self._fname("data_3d"), callback=self.loaded.append)
+        self.loader.load(self._fname("mask"), callback=self.loaded.append, preload=False)
+        self._wait()
+        self.assertTrue(self.loaded[0].rawdata is not None)
+
+        self.loaded[1].uncache()
+        self.assertTrue(self.loaded[1].rawdata is None)
+        self.loader.preload(self.loaded[1], callback=self.loaded.append)
+        self._wait()
+        self.assertTrue(self.loaded[2] is self.loaded[1])
+        self.assertTrue(self.loaded[2].rawdata is not None)
+
+    def testFailure(self):
+        self.loader.load(self._fname("not_a_file"), callback=self.loaded.append, errback=self.failed.append)
+        self.loader.load(self._fname("data_3d"), callback=self.loaded.append, errback=self.failed.append)
+        self._wait()
+        self.assertEqual(len(self.failed), 1)
+        self.assertEqual(len(self.loaded), 1)
+
+    def testWait(self):
+        request = self.loader.load(self._fname("data_4d"), callback=self.loaded.append)
+        self.loader.wait()
+        self.assertEqual(self.loader.pending, 0)
+        self.assertTrue(request.done())
+        self.assertTrue(request.result() is self.loaded[0])
+
+    def testWaitRequests(self):
+        blocked = threading.Event()
+        first = self.loader.load(self._fname("data_3d"), callback=self.loaded.append)
+        self.loader.submit("blocked", lambda progress_cb: blocked.wait(30), callback=self.loaded.append)
+        try:
+            # Later request is not waited for
+            self.loader.wait([first])
+            self.assertEqual(self.loader.pending, 1)
+            self.assertTrue(self.loaded[0] is first.result())
+        finally:
+            blocked.set()
+        self._wait()
+        self.assertEqual(len(self.loaded), 2)
+
+    def testWaitInCallback(self):
+        def _loaded(qpdata):
+            self.loaded.append(qpdata)
+            request = self.loader.load(self._fname("mask"), callback=self.loaded.append)
+            self.loader.wait([request])
+            self.assertEqual(len(self.loaded), 2)
+
+        self.loader.load(self._fname("data_3d"), callback=_loaded)
+        self._wait()
+        self.assertEqual([qpd.fname for qpd in self.loaded], [self._fname("data_3d"), self._fname("mask")])
@@ -16,10 +16,14 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
 import unittest
+import tempfile
+import shutil
+
 import numpy as np
 
-from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+from quantiphyse.data import ImageVolumeManagement, NumpyData, NiftiData, DataGrid, save
 
 GRIDSIZE = 5
 
@@ -152,6 +156,18 @@ class IVMTest(unittest.TestCase):
         self.assertEqual(self.ivm.data["test3"], qpd3)
         self.assertEqual(self.ivm.rois["test3"], qpd3)
 
+    def testTimeseriesMany(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        data4d = np.random.rand(*(shape + [3,]))
+        self.ivm.add(NumpyData(data4d, name="data4d", grid=grid))
+        self.ivm.add(NumpyData(np.random.rand(*shape), name="data3d", grid=grid))
+        points = [[1, 2, 3], [4, 0, 2]]
+        curves = self.ivm.timeseries_many(points)
+        self.assertEqual(list(curves.keys()), ["data4d"])
+        for point, curve in zip(points, curves["data4d"]):
+            self.assertTrue(np.allclose(curve, self.ivm.timeseries(point)["data4d"]))
+
     def testDelete(self):
         shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
         grid = DataGrid(shape, np.identity(4))
@@ -183,5 +199,76 @@ class IVMTest(unittest.TestCase):
         self.assertEqual(self.ivm.main, self.ivm.data["test2"])
         self.assertTrue(np.all(self.ivm.data["test2"].raw() == qpd.raw()))
 
+    def testAddResampled(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        qpd = NumpyData(np.random.rand(*shape), name="test", grid=grid)
+        resampled = qpd.resample(DataGrid(shape, np.diag([0.5, 0.5, 0.5, 1])), order=1)
+        self.ivm.add(resampled, name="resampled")
+        self.assertTrue(self.ivm.data["resampled"].raw().flags.writeable)
+        self.assertFalse(qpd.resample(resampled.grid, order=1).raw().flags.writeable)
+
+    def testMemoryUsage(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        qpd = NumpyData(np.random.rand(*shape), name="test", grid=grid)
+        self.ivm.add(qpd)
+        self.assertEqual(self.ivm.memory.usage(), {"test" : qpd.raw().nbytes})
+        self.assertEqual(self.ivm.memory.total(), qpd.raw().nbytes)
+
+    def testMemoryBudget(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        try:
+            for name in ("main", "old", "new"):
+                fname = os.path.join(tempdir, "%s.nii" % name)
+                save(NumpyData(np.random.rand(*shape), name=name, grid=grid), fname)
+                qpd = NiftiData(fname)
+                qpd.raw()
+                self.ivm.add(qpd, name=name, make_current=False)
+            self.assertEqual(self.ivm.main.name, "main")
+            self.assertTrue(self.ivm.data["old"].rawdata is not None)
+            nbytes = self.ivm.data["old"].memory_usage()
+
+            # Least recently used item is released, main data is protected
+            self.ivm.memory.budget = 2 * nbytes
+            self.assertTrue(self.ivm.data["main"].rawdata is not None)
+            self.assertTrue(self.ivm.data["old"].rawdata is None)
+            self.assertTrue(self.ivm.data["new"].rawdata is not None)
+            self.assertEqual(self.ivm.memory.total(), 2 * nbytes)
+
+            # Data is re-read when required
+            self.assertEqual(list(self.ivm.data["old"].raw().shape), shape)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def testMemoryBudgetEdited(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        try:
+            for name in ("edited", "other"):
+                fname = os.path.join(tempdir, "%s.nii" % name)
+                save(NumpyData(np.zeros(shape, dtype=np.int8), name=name, grid=grid, roi=True), fname)
+                qpd = NiftiData(fname)
+                qpd.roi = True
+                self.ivm.add(qpd, name=name, make_current=True)
+            self.ivm.set_current_roi("edited")
+
+            # Edit the ROI in place in the same way as the ROI builder
+            roi = self.ivm.data["edited"]
+            roi.writeable_raw()[1, 2, 3] = 3
+            roi.invalidate()
+            self.assertFalse(roi.reloadable)
+
+            # Edited data is not released even when over budget
+            self.ivm.set_current_roi("other")
+            self.ivm.memory.budget = 1
+            self.assertTrue(roi.rawdata is not None)
+            self.assertEqual(roi.raw()[1, 2, 3], 3)
+        finally:
+            shutil.rmtree(tempdir)
+
 if __name__ == '__main__':
     unittest.main()
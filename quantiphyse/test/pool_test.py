@@ -0,0 +1,266 @@
+"""
+Quantiphyse - Tests for the shared worker pool
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import time
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import ImageVolumeManagement
+from quantiphyse.processes import Process
+import quantiphyse.processes.pool as pool_module
+from quantiphyse.processes.pool import get_pool, shutdown_pool, TaskCancelled
+
+def _square_worker(worker_id, queue, data):
+    queue.put(worker_id)
+    return worker_id, True, [data**2, os.getpid()]
+
+def _cooperative_worker(worker_id, queue, wait=30):
+    start = time.time()
+    while not queue.cancelled() and time.time() - start < wait:
+        time.sleep(0.05)
+    return worker_id, True, queue.cancelled()
+
+def _stubborn_worker(worker_id, queue, wait=30):
+    time.sleep(wait)
+    return worker_id, True, os.getpid()
+
+def _failing_worker(worker_id, queue):
+    if worker_id == 0:
+        return worker_id, False, RuntimeError("Worker failed")
+    return _cooperative_worker(worker_id, queue)
+
+class SquareProcess(Process):
+    """
+    Background process which squares its input and records the worker PIDs
+    """
+
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, worker_fn=_square_worker, sync=True, **kwargs)
+        self.output, self.pids = None, None
+
+    def run(self, options):
+        self.start_bg([options.pop("data")], n_workers=options.pop("n-workers", 2))
+
+    def finished(self, worker_output):
+        self.output = np.concatenate([output[0] for output in worker_output])
+        self.pids = set([output[1] for output in worker_output])
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ivm = ImageVolumeManagement()
+        self.data = np.arange(20, dtype=np.float32)
+
+    def _run(self, n_workers=2):
+        process = SquareProcess(self.ivm)
+        process.execute({"data" : self.data, "n-workers" : n_workers})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(process.output, self.data**2))
+        return process
+
+    def _messages(self, queue, num):
+        """
+        :return: Messages received on a channel, waiting until ``num`` have arrived
+        """
+        messages = []
+        for _ in range(100):
+            while not queue.empty():
+                messages.append(queue.get())
+            if len(messages) >= num:
+                break
+            time.sleep(0.1)
+        return messages
+
+    def testProcess(self):
+        process = self._run()
+        self.assertTrue(os.getpid() not in process.pids)
+
+    def testPoolReused(self):
+        pool = get_pool()
+        pids = self._run().pids
+        self.assertTrue(get_pool() is pool)
+
+        # Pool workers are not restarted for the second process
+        process = self._run()
+        self.assertTrue(get_pool() is pool)
+        self.assertTrue(process.pids.issubset(pool_pids(pool)))
+        self.assertTrue(pids.issubset(pool_pids(pool)))
+
+    def testMoreWorkersThanPool(self):
+        self._run(n_workers=get_pool().size + 2)
+
+    def testChannels(self):
+        pool = get_pool()
+        worker_queue1, queue1 = pool.channel()
+        worker_queue2, queue2 = pool.channel()
+        try:
+            results = [pool.apply_async(_square_worker, (idx, worker_queue1, self.data)) for idx in range(2)]
+            results.append(pool.apply_async(_square_worker, (2, worker_queue2, self.data)))
+            for result in results:
+                result.get()
+            self.assertEqual(sorted(self._messages(queue1, 2)), [0, 1])
+            self.assertEqual(self._messages(queue2, 1), [2])
+        finally:
+            pool.close_channel(worker_queue1)
+            pool.close_channel(worker_queue2)
+
+    def testTaskReleased(self):
+        pool = get_pool()
+        worker_queue, _ = pool.channel()
+        task = pool.apply_async(_square_worker, (0, worker_queue, self.data), channel=worker_queue)
+        task.get()
+        # Finished tasks are forgotten as soon as their result is available
+        self.assertTrue(task not in pool._tasks)
+        self.assertTrue(task.args is None)
+        pool.close_channel(worker_queue)
+
+    def testChannelSlots(self):
+        pool = get_pool()
+        worker_queue, _ = pool.channel()
+        # Closed channels return their cancellation flag for reuse
+        for _ in range(pool_module.POOL_CHANNELS):
+            other_queue, _ = pool.channel()
+            self.assertNotEqual(other_queue._slot, worker_queue._slot)
+            pool.close_channel(other_queue)
+        pool.close_channel(worker_queue)
+
+    def testCallbackError(self):
+        def _callback(result):
+            raise RuntimeError("Callback failed")
+        pool = get_pool()
+        worker_queue, _ = pool.channel()
+        pool.apply_async(_square_worker, (0, worker_queue, self.data), callback=_callback).wait()
+        pool.close_channel(worker_queue)
+        # Pool continues to handle results
+        self._run()
+
+    def testShutdown(self):
+        pool = get_pool()
+        shutdown_pool()
+        self._run()
+        self.assertFalse(get_pool() is pool)
+
+    def testCancelCooperative(self):
+        pool = get_pool()
+        worker_queue, _ = pool.channel()
+        task = pool.apply_async(_cooperative_worker, (0, worker_queue), channel=worker_queue)
+        time.sleep(0.5)
+        pool.cancel(worker_queue)
+        self.assertEqual(task.get(timeout=5), (0, True, True))
+        pool.close_channel(worker_queue)
+
+    def testCancelQueued(self):
+        pool = get_pool()
+        worker_queue, _ = pool.channel()
+        tasks = [pool.apply_async(_cooperative_worker, (idx, worker_queue), channel=worker_queue)
+                 for idx in range(pool.size + 2)]
+        time.sleep(0.5)
+        pool.cancel(worker_queue)
+        start = time.time()
+        for task in tasks:
+            try:
+                task.get(timeout=5)
+            except TaskCancelled:
+                pass
+        self.assertTrue(time.time() - start < 5)
+        pool.close_channel(worker_queue)
+
+    def testCancelQueuedBehindOthers(self):
+        pool = get_pool()
+        pids = pool_pids(pool)
+        other_queue, _ = pool.channel()
+        other_tasks = [pool.apply_async(_cooperative_worker, (idx, other_queue, 2), channel=other_queue)
+                       for idx in range(pool.size)]
+        worker_queue, _ = pool.channel()
+        tasks = [pool.apply_async(_stubborn_worker, (idx, worker_queue), channel=worker_queue)
+                 for idx in range(2)]
+        time.sleep(0.5)
+        pool.cancel(worker_queue, timeout=0.2)
+        time.sleep(0.5)
+
+        # Cancelled tasks had not started so the workers are not replaced
+        self.assertEqual(pids, pool_pids(pool))
+        for idx, task in enumerate(other_tasks):
+            self.assertEqual(task.get(timeout=10)[:2], (idx, True))
+            self.assertEqual(task.restarts, 0)
+        for task in tasks:
+            with self.assertRaises(TaskCancelled):
+                task.get(timeout=5)
+        pool.close_channel(worker_queue)
+        pool.close_channel(other_queue)
+
+    def testCancelTerminate(self):
+        pool = get_pool()
+        pids = pool_pids(pool)
+        worker_queue, _ = pool.channel()
+        task = pool.apply_async(_stubborn_worker, (0, worker_queue), channel=worker_queue)
+        time.sleep(0.5)
+        pool.cancel(worker_queue, timeout=0.2)
+        task.wait(5)
+        self.assertTrue(task.ready())
+        self.assertFalse(task.successful())
+        with self.assertRaises(TaskCancelled):
+            task.get()
+        pool.close_channel(worker_queue)
+
+        # Workers have been replaced and the pool can still be used
+        self.assertTrue(get_pool() is pool)
+        self.assertFalse(pids & pool_pids(pool))
+        self._run()
+
+    def testCancelResubmit(self):
+        pool = get_pool()
+        worker_queue, _ = pool.channel()
+        other_queue, _ = pool.channel()
+        task = pool.apply_async(_stubborn_worker, (0, worker_queue), channel=worker_queue)
+        other_task = pool.apply_async(_stubborn_worker, (0, other_queue, 1), channel=other_queue)
+        time.sleep(0.5)
+        pool.cancel(worker_queue, timeout=0.2)
+        # Task on the other channel is restarted if it was interrupted
+        self.assertEqual(other_task.get(timeout=10)[:2], (0, True))
+        self.assertEqual(other_task.restarts, 1)
+        with self.assertRaises(TaskCancelled):
+            task.get(timeout=5)
+        pool.close_channel(worker_queue)
+        pool.close_channel(other_queue)
+
+    def testProcessCancel(self):
+        process = Process(self.ivm, worker_fn=_stubborn_worker)
+        process.start_bg([], n_workers=2)
+        self.assertEqual(process.status, Process.RUNNING)
+        tasks = list(process._workers)
+        process.cancel()
+        self.assertEqual(process.status, Process.CANCELLED)
+        for task in tasks:
+            task.wait(5)
+            self.assertTrue(task.ready())
+
+    def testFailureCancelsWorkers(self):
+        process = Process(self.ivm, worker_fn=_failing_worker, sync=True)
+        start = time.time()
+        process.start_bg([], n_workers=2)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(process.status, Process.FAILED)
+        self.assertEqual(str(process.exception), "Worker failed")
+
+def pool_pids(pool):
+    return set([proc.pid for proc in pool._pool._pool])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Quantiphyse - Tests for background prefetching of slices
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+import threading
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import DataGrid, NumpyData, OrthoSlice
+from quantiphyse.gui.viewer.prefetch import SlicePrefetcher
+
+GRIDSIZE = 5
+NVOLS = 6
+
+class BlockingData(NumpyData):
+    """
+    Data whose slices cannot be extracted until ``release`` is set
+    """
+    def __init__(self, *args, **kwargs):
+        NumpyData.__init__(self, *args, **kwargs)
+        self.release = threading.Event()
+
+    def slice_data(self, plane, vol=0, interp_order=0):
+        self.release.wait(10)
+        return NumpyData.slice_data(self, plane, vol, interp_order)
+
+class SlicePrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = DataGrid([GRIDSIZE, GRIDSIZE, GRIDSIZE], np.identity(4))
+        self.plane = OrthoSlice(self.grid, 2, 2)
+        self.prefetcher = SlicePrefetcher(nvols=1, nthreads=1)
+
+    def tearDown(self):
+        self.prefetcher.stop()
+
+    def _data(self, name, cls=NumpyData):
+        return cls(np.random.rand(GRIDSIZE, GRIDSIZE, GRIDSIZE, NVOLS), grid=self.grid, name=name)
+
+    def _cached(self, qpd, vol):
+        key = (qpd.grid.affine.tobytes(), self.plane.affine.tobytes(), tuple(self.plane.shape), vol, 0)
+        return qpd._slice_cache.get(key) is not None
+
+    def _wait(self, timeout=10):
+        start = time.time()
+        while self.prefetcher._pending and time.time() - start < timeout:
+            time.sleep(0.01)
+        self.assertFalse(self.prefetcher._pending)
+
+    def testPrefetch(self):
+        qpd = self._data("data")
+        self.prefetcher.prefetch("owner", qpd, self.plane, 2)
+        self._wait()
+        self.assertTrue(self._cached(qpd, 1))
+        self.assertTrue(self._cached(qpd, 3))
+        self.assertFalse(self._cached(qpd, 2))
+        self.assertFalse(self._cached(qpd, 4))
+
+    def testMultipleData(self):
+        qpd1, qpd2 = self._data("data1"), self._data("data2")
+        self.prefetcher.prefetch(("owner", "data1"), qpd1, self.plane, 2)
+        self.prefetcher.prefetch(("owner", "data2"), qpd2, self.plane, 2)
+        self._wait()
+        for qpd in (qpd1, qpd2):
+            self.assertTrue(self._cached(qpd, 1))
+            self.assertTrue(self._cached(qpd, 3))
+
+    def testNewerRequestCancelsOlder(self):
+        # Occupy the only thread so the following requests are queued
+        blocker = self._data("blocker", BlockingData)
+        self.prefetcher.prefetch("other", blocker, self.plane, 0)
+        time.sleep(0.2)
+
+        qpd = self._data("data")
+        self.prefetcher.prefetch("owner", qpd, self.plane, 2)
+        self.prefetcher.prefetch("owner", qpd, self.plane, 4)
+        blocker.release.set()
+        self._wait()
+
+        # Volumes only requested by the older call are skipped
+        self.assertFalse(self._cached(qpd, 1))
+        self.assertTrue(self._cached(qpd, 5))
+        self.assertTrue(self._cached(blocker, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,17 +17,77 @@ limitations under the License.
 """
 
 import os
+import gzip
 import unittest
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
+import nibabel as nib
 
-from quantiphyse.data import NumpyData, DataGrid
+from quantiphyse.data import NumpyData, SparseRoiData, ExpressionData, DataGrid, OrthoSlice, ImageVolumeManagement, label_dtype
 import quantiphyse.data.nifti as nifti
+import quantiphyse.data.qpdata as qpdata
+import quantiphyse.data.expression as expression
+import quantiphyse.data.gzip_writer as gzip_writer
+import quantiphyse.data.hdf5 as hdf5
+import quantiphyse.data.dicoms as dicoms
+from quantiphyse.data.roi_index import RoiIndex
+import quantiphyse.data.volume_management as volume_management
+from quantiphyse.utils import QpException
 
 GRIDSIZE = 5
 NVOLS = 4
 
+class DataGridTest(unittest.TestCase):
+    """ Tests for the DataGrid class """
+
+    def setUp(self):
+        self.affine = np.array([
+            [0.3, 0.2, 1.7, 4],
+            [0.1, 2.1, 0.11, -3],
+            [2.2, 0.7, 0.3, 1.5],
+            [0, 0, 0, 1],
+        ])
+        self.grid = DataGrid([GRIDSIZE, GRIDSIZE, GRIDSIZE], self.affine)
+        self.points = np.random.rand(10, 4) * GRIDSIZE
+
+    def testReadOnly(self):
+        self.assertTrue(np.allclose(self.grid.affine, self.affine))
+        self.assertFalse(self.grid.affine.flags.writeable)
+        self.assertFalse(self.grid.shape.flags.writeable)
+        self.assertTrue(self.grid.affine is self.grid.affine)
+        self.grid.affine = np.identity(4)
+        self.assertTrue(np.allclose(self.grid.inv_transform, np.identity(3)))
+        self.grid.reset()
+        self.assertTrue(np.allclose(self.grid.affine, self.affine))
+
+    def testInverse(self):
+        self.assertTrue(np.allclose(self.grid.inv_affine, np.linalg.inv(self.affine)))
+        self.assertTrue(self.grid.inv_affine is self.grid.inv_affine)
+        self.assertTrue(np.allclose(self.grid.inv_transform, np.linalg.inv(self.affine[:3, :3])))
+
+    def testWorldMany(self):
+        world = self.grid.grid_to_world_many(self.points)
+        self.assertEqual(world.shape, self.points.shape)
+        self.assertTrue(np.allclose(world[:, 3], self.points[:, 3]))
+        for point, world_point in zip(self.points, world):
+            self.assertTrue(np.allclose(self.grid.grid_to_world(list(point)), world_point))
+            self.assertTrue(np.allclose(self.grid.world_to_grid(list(world_point)), point))
+        self.assertTrue(np.allclose(self.grid.world_to_grid_many(world), self.points))
+
+    def testDirection(self):
+        world = self.grid.grid_to_world_many(self.points[:, :3], direction=True)
+        self.assertTrue(np.allclose(world, np.dot(self.points[:, :3], self.affine[:3, :3].T)))
+
+    def testGridToGridMany(self):
+        other = DataGrid([GRIDSIZE, GRIDSIZE, GRIDSIZE], np.diag([2, 3, 4, 1]))
+        res = other.grid_to_grid_many(self.points, from_grid=self.grid)
+        self.assertTrue(np.allclose(res, self.grid.grid_to_grid_many(self.points, to_grid=other)))
+        for point, res_point in zip(self.points, res):
+            self.assertTrue(np.allclose(other.grid_to_grid(list(point), from_grid=self.grid), res_point))
+        self.assertTrue(other.grid_to_grid_matrix(self.grid) is other.grid_to_grid_matrix(self.grid))
+
 class NumpyDataTest(unittest.TestCase):
     """ Tests for the NumpyData subclass of QpData """
 
@@ -67,8 +127,25 @@ class NumpyDataTest(unittest.TestCase):
     def testRoiFloats(self):
         """ Check that ROIs can contain float data so long as the numbers are really integers """
         qpd = NumpyData(self.ints.astype(np.float), grid=self.grid, name="test", roi=True)
-        self.assertTrue(issubclass(qpd.raw().dtype.type, np.floating))
+        self.assertEqual(qpd.raw().dtype, np.uint8)
+        self.assertTrue(np.all(qpd.raw() == self.ints))
         self.assertTrue(qpd.roi)
+
+    def testRoiLabelDtype(self):
+        self.assertEqual(label_dtype(0, 1), np.uint8)
+        self.assertEqual(label_dtype(0, 256), np.uint16)
+        self.assertEqual(label_dtype(0, 70000), np.uint32)
+        self.assertEqual(label_dtype(-1, 100), np.int8)
+        qpd = NumpyData(self.ints * 1000, grid=self.grid, name="test", roi=True)
+        self.assertEqual(qpd.raw().dtype, np.uint16)
+
+    def testRoiResampleDtype(self):
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        grid = DataGrid(self.shape, np.diag([0.5, 0.5, 0.5, 1]))
+        for order in (0, 1, 3):
+            res = qpd.resample(grid, order=order)
+            self.assertEqual(res.raw().dtype, np.uint8)
+            self.assertTrue(res.raw().max() <= self.ints.max())
         
     def testRoiRegions(self):
         qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
@@ -76,12 +153,115 @@ class NumpyDataTest(unittest.TestCase):
         regions = [v for v in np.unique(self.ints) if v != 0]
         self.assertEqual(regions, list(qpd.regions.keys()))
 
+    def testRoiIndex(self):
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        index = qpd.roi_index()
+        self.assertTrue(qpd.roi_index() is index)
+        self.assertEqual(list(index.labels), [v for v in np.unique(self.ints) if v != 0])
+        for region in index.labels:
+            self.assertEqual(index.count(region), np.sum(self.ints == region))
+            self.assertTrue(np.array_equal(index.mask(region), self.ints == region))
+            coords = np.argwhere(self.ints == region)
+            bbox = index.bbox(region)
+            for axis in range(3):
+                self.assertEqual(bbox[axis].start, np.min(coords[:, axis]))
+                self.assertEqual(bbox[axis].stop, np.max(coords[:, axis])+1)
+        self.assertEqual(index.count(), np.sum(self.ints > 0))
+        self.assertEqual(index.count(100), 0)
+
+    def testRoiIndexFloatLabels(self):
+        index = RoiIndex(self.ints.astype(np.float32))
+        self.assertEqual(list(index.labels), [v for v in np.unique(self.ints) if v != 0])
+        for region in index.labels:
+            self.assertEqual(index.count(region), np.sum(self.ints == region))
+
+        floats = np.zeros(self.shape, dtype=np.float32)
+        floats[0, 0, 0], floats[1, 1, 1] = 1.2, 1.7
+        with self.assertRaises(QpException):
+            RoiIndex(floats)
+
+    def testRoiIndexInvalidated(self):
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        index = qpd.roi_index()
+        qpd.rawdata = np.ones(self.shape, dtype=np.uint8)
+        self.assertFalse(qpd.roi_index() is index)
+        self.assertEqual(list(qpd.roi_index().labels), [1])
+
+    def testMaskRegion(self):
+        roi = NumpyData(self.ints, grid=self.grid, name="roi", roi=True)
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        for region in list(roi.regions.keys()) + [None]:
+            if region is None:
+                mask = self.ints > 0
+            else:
+                mask = self.ints == region
+            flat = qpd.mask(roi, region=region, output_flat=True)
+            self.assertTrue(np.array_equal(flat, qpd.raw()[mask]))
+            masked, out_mask = qpd.mask(roi, region=region, vol=1, output_mask=True)
+            self.assertTrue(np.array_equal(out_mask, mask))
+            self.assertTrue(np.array_equal(masked[mask], qpd.volume(1)[mask]))
+            self.assertTrue(np.all(masked[~mask] == 0))
+
     def testRange(self):
         qpd = NumpyData(self.floats, grid=self.grid, name="test")
         mx, mn = np.max(self.floats), np.min(self.floats)
         self.assertAlmostEqual(qpd.range()[0], mn)
         self.assertAlmostEqual(qpd.range()[1], mx)
-        
+
+    def testRangeVolume(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        for vol in range(NVOLS):
+            self.assertAlmostEqual(qpd.range(vol=vol)[0], np.min(self.floats4d[..., vol]), places=5)
+            self.assertAlmostEqual(qpd.range(vol=vol)[1], np.max(self.floats4d[..., vol]), places=5)
+
+    def testRangePercentile(self):
+        data = np.arange(1000, dtype=np.float32).reshape((10, 10, 10))
+        data[0, 0, 0] = np.inf
+        qpd = NumpyData(data, grid=DataGrid([10, 10, 10], np.identity(4)), name="test")
+        dmin, dmax = qpd.range(percentile=90)
+        self.assertEqual(dmin, 1)
+        # Approximate to within a histogram bin
+        self.assertTrue(abs(dmax - np.percentile(data[np.isfinite(data)], 90)) < 1000.0 / qpdata.STATS_BINS)
+
+    def testStatsCached(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        stats = qpd.stats(vol=1)
+        self.assertTrue(qpd.stats(vol=1) is stats)
+        self.assertEqual(stats["count"], GRIDSIZE**3)
+        self.assertEqual(sum(stats["hist"]), GRIDSIZE**3)
+        self.assertTrue(1 in qpd.cached_stats())
+
+    def testStatsInvalidated(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        self.assertTrue(qpd.range()[1] < 1)
+        qpd.rawdata = self.floats + 10
+        self.assertTrue(qpd.range()[1] > 10)
+
+    def testFingerprint(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        same = NumpyData(np.array(self.floats4d), grid=self.grid, name="other")
+        self.assertEqual(qpd.fingerprint(), same.fingerprint())
+        moved = NumpyData(self.floats4d, grid=DataGrid(self.shape, np.identity(4) * 2), name="test")
+        self.assertNotEqual(qpd.fingerprint(), moved.fingerprint())
+        roi = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        self.assertNotEqual(roi.fingerprint(), NumpyData(self.ints, grid=self.grid, name="test").fingerprint())
+
+    def testFingerprintInvalidated(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        fingerprint = qpd.fingerprint()
+        qpd.rawdata = self.floats + 1
+        self.assertNotEqual(qpd.fingerprint(), fingerprint)
+
+    def testFingerprintChunked(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        fingerprint = qpd.fingerprint()
+        chunk_size = qpdata.FINGERPRINT_CHUNK_SIZE
+        try:
+            qpdata.FINGERPRINT_CHUNK_SIZE = 100
+            self.assertEqual(NumpyData(self.floats4d, grid=self.grid, name="test").fingerprint(), fingerprint)
+        finally:
+            qpdata.FINGERPRINT_CHUNK_SIZE = chunk_size
+
     def testSet2dt(self):
         qpd = NumpyData(self.floats, grid=self.grid, name="test")
         qpd.set_2dt()
@@ -119,7 +299,404 @@ class NumpyDataTest(unittest.TestCase):
         qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
         POS = [2, 3, 4]
         self.assertAlmostEqual(qpd.value(POS), self.floats4d[POS[0], POS[1], POS[2], 0])
-        
+
+    def testTimeseriesMany(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        points = [[2, 3, 4], [0, 0, 0], [4.2, 1.1, 0.7], [-1, 2, 2], [2, 2, GRIDSIZE]]
+        curves = qpd.timeseries_many(points)
+        self.assertEqual(curves.shape, (len(points), NVOLS))
+        for point, curve in zip(points[:3], curves):
+            self.assertTrue(np.allclose(curve, qpd.timeseries(point)))
+        self.assertTrue(np.all(np.isnan(curves[3:])))
+
+    def testTimeseriesManyGrid(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        grid = DataGrid(self.shape, np.diag([0.5, 0.5, 0.5, 1]))
+        points = np.array([[4, 6, 8, 0], [1, 1, 1, 2]])
+        curves = qpd.timeseries_many(points, grid=grid)
+        self.assertTrue(np.allclose(curves[0], self.floats4d[2, 3, 4, :]))
+        self.assertTrue(np.allclose(curves[1], self.floats4d[1, 1, 1, :]))
+        self.assertEqual(qpd.timeseries_many([]).shape, (0, NVOLS))
+
+    def testResampleCached(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        grid = DataGrid(self.shape, np.diag([0.5, 0.5, 0.5, 1]))
+        res1 = qpd.resample(grid, order=1)
+        res2 = qpd.resample(grid, order=1, suffix="_2")
+        self.assertEqual(res2.name, "test_2")
+        self.assertTrue(np.shares_memory(res1.raw(), res2.raw()))
+        self.assertFalse(res1.raw().flags.writeable)
+        res3 = qpd.resample(grid, order=0)
+        self.assertFalse(np.shares_memory(res1.raw(), res3.raw()))
+
+    def testFloat32NotCopied(self):
+        floats = self.floats.astype(np.float32)
+        qpd = NumpyData(floats, grid=self.grid, name="test")
+        self.assertTrue(qpd.raw() is floats)
+
+    def testVolumeQpdataShared(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        vol = qpd.volume(2, qpdata=True)
+        self.assertTrue(np.shares_memory(vol.raw(), qpd.raw()))
+        self.assertFalse(vol.raw().flags.writeable)
+        self.assertTrue(qpd.raw().flags.writeable)
+        self.assertTrue(np.allclose(vol.raw(), self.floats4d[..., 2]))
+
+    def testResampleIdentityShared(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        res = qpd.resample(DataGrid(self.shape, np.identity(4)))
+        self.assertTrue(np.shares_memory(res.raw(), qpd.raw()))
+        self.assertFalse(res.raw().flags.writeable)
+        self.assertTrue(qpd.raw().flags.writeable)
+        self.assertTrue(qpd.memory_usage() > 0)
+        self.assertEqual(res.memory_usage(), 0)
+
+    def testResampleFlipShared(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        affine = np.diag([-1, 1, 1, 1])
+        affine[0, 3] = GRIDSIZE-1
+        res = qpd.resample(DataGrid(self.shape, affine))
+        self.assertTrue(np.shares_memory(res.raw(), qpd.raw()))
+        self.assertTrue(np.allclose(res.raw(), self.floats[::-1]))
+
+    def testWriteableRaw(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        self.assertTrue(qpd.writeable_raw() is qpd.raw())
+        res = qpd.resample(DataGrid(self.shape, np.identity(4)))
+        arr = res.writeable_raw()
+        self.assertTrue(arr.flags.writeable)
+        self.assertFalse(np.shares_memory(arr, qpd.raw()))
+        arr[0, 0, 0] = 7
+        res.invalidate()
+        self.assertEqual(res.value([0, 0, 0]), 7)
+        self.assertNotEqual(qpd.value([0, 0, 0]), 7)
+
+    def testResampleCacheInvalidated(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        grid = DataGrid(self.shape, np.diag([0.5, 0.5, 0.5, 1]))
+        res1 = qpd.resample(grid, order=1)
+        qpd.rawdata = self.floats.astype(np.float32) * 2
+        res2 = qpd.resample(grid, order=1)
+        self.assertFalse(np.shares_memory(res1.raw(), res2.raw()))
+        self.assertTrue(np.allclose(res2.raw(), res1.raw() * 2))
+
+    def testSliceCached(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        plane = OrthoSlice(self.grid, 2, 3)
+        slice1, _, _, _ = qpd.slice_data(plane, vol=1)
+        slice2, _, _, _ = qpd.slice_data(plane, vol=1)
+        self.assertTrue(slice1 is slice2)
+        self.assertFalse(slice1.flags.writeable)
+        self.assertTrue(np.allclose(slice1, self.floats4d[:, :, 3, 1]))
+        slice3, _, _, _ = qpd.slice_data(plane, vol=2)
+        self.assertTrue(np.allclose(slice3, self.floats4d[:, :, 3, 2]))
+
+    def testSliceCacheInvalidated(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        plane = OrthoSlice(self.grid, 2, 3)
+        slice1, _, _, _ = qpd.slice_data(plane, vol=1)
+        qpd.rawdata = self.floats4d * 2
+        slice2, _, _, _ = qpd.slice_data(plane, vol=1)
+        self.assertTrue(np.allclose(slice2, slice1 * 2))
+
+class SparseRoiDataTest(unittest.TestCase):
+    """ Tests for the SparseRoiData subclass of QpData """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE*4, GRIDSIZE*4, GRIDSIZE*4]
+        self.grid = DataGrid(self.shape, np.identity(4))
+        self.ints = np.zeros(self.shape, dtype=np.int64)
+        self.ints[3:6, 4:8, 5:7] = 1
+        self.ints[10:12, 11, 2:4] = 3
+        self.ints[15, 16, 17] = 2
+        self.floats = np.random.rand(*self.shape)
+
+    def testRaw(self):
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        self.assertTrue(qpd.roi)
+        self.assertEqual(qpd.nvols, 1)
+        self.assertTrue(qpd.memory_usage() < self.ints.nbytes / 100)
+        self.assertEqual(list(qpd.regions.keys()), [1, 2, 3])
+        self.assertTrue(np.array_equal(qpd.raw(), self.ints))
+        self.assertEqual(qpd.raw().dtype, np.uint8)
+
+    def testRoiIndex(self):
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        dense = NumpyData(self.ints, grid=self.grid, name="dense", roi=True)
+        for region in [1, 2, 3, None]:
+            self.assertEqual(qpd.roi_index().count(region), dense.roi_index().count(region))
+            self.assertTrue(np.array_equal(qpd.roi_index().indices(region), dense.roi_index().indices(region)))
+        self.assertEqual(qpd.get_bounding_box(), dense.get_bounding_box())
+
+    def testMask(self):
+        roi = SparseRoiData.from_array(self.ints, grid=self.grid, name="roi")
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        for region in [1, 2, 3, None]:
+            mask = self.ints > 0 if region is None else self.ints == region
+            self.assertTrue(np.array_equal(qpd.mask(roi, region=region, output_flat=True), qpd.raw()[mask]))
+
+    def testResample(self):
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        dense = NumpyData(self.ints, grid=self.grid, name="dense", roi=True)
+        affine = np.array([
+            [0.7, 0.1, 0, 1.3],
+            [-0.1, 0.7, 0, -0.6],
+            [0, 0, 1.3, 0.4],
+            [0, 0, 0, 1],
+        ])
+        for grid in [DataGrid(self.shape, affine), DataGrid([10, 10, 10], np.diag([2.1, 2.1, 2.1, 1])),
+                     DataGrid(self.shape, np.diag([-1, 1, 1, 1]))]:
+            res = qpd.resample(grid)
+            self.assertTrue(isinstance(res, SparseRoiData))
+            self.assertTrue(np.array_equal(res.raw(), dense.resample(grid).raw()))
+
+    def testSliceData(self):
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        dense = NumpyData(self.ints, grid=self.grid, name="dense", roi=True)
+        for zaxis in range(3):
+            for pos in [3, 11, 17]:
+                plane = OrthoSlice(self.grid, zaxis, pos)
+                self.assertTrue(np.array_equal(qpd.slice_data(plane)[0], dense.slice_data(plane)[0]))
+        self.assertTrue(qpd.memory_usage() < self.ints.nbytes)
+
+    def testValue(self):
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        self.assertEqual(qpd.value([15, 16, 17]), 2)
+        self.assertEqual(qpd.value([0, 0, 0]), 0)
+        self.assertEqual(qpd.value([-1, 0, 0]), 0)
+        self.assertEqual(qpd.range(), (0, 3))
+
+    def testTimeseriesMany(self):
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        points = [[15, 16, 17], [0, 0, 0], [4, 5, 6], [100, 0, 0]]
+        curves = qpd.timeseries_many(points)
+        self.assertTrue(np.array_equal(curves[:3, 0], [2, 0, 1]))
+        self.assertTrue(np.isnan(curves[3, 0]))
+        self.assertTrue(qpd.memory_usage() < self.ints.nbytes)
+
+    def testModifyInPlace(self):
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        self.assertEqual(qpd.roi_index().count(2), 1)
+        qpd.raw()[0, 0, 0] = 2
+        qpd.invalidate()
+        self.assertEqual(qpd.roi_index().count(2), 2)
+        qpd.uncache()
+        self.assertEqual(qpd.raw()[0, 0, 0], 2)
+
+    def testWriteableRawNotUncached(self):
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        dense = qpd.writeable_raw()
+        self.assertFalse(qpd.reloadable)
+        qpd.uncache()
+        # Edits to the array which was handed out must not be lost
+        dense[0, 0, 0] = 2
+        qpd.invalidate()
+        self.assertTrue(qpd.raw() is dense)
+        self.assertEqual(qpd.roi_index().count(2), 2)
+
+    def testSaveNifti(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "roi.nii.gz")
+        qpd = SparseRoiData.from_array(self.ints, grid=self.grid, name="test")
+        nifti.save(qpd, fname)
+        nifti_data = nifti.NiftiData(fname)
+        self.assertEqual(nifti_data.raw().dtype, np.uint8)
+        self.assertTrue(np.array_equal(nifti_data.raw(), self.ints))
+
+    def testIvmSparse(self):
+        ivm = ImageVolumeManagement()
+        min_voxels = volume_management.SPARSE_ROI_MIN_VOXELS
+        volume_management.SPARSE_ROI_MIN_VOXELS = 1
+        try:
+            roi = ivm.add(NumpyData(self.ints, grid=self.grid, name="roi", roi=True), sparse=True)
+            ivm.add(NumpyData(self.ints, grid=self.grid, name="data"), sparse=True)
+            self.assertTrue(isinstance(ivm.data["roi"], SparseRoiData))
+            self.assertTrue(roi is ivm.data["roi"])
+            self.assertFalse(isinstance(ivm.data["data"], SparseRoiData))
+
+            # Not converted unless requested, so the caller's data item is the one stored
+            dense = NumpyData(self.ints, grid=self.grid, name="dense", roi=True)
+            self.assertTrue(ivm.add(dense) is dense)
+            self.assertTrue(ivm.data["dense"] is dense)
+        finally:
+            volume_management.SPARSE_ROI_MIN_VOXELS = min_voxels
+
+class ExpressionDataTest(unittest.TestCase):
+    """ Tests for the ExpressionData subclass of QpData """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        self.grid = DataGrid(self.shape, np.identity(4))
+        self.floats4d = np.random.rand(*(self.shape + [NVOLS,])).astype(np.float32)
+        self.ones4d = np.ones(self.shape + [NVOLS,], dtype=np.float32)
+        self.data = {
+            "a" : NumpyData(self.floats4d, grid=self.grid, name="a"),
+            "b" : NumpyData(self.ones4d, grid=self.grid, name="b"),
+            "c" : NumpyData(self.floats4d[..., 0], grid=self.grid, name="c"),
+        }
+
+    def testElementwise(self):
+        self.assertEqual(expression.elementwise_names("a * 2 + np.exp(b)"), set(["a", "b"]))
+        self.assertEqual(expression.elementwise_names("np.where(a > 0.5, a, -b)"), set(["a", "b"]))
+        self.assertTrue(expression.elementwise_names("a - np.mean(a)") is None)
+        self.assertTrue(expression.elementwise_names("a[..., 0]") is None)
+        self.assertTrue(expression.elementwise_names("a.T") is None)
+        self.assertTrue(expression.elementwise_names("scipy.ndimage.gaussian_filter(a, 2)") is None)
+
+    def testCreate(self):
+        self.assertTrue(ExpressionData.create("a - b", self.data, self.grid, "test") is not None)
+        self.assertTrue(ExpressionData.create("a - np.mean(a)", self.data, self.grid, "test") is None)
+        self.assertTrue(ExpressionData.create("a - d", self.data, self.grid, "test") is None)
+        # Different numbers of volumes
+        self.assertTrue(ExpressionData.create("a - c", self.data, self.grid, "test") is None)
+
+    def testVolume(self):
+        qpd = ExpressionData.create("a / (b + 1)", self.data, self.grid, "test")
+        self.assertEqual(qpd.nvols, NVOLS)
+        self.assertTrue(np.allclose(qpd.volume(2), self.floats4d[..., 2] / 2))
+        self.assertTrue(qpd.memory_usage() == 0)
+
+    def testSliceData(self):
+        qpd = ExpressionData.create("a - b", self.data, self.grid, "test")
+        plane = OrthoSlice(self.grid, 1, 2)
+        sdata, _, _, _ = qpd.slice_data(plane, vol=3)
+        self.assertTrue(np.allclose(sdata, self.floats4d[:, 2, :, 3] - 1))
+        self.assertTrue(qpd.memory_usage() < self.floats4d.nbytes)
+
+    def testTimeseries(self):
+        qpd = ExpressionData.create("a * b * 3", self.data, self.grid, "test")
+        self.assertTrue(np.allclose(qpd.timeseries([1, 2, 3]), self.floats4d[1, 2, 3] * 3))
+        self.assertAlmostEqual(qpd.value([1, 2, 3, 2]), self.floats4d[1, 2, 3, 2] * 3, places=5)
+        curves = qpd.timeseries_many([[1, 2, 3], [4, 0, 1]])
+        self.assertTrue(np.allclose(curves[1], self.floats4d[4, 0, 1] * 3))
+
+    def testRaw(self):
+        chunk_size = expression.EXPRESSION_CHUNK_SIZE
+        expression.EXPRESSION_CHUNK_SIZE = GRIDSIZE * GRIDSIZE * NVOLS * 2
+        try:
+            qpd = ExpressionData.create("a * 2", self.data, self.grid, "test")
+            self.assertEqual(qpd.raw().dtype, np.float32)
+            self.assertTrue(np.allclose(qpd.raw(), self.floats4d * 2))
+            self.assertFalse(qpd.raw().flags.writeable)
+            qpd.uncache()
+            self.assertEqual(qpd.memory_usage(), 0)
+        finally:
+            expression.EXPRESSION_CHUNK_SIZE = chunk_size
+
+    def testInputChanged(self):
+        qpd = ExpressionData.create("c + 1", self.data, self.grid, "test")
+        self.assertAlmostEqual(qpd.range()[1], np.max(self.floats4d[..., 0]) + 1, places=5)
+        self.data["c"].rawdata = self.floats4d[..., 0] * 10
+        self.assertAlmostEqual(qpd.range()[1], np.max(self.floats4d[..., 0]) * 10 + 1, places=4)
+        self.assertTrue(np.allclose(qpd.raw(), self.floats4d[..., 0] * 10 + 1))
+
+    def testInputReplaced(self):
+        qpd = ExpressionData.create("c + 1", self.data, self.grid, "test")
+        self.assertTrue(np.allclose(qpd.raw(), self.floats4d[..., 0] + 1))
+        self.data["c"] = NumpyData(self.floats4d[..., 1], grid=self.grid, name="c")
+        self.assertTrue(np.allclose(qpd.raw(), self.floats4d[..., 1] + 1))
+        self.assertTrue(np.allclose(qpd.volume(0), self.floats4d[..., 1] + 1))
+
+    def testInputDeleted(self):
+        qpd = ExpressionData.create("c + 1", self.data, self.grid, "test")
+        qpd.raw()
+        del self.data["c"]
+        self.assertRaises(QpException, qpd.raw)
+        self.assertEqual(qpd.memory_usage(), 0)
+
+    def testInputIncompatible(self):
+        qpd = ExpressionData.create("c + 1", self.data, self.grid, "test")
+        self.data["c"] = NumpyData(self.floats4d, grid=self.grid, name="c")
+        self.assertRaises(QpException, qpd.volume, 0)
+
+    def testCircular(self):
+        self.assertTrue(ExpressionData.create("a * 2", self.data, self.grid, "a") is None)
+        self.data["d"] = ExpressionData.create("a * 2", self.data, self.grid, "d")
+        self.assertTrue(ExpressionData.create("d + 1", self.data, self.grid, "a") is None)
+
+class PyramidTest(unittest.TestCase):
+    """ Tests for reduced resolution levels of QpData """
+
+    def setUp(self):
+        self.orig_consts = qpdata.PYRAMID_MIN_VOXELS, qpdata.PYRAMID_MIN_SIZE, qpdata.OVERVIEW_VOXELS
+        qpdata.PYRAMID_MIN_VOXELS, qpdata.PYRAMID_MIN_SIZE, qpdata.OVERVIEW_VOXELS = 1000, 4, 100
+        self.shape = [16, 12, 9]
+        affine = np.array([[2, 0, 0, -10], [0, 1.5, 0, 3], [0, 0, 3, 0], [0, 0, 0, 1]], dtype=float)
+        self.grid = DataGrid(self.shape, affine)
+        self.floats4d = np.random.rand(*(self.shape + [NVOLS,])).astype(np.float32)
+        self.ints = np.random.randint(0, 4, self.shape)
+
+    def tearDown(self):
+        qpdata.PYRAMID_MIN_VOXELS, qpdata.PYRAMID_MIN_SIZE, qpdata.OVERVIEW_VOXELS = self.orig_consts
+
+    def testLevels(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        self.assertEqual(qpd.pyramid_levels(), 2)
+        small = NumpyData(self.floats4d[:8, :8, :8], grid=DataGrid([8, 8, 8], np.identity(4)), name="small")
+        self.assertEqual(small.pyramid_levels(), 0)
+
+    def testBlockAverage(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        level = qpd.pyramid_level(1, vol=2)
+        self.assertEqual(list(level.grid.shape), [8, 6, 5])
+        self.assertEqual(level.nvols, 1)
+        self.assertFalse(level.raw().flags.writeable)
+        expected = self.floats4d[:, :, :8, 2].reshape(8, 2, 6, 2, 4, 2).mean(axis=(1, 3, 5))
+        self.assertTrue(np.allclose(level.raw()[:, :, :4], expected))
+        # Odd size - last block is smaller
+        expected = self.floats4d[:, :, 8, 2].reshape(8, 2, 6, 2).mean(axis=(1, 3))
+        self.assertTrue(np.allclose(level.raw()[:, :, 4], expected))
+
+    def testGrid(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        level = qpd.pyramid_level(1)
+        # Centre of a reduced voxel is the centre of the block it was averaged from
+        block_centre = np.mean([self.grid.grid_to_world([2, 4, 6]), self.grid.grid_to_world([3, 5, 7])], axis=0)
+        self.assertTrue(np.allclose(level.grid.grid_to_world([1, 2, 3]), block_centre))
+
+    def testMultipleLevels(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        level2 = qpd.pyramid_level(2, vol=1)
+        self.assertEqual(list(level2.grid.shape), [4, 3, 3])
+        self.assertTrue(qpd.pyramid_level(1, vol=1, build=False) is not None)
+        self.assertTrue(qpd.pyramid_level(1, vol=0, build=False) is None)
+        self.assertAlmostEqual(level2.raw()[0, 0, 0], np.mean(self.floats4d[:4, :4, :4, 1]), places=5)
+        self.assertTrue(qpd.pyramid_level(2, vol=1) is level2)
+
+    def testRoi(self):
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        level = qpd.pyramid_level(1)
+        self.assertTrue(level.roi)
+        self.assertTrue(np.array_equal(level.raw(), self.ints[::2, ::2, ::2]))
+        self.assertTrue(np.allclose(level.grid.grid_to_world([1, 2, 3]), self.grid.grid_to_world([2, 4, 6])))
+
+    def testInvalidated(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        level1 = qpd.pyramid_level(1)
+        self.assertTrue(qpd.memory_usage() > self.floats4d.nbytes)
+        qpd.rawdata = self.floats4d * 2
+        self.assertTrue(qpd.pyramid_level(1, build=False) is None)
+        self.assertTrue(np.allclose(qpd.pyramid_level(1).raw(), level1.raw() * 2))
+
+    def testSliceData(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        level = qpd.pyramid_level(1, vol=3)
+        plane = OrthoSlice(self.grid, 2, 4)
+        sdata, _, scale, _ = level.slice_data(plane)
+        self.assertEqual(list(sdata.shape), [8, 6])
+        self.assertTrue(np.allclose(np.abs(np.diag(scale)), [2, 2]))
+
+    def testOverview(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        self.assertEqual(list(qpd.overview(vol=1).grid.shape), [4, 3, 3])
+        cmin, cmax = qpd.suggest_cmap_range(vol=1)
+        level = qpd.pyramid_level(2, vol=1)
+        self.assertAlmostEqual(cmax, np.max(level.raw()), places=5)
+        # Uses the exact statistics if available
+        qpd.stats(vol=1)
+        cmin, cmax = qpd.suggest_cmap_range(vol=1)
+        self.assertAlmostEqual(cmax, np.max(self.floats4d[..., 1]), places=5)
+
 class NiftiDataTest(unittest.TestCase):
     """ Tests for the NiftiData subclass of QpData """
 
@@ -150,6 +727,37 @@ class NiftiDataTest(unittest.TestCase):
             self.assertTrue(key in nifti_data.metadata)
             self.assertEqual(nifti_data.metadata[key], value)
 
+    def testSaveLoadStats(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        stats = qpd.stats(vol=2)
+        qpd.stats()
+        nifti.save(qpd, fname)
+
+        # Summaries are restored from the file so the data does not need to be read
+        nifti_data = nifti.NiftiData(fname)
+        self.assertEqual(set(nifti_data.cached_stats().keys()), set([None, 2]))
+        self.assertAlmostEqual(nifti_data.range(vol=2)[1], stats["max"])
+        self.assertTrue(nifti_data.rawdata is None)
+        self.assertTrue(np.all(nifti_data.stats(vol=2)["hist"] == stats["hist"]))
+
+    def testSaveRoiDtype(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "roi.nii.gz")
+        qpd = NumpyData(self.ints, grid=self.grid, name="roi", roi=True)
+        nifti.save(qpd, fname)
+        self.assertEqual(nib.load(fname).get_data_dtype(), np.uint8)
+
+        # Header of a source file with a different data type is overridden
+        fname2 = os.path.join(tempdir, "roi2.nii.gz")
+        nib.save(nib.Nifti1Image(self.ints.astype(np.int64), np.identity(4)), fname2)
+        nifti_data = nifti.NiftiData(fname2)
+        nifti_data.roi = True
+        nifti.save(nifti_data, fname)
+        self.assertEqual(nib.load(fname).get_data_dtype(), np.uint8)
+        self.assertTrue(np.all(nib.load(fname).get_fdata() == self.ints))
+
     def testLoadSaveSameName(self):
         qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
 
@@ -160,5 +768,337 @@ class NiftiDataTest(unittest.TestCase):
         nifti_data = nifti.NiftiData(fname)
         nifti.save(nifti_data, fname)
 
+    def testLoadSaveSameNameMmap(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(qpd, fname)
+
+        nifti_data = nifti.NiftiData(fname, mmap=True)
+        nifti.save(nifti_data, fname)
+        self.assertTrue(np.allclose(nib.load(fname).get_fdata(), self.floats4d))
+
+    def testSaveCompressed(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        block_size, nthreads = gzip_writer.GZIP_BLOCK_SIZE, gzip_writer.GZIP_THREADS
+        try:
+            # Use small blocks so the data is split between several threads
+            gzip_writer.GZIP_BLOCK_SIZE, gzip_writer.GZIP_THREADS = 256, 3
+            nifti.save(qpd, fname)
+        finally:
+            gzip_writer.GZIP_BLOCK_SIZE, gzip_writer.GZIP_THREADS = block_size, nthreads
+
+        # Must be a single valid gzip stream readable by standard tools
+        with gzip.open(fname, "rb") as gzfile:
+            self.assertTrue(len(gzfile.read()) > qpd.raw().nbytes)
+        self.assertTrue(np.allclose(nib.load(fname).get_fdata(), self.floats4d))
+        self.assertTrue(np.allclose(nifti.NiftiData(fname).volume(2), self.floats4d[..., 2]))
+
+    def testMmap(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nib.save(nib.Nifti1Image(self.floats4d.astype(np.float32), np.identity(4)), fname)
+
+        nifti_data = nifti.NiftiData(fname, mmap=True)
+        self.assertTrue(nifti_data.mmap)
+        self.assertTrue(isinstance(nifti_data.raw(), np.memmap))
+        for idx in range(NVOLS):
+            self.assertTrue(np.allclose(nifti_data.volume(idx), self.floats4d[..., idx]))
+
+        vol = nifti_data.volume(1, qpdata=True)
+        self.assertTrue(np.shares_memory(vol.raw(), nifti_data.raw()))
+        arr = nifti_data.writeable_raw()
+        self.assertTrue(arr.flags.writeable)
+        self.assertFalse(nifti_data.mmap)
+
+        nifti_data.materialize()
+        self.assertFalse(nifti_data.mmap)
+        self.assertFalse(isinstance(nifti_data.raw(), np.memmap))
+        self.assertTrue(np.allclose(nifti_data.raw(), self.floats4d))
+
+    def testSaveResampledNotReloaded(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        shape = [GRIDSIZE*2] * 3
+        nifti.save(NumpyData(np.random.rand(*shape), grid=DataGrid(shape, np.identity(4)), name="test"), fname)
+        nifti_data = nifti.NiftiData(fname)
+        nifti_data.raw()
+
+        # File is not a copy of the data so the data is not re-read from it
+        nifti.save(nifti_data, os.path.join(tempdir, "resampled.nii"), grid=DataGrid(self.shape, np.diag([2, 2, 2, 1])))
+        self.assertEqual(nifti_data.fname, fname)
+        self.assertFalse(nifti_data.reloadable)
+        nifti_data.uncache()
+        self.assertEqual(list(nifti_data.raw().shape), shape)
+
+    def testSaveEditedReloadable(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(NumpyData(self.floats, grid=self.grid, name="test"), fname)
+        nifti_data = nifti.NiftiData(fname)
+        nifti_data.writeable_raw()[1, 2, 3] = 7
+        nifti_data.invalidate()
+        self.assertFalse(nifti_data.reloadable)
+
+        # Exact copy is saved so the data can be re-read from it
+        copy_fname = os.path.join(tempdir, "copy.nii")
+        nifti.save(nifti_data, copy_fname)
+        self.assertEqual(nifti_data.fname, copy_fname)
+        self.assertTrue(nifti_data.reloadable)
+        nifti_data.uncache()
+        self.assertTrue(nifti_data.rawdata is None)
+        self.assertEqual(nifti_data.raw()[1, 2, 3], 7)
+
+    def testMmapCompressed(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        nib.save(nib.Nifti1Image(self.floats4d.astype(np.float32), np.identity(4)), fname)
+
+        nifti_data = nifti.NiftiData(fname, mmap=True)
+        self.assertFalse(nifti_data.mmap)
+        self.assertTrue(np.allclose(nifti_data.raw(), self.floats4d))
+
+    @unittest.skipIf(not nifti.HAVE_INDEXED_GZIP, "indexed_gzip not available")
+    def testGzipIndex(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        nib.save(nib.Nifti1Image(self.floats4d.astype(np.float32), np.identity(4)), fname)
+
+        save_index = nifti.GZIP_INDEX_SAVE
+        try:
+            nifti.GZIP_INDEX_SAVE = True
+            nifti_data = nifti.NiftiData(fname)
+            for idx in reversed(range(NVOLS)):
+                self.assertTrue(np.allclose(nifti_data.volume(idx), self.floats4d[..., idx]))
+            self.assertTrue(os.path.exists(fname + nifti.GZIP_INDEX_EXT))
+
+            nifti_data = nifti.NiftiData(fname)
+            self.assertTrue(np.allclose(nifti_data.volume(2), self.floats4d[..., 2]))
+        finally:
+            nifti.GZIP_INDEX_SAVE = save_index
+
+    def testUncacheDuringLoad(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nib.save(nib.Nifti1Image(self.floats4d.astype(np.float32), np.identity(4)), fname)
+        nifti_data = nifti.NiftiData(fname)
+
+        def _read(idx):
+            if idx % 2:
+                nifti_data.uncache()
+            return nifti_data.volume(idx % NVOLS)
+
+        pool = ThreadPool(4)
+        try:
+            vols = pool.map(_read, range(40))
+        finally:
+            pool.terminate()
+        for idx, vol in enumerate(vols):
+            self.assertTrue(np.allclose(vol, self.floats4d[..., idx % NVOLS]))
+
+    @unittest.skipIf(not nifti.HAVE_INDEXED_GZIP, "indexed_gzip not available")
+    def testGzipIndexClosed(self):
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        nib.save(nib.Nifti1Image(self.floats4d.astype(np.float32), np.identity(4)), fname)
+
+        nifti_data = nifti.NiftiData(fname)
+        nifti_data.volume(1)
+        fileobj = nifti_data._indexed_file
+        self.assertFalse(fileobj is None)
+        nifti_data.uncache()
+        self.assertTrue(fileobj.closed)
+        self.assertTrue(nifti_data._indexed_file is None)
+        self.assertTrue(np.allclose(nifti_data.volume(1), self.floats4d[..., 1]))
+
+@unittest.skipIf(not hdf5.HAVE_H5PY, "h5py not available")
+class Hdf5DataTest(unittest.TestCase):
+    """ Tests for the Hdf5Data subclass of QpData """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        self.grid = DataGrid(self.shape, np.identity(4))
+        self.floats4d = np.random.rand(*(self.shape + [NVOLS,])).astype(np.float32)
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        self.fname = os.path.join(tempdir, "test.h5")
+        hdf5.save(NumpyData(self.floats4d, grid=self.grid, name="test"), self.fname)
+
+    def testLoad(self):
+        qpd = hdf5.Hdf5Data(self.fname)
+        self.assertEqual(qpd.nvols, NVOLS)
+        self.assertTrue(np.allclose(qpd.grid.affine, self.grid.affine))
+        self.assertTrue(np.allclose(qpd.raw(), self.floats4d))
+
+    def testVolume(self):
+        qpd = hdf5.Hdf5Data(self.fname)
+        for idx in range(NVOLS):
+            self.assertTrue(np.allclose(qpd.volume(idx), self.floats4d[..., idx]))
+        self.assertTrue(qpd.rawdata is None)
+
+    def testVolumeQpdataReadOnly(self):
+        qpd = hdf5.Hdf5Data(self.fname)
+        qpd.raw()
+        vol = qpd.volume(1, qpdata=True)
+        self.assertTrue(np.allclose(vol.raw(), self.floats4d[..., 1]))
+        self.assertFalse(vol.raw().flags.writeable)
+
+    def testTimeseries(self):
+        qpd = hdf5.Hdf5Data(self.fname)
+        POS = [2, 3, 4]
+        self.assertTrue(np.allclose(qpd.timeseries(POS), self.floats4d[POS[0], POS[1], POS[2], :]))
+        self.assertTrue(qpd.rawdata is None)
+
+    def testValue(self):
+        qpd = hdf5.Hdf5Data(self.fname)
+        mem = NumpyData(self.floats4d, grid=self.grid, name="test")
+        for pos in ([2, 3, 4], [2, 3, 4, 1], [0, 0, 0, NVOLS+1], [-1, 2, 2, 0], [2, 2, GRIDSIZE, 0]):
+            self.assertEqual(qpd.value(pos), mem.value(pos))
+            self.assertEqual(qpd.value(pos, as_str=True), mem.value(pos, as_str=True))
+        self.assertTrue(qpd.rawdata is None)
+
+    def testTimeseriesMany(self):
+        chunk_shape = hdf5.CHUNK_SHAPE
+        hdf5.CHUNK_SHAPE = (2, 2, 2, 2)
+        try:
+            hdf5.save(NumpyData(self.floats4d, grid=self.grid, name="test"), self.fname)
+        finally:
+            hdf5.CHUNK_SHAPE = chunk_shape
+        qpd = hdf5.Hdf5Data(self.fname)
+        points = np.random.randint(0, GRIDSIZE, (20, 3))
+        curves = qpd.timeseries_many(points)
+        self.assertTrue(qpd.rawdata is None)
+        self.assertTrue(np.allclose(curves, self.floats4d[points[:, 0], points[:, 1], points[:, 2]]))
+
+    def testSaveResampledNotReloaded(self):
+        qpd = hdf5.Hdf5Data(self.fname)
+        qpd.raw()
+        grid = DataGrid([2, 2, 2], np.diag([2, 2, 2, 1]))
+        hdf5.save(qpd, os.path.join(os.path.dirname(self.fname), "resampled.h5"), grid=grid)
+        self.assertEqual(qpd.fname, self.fname)
+        qpd.uncache()
+        self.assertEqual(list(qpd.raw().shape), self.shape + [NVOLS])
+
+    def testSliceData(self):
+        qpd = hdf5.Hdf5Data(self.fname)
+        for axis in range(3):
+            plane = OrthoSlice(self.grid, axis, 1)
+            sdata, _, _, _ = qpd.slice_data(plane, vol=2)
+            slices = [slice(None)] * 3 + [2]
+            slices[axis] = 1
+            self.assertTrue(np.allclose(sdata, self.floats4d[tuple(slices)]))
+        self.assertTrue(qpd.rawdata is None)
+
+@unittest.skipIf(not dicoms.HAVE_PYDICOM, "pydicom not available")
+class DicomFolderTest(unittest.TestCase):
+    """ Tests for the DicomFolder subclass of QpData """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE+1, GRIDSIZE+2]
+        self.ints4d = np.random.randint(0, 1000, self.shape + [NVOLS,]).astype(np.uint16)
+        self.dirname = tempfile.mkdtemp(prefix="qp")
+        instance = 0
+        for vol in range(NVOLS):
+            for slc in range(self.shape[2]):
+                instance += 1
+                # Name files so that directory order is not the acquisition order
+                fname = os.path.join(self.dirname, "img%04i.dcm" % (NVOLS*self.shape[2] - instance))
+                self._write_dcm(fname, self.ints4d[:, :, slc, vol], slc, instance)
+        with open(os.path.join(self.dirname, "notes.txt"), "w") as txt_file:
+            txt_file.write("Not a DICOM file")
+        self.index_dir = dicoms.DICOM_INDEX_DIR
+        dicoms.DICOM_INDEX_DIR = tempfile.mkdtemp(prefix="qp")
+
+    def tearDown(self):
+        dicoms.DICOM_INDEX_DIR = self.index_dir
+
+    def _write_dcm(self, fname, pixels, slice_loc, instance, series_uid=None):
+        import pydicom
+        meta = pydicom.dataset.FileMetaDataset()
+        meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+        meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        dcm = pydicom.dataset.FileDataset(fname, {}, file_meta=meta, preamble=b"\0" * 128)
+        dcm.is_little_endian, dcm.is_implicit_VR = True, False
+        dcm.SOPClassUID = meta.MediaStorageSOPClassUID
+        dcm.Modality = "MR"
+        dcm.Rows, dcm.Columns = pixels.shape
+        dcm.BitsAllocated, dcm.BitsStored, dcm.HighBit, dcm.PixelRepresentation = 16, 16, 15, 0
+        dcm.SamplesPerPixel, dcm.PhotometricInterpretation = 1, "MONOCHROME2"
+        dcm.SliceLocation, dcm.InstanceNumber = slice_loc, instance
+        dcm.ImagePositionPatient, dcm.ImageOrientationPatient = [0, 0, slice_loc], [1, 0, 0, 0, 1, 0]
+        dcm.PixelSpacing, dcm.SliceThickness = [1, 1], 1
+        if series_uid is not None:
+            dcm.SeriesInstanceUID = series_uid
+        dcm.PixelData = pixels.tobytes()
+        dcm.save_as(fname)
+
+    def testLoad(self):
+        progress = []
+        qpd = dicoms.DicomFolder(self.dirname, progress_cb=progress.append)
+        self.assertEqual(qpd.nvols, NVOLS)
+        self.assertEqual(list(qpd.grid.shape), self.shape)
+        self.assertEqual(qpd.raw().dtype, np.uint16)
+        self.assertTrue(np.all(qpd.raw() == self.ints4d))
+        self.assertEqual(progress, sorted(progress))
+        self.assertAlmostEqual(progress[-1], 1)
+
+    def testVolume(self):
+        qpd = dicoms.DicomFolder(self.dirname)
+        self.assertTrue(np.all(qpd.volume(1) == self.ints4d[..., 1]))
+        self.assertTrue(qpd.dcmdata is None)
+
+    def testVolumeQpdataReadOnly(self):
+        qpd = dicoms.DicomFolder(self.dirname)
+        vol = qpd.volume(1, qpdata=True)
+        self.assertTrue(np.all(vol.raw() == self.ints4d[..., 1]))
+        self.assertFalse(vol.raw().flags.writeable)
+        self.assertTrue(np.shares_memory(vol.raw(), qpd.volume(1)))
+
+    def testIndexedBeforeDcmstack(self):
+        def _dcmstack(_self, fname):
+            raise AssertionError("DCMSTACK used for a folder which can be indexed")
+        dcmstack = dicoms.DicomFolder._dcmstack
+        dicoms.DicomFolder._dcmstack = _dcmstack
+        try:
+            qpd = dicoms.DicomFolder(self.dirname)
+        finally:
+            dicoms.DicomFolder._dcmstack = dcmstack
+        self.assertTrue(qpd._index is not None)
+        self.assertTrue(dicoms._load_index(self.dirname) is not None)
+
+    def testMultipleSeriesNotIndexed(self):
+        # Second series with the same number of files per slice location would
+        # otherwise be stacked as extra volumes
+        for slc in range(self.shape[2]):
+            fname = os.path.join(self.dirname, "series2_%04i.dcm" % slc)
+            self._write_dcm(fname, self.ints4d[:, :, slc, 0], slc, slc+1, series_uid="1.2.3.4")
+        with self.assertRaises(QpException):
+            dicoms._build_index(self.dirname)
+
+    def testSavedIndex(self):
+        dicoms.DicomFolder(self.dirname)
+        index = dicoms._load_index(self.dirname)
+        self.assertTrue(index is not None)
+
+        qpd = dicoms.DicomFolder(self.dirname)
+        self.assertEqual(qpd._index, index)
+        self.assertEqual(list(qpd.grid.shape), self.shape)
+        self.assertTrue(np.all(qpd.raw() == self.ints4d))
+
+        # Index is out of date if folder contents change
+        with open(os.path.join(self.dirname, "notes2.txt"), "w") as txt_file:
+            txt_file.write("Not a DICOM file either")
+        self.assertTrue(dicoms._load_index(self.dirname) is None)
+
+    def testReload(self):
+        qpd = dicoms.DicomFolder(self.dirname)
+        self.assertTrue(qpd.reloadable)
+        qpd.uncache()
+        self.assertEqual(qpd.memory_usage(), 0)
+        self.assertTrue(np.all(qpd.raw() == self.ints4d))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,201 @@
+"""
+Quantiphyse - Tests for caching the results of processes
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+from quantiphyse.data.extras import NumberListExtra
+from quantiphyse.processes import Process
+import quantiphyse.processes.result_cache as result_cache
+
+# Names of processes which have been run
+RUNS = []
+
+def _scale_worker(worker_id, queue, data, scale):
+    return worker_id, True, [data * scale]
+
+class ScaleProcess(Process):
+    """
+    Scales data and records the number of times it has been run
+    """
+    CACHEABLE = True
+
+    def run(self, options):
+        RUNS.append("scale")
+        data = self.get_data(options)
+        self.output_name = options.pop("output-name", "scaled")
+        scale = options.pop("scale", 2)
+        self.ivm.add(NumpyData(data.raw() * scale, grid=data.grid, name=self.output_name), make_current=True)
+        self.ivm.add_extra("scale", NumberListExtra("scale", [scale]))
+        delete = options.pop("delete", None)
+        if delete is not None:
+            self.ivm.delete(delete)
+        self.log("Scaled by %s\n" % scale)
+
+    def output_data_items(self):
+        return [self.output_name]
+
+class BgScaleProcess(Process):
+    """
+    Scales data in a background worker
+    """
+    CACHEABLE = True
+
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, worker_fn=_scale_worker, sync=True, **kwargs)
+
+    def run(self, options):
+        RUNS.append("bg_scale")
+        self.data = self.get_data(options)
+        self.start_bg([self.data.raw(), options.pop("scale", 2)], n_workers=2)
+
+    def finished(self, worker_output):
+        self.ivm.add(NumpyData(self.recombine_data([output[0] for output in worker_output]), grid=self.data.grid, name="bg_scaled"))
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.orig_cache_dir = result_cache.RESULT_CACHE_DIR
+        result_cache.RESULT_CACHE_DIR = self.cache_dir
+        del RUNS[:]
+
+        self.ivm = ImageVolumeManagement()
+        self.grid = DataGrid([10, 10, 10], np.identity(4))
+        self.data = np.random.rand(10, 10, 10).astype(np.float32)
+        self.ivm.add(NumpyData(self.data, grid=self.grid, name="data"))
+        self.ivm.add(NumpyData(np.ones((10, 10, 10), dtype=np.int8), grid=self.grid, name="mask", roi=True))
+
+    def tearDown(self):
+        result_cache.RESULT_CACHE_DIR = self.orig_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def _run(self, proc_class=ScaleProcess, **options):
+        process = proc_class(self.ivm)
+        options.setdefault("cache", True)
+        process.execute(options)
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        return process
+
+    def _reset_outputs(self):
+        for name in ("scaled", "bg_scaled"):
+            if name in self.ivm.data:
+                self.ivm.delete(name)
+        self.ivm.extras.pop("scale", None)
+
+    def testCacheHit(self):
+        self._run(scale=3)
+        self.assertEqual(len(glob.glob(os.path.join(self.cache_dir, "*"))), 1)
+        self._reset_outputs()
+
+        process = self._run(scale=3)
+        self.assertEqual(RUNS, ["scale"])
+        self.assertTrue(np.allclose(self.ivm.data["scaled"].raw(), self.data * 3))
+        self.assertEqual(self.ivm.current_data.name, "scaled")
+        self.assertEqual(self.ivm.extras["scale"].values, [3])
+        self.assertEqual(process.get_output_data_items(), ["scaled"])
+        self.assertEqual(process.get_log(), "Scaled by 3\n")
+
+    def testCachedThenNotCached(self):
+        self._run(scale=3)
+        self._reset_outputs()
+        process = ScaleProcess(self.ivm)
+        process.execute({"scale" : 3, "cache" : True})
+        self.assertEqual(process.get_output_data_items(), ["scaled"])
+        self._reset_outputs()
+
+        # Outputs restored from the cache are not reported for a later run
+        process.execute({"scale" : 4, "output-name" : "scaled4"})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertEqual(RUNS, ["scale", "scale"])
+        self.assertEqual(process.get_output_data_items(), ["scaled4"])
+
+    def testChangedOptions(self):
+        self._run(scale=3)
+        self._reset_outputs()
+        self._run(scale=4)
+        self.assertEqual(RUNS, ["scale", "scale"])
+        self.assertTrue(np.allclose(self.ivm.data["scaled"].raw(), self.data * 4))
+
+    def testChangedData(self):
+        self._run()
+        self._reset_outputs()
+        self.ivm.data["data"].rawdata = self.data + 1
+        self._run()
+        self.assertEqual(RUNS, ["scale", "scale"])
+        self.assertTrue(np.allclose(self.ivm.data["scaled"].raw(), (self.data + 1) * 2))
+
+    def testUnrelatedData(self):
+        self.ivm.add(NumpyData(self.data, grid=self.grid, name="other"), make_current=False)
+        self._run(data="data")
+        self._reset_outputs()
+        self.ivm.data["other"].rawdata = self.data + 1
+        self._run(data="data")
+        self.assertEqual(RUNS, ["scale"])
+        # Data which the process does not use is not read to fingerprint it
+        self.assertTrue(self.ivm.data["other"]._fingerprint is None)
+
+    def testNotCached(self):
+        self._run(cache=False)
+        self._reset_outputs()
+        self._run(cache=False)
+        self.assertEqual(RUNS, ["scale", "scale"])
+        self.assertEqual(glob.glob(os.path.join(self.cache_dir, "*")), [])
+
+    def testDeleted(self):
+        self._run(delete="mask")
+        self._reset_outputs()
+        self.ivm.add(NumpyData(np.ones((10, 10, 10), dtype=np.int8), grid=self.grid, name="mask", roi=True))
+        self._run(delete="mask")
+        self.assertEqual(RUNS, ["scale"])
+        self.assertTrue("mask" not in self.ivm.data)
+
+    def testBackground(self):
+        self._run(BgScaleProcess, scale=5)
+        self._reset_outputs()
+        self._run(BgScaleProcess, scale=5)
+        self.assertEqual(RUNS, ["bg_scale"])
+        self.assertTrue(np.allclose(self.ivm.data["bg_scaled"].raw(), self.data * 5))
+
+    def testEvict(self):
+        for scale in range(3):
+            self._run(scale=scale)
+            self._reset_outputs()
+        fnames = sorted(glob.glob(os.path.join(self.cache_dir, "*")), key=os.path.getmtime)
+        self.assertEqual(len(fnames), 3)
+        # Oldest results removed first
+        os.utime(fnames[0], (0, 0))
+        result_cache.evict(os.path.getsize(fnames[1]) + os.path.getsize(fnames[2]))
+        self.assertEqual(sorted(glob.glob(os.path.join(self.cache_dir, "*"))), sorted(fnames[1:]))
+        result_cache.clear()
+        self.assertEqual(glob.glob(os.path.join(self.cache_dir, "*")), [])
+
+    def testUncacheableOption(self):
+        process = ScaleProcess(self.ivm)
+        self.assertTrue(result_cache.cache_key(process, {"scale" : 2}) is not None)
+        self.assertTrue(result_cache.cache_key(process, {"scale" : object()}) is None)
+        self.assertEqual(result_cache.cache_key(process, {"a" : 1, "b" : [1, 2]}),
+                         result_cache.cache_key(process, {"b" : [1, 2], "a" : 1}))
+
+if __name__ == '__main__':
+    unittest.main()
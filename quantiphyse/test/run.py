@@ -3,11 +3,16 @@ import unittest
 from quantiphyse.utils import get_plugins
 
 from .ivm_test import IVMTest
-from .qpd_test import NumpyDataTest, NiftiDataTest
+from .qpd_test import DataGridTest, NumpyDataTest, SparseRoiDataTest, ExpressionDataTest, PyramidTest, NiftiDataTest, Hdf5DataTest, DicomFolderTest
 from .slice_plane_test import OrthoSliceTest
-from .io_test import IoProcessTest
-
-class_tests = [IVMTest, NumpyDataTest, NiftiDataTest, OrthoSliceTest, IoProcessTest,]
+from .prefetch_test import SlicePrefetcherTest
+from .io_test import IoProcessTest, SessionTest, AsyncLoaderTest
+from .pool_test import WorkerPoolTest
+from .sharedmem_test import SharedMemoryTest
+from .chunking_test import ChunkingTest
+from .result_cache_test import ResultCacheTest
+
+class_tests = [IVMTest, DataGridTest, NumpyDataTest, SparseRoiDataTest, ExpressionDataTest, PyramidTest, NiftiDataTest, Hdf5DataTest, DicomFolderTest, OrthoSliceTest, SlicePrefetcherTest, IoProcessTest, SessionTest, AsyncLoaderTest, WorkerPoolTest, SharedMemoryTest, ChunkingTest, ResultCacheTest]
 
 def run_tests(test_filter=None):
     """
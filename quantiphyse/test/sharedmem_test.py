@@ -0,0 +1,127 @@
+"""
+Quantiphyse - Tests for passing arrays to worker processes in shared memory
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import pickle
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import ImageVolumeManagement
+from quantiphyse.processes import Process, SharedArray
+import quantiphyse.processes.sharedmem as sharedmem
+
+# Large enough to be passed in shared memory
+SHAPE = (64, 64, 128)
+
+def _shared_worker(worker_id, queue, data, out):
+    """
+    Return whether the input was received in shared memory, and write
+    the result into the output array in place
+    """
+    in_shared = not data.flags.owndata
+    out[...] = data * 2
+    return worker_id, True, [in_shared, data + 1]
+
+class SharedProcess(Process):
+
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, worker_fn=_shared_worker, sync=True, **kwargs)
+
+    def run(self, options):
+        self.data = options.pop("data")
+        self.out = SharedArray(self.data.shape, self.data.dtype)
+        self.start_bg([self.data, self.out], n_workers=options.pop("n-workers", 2))
+
+    def finished(self, worker_output):
+        self.in_shared = [output[0] for output in worker_output]
+        self.output = self.recombine_data([output[1] for output in worker_output])
+
+@unittest.skipIf(not sharedmem.HAVE_SHARED_MEMORY, "Shared memory not available")
+class SharedMemoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ivm = ImageVolumeManagement()
+        self.data = np.random.rand(*SHAPE).astype(np.float32)
+
+    def testFromArray(self):
+        shared = SharedArray.from_array(self.data)
+        try:
+            self.assertTrue(np.all(shared.array == self.data))
+            self.assertEqual(shared.array.dtype, np.float32)
+            arr = pickle.loads(pickle.dumps(shared))
+            self.assertTrue(np.all(arr == self.data))
+            # Same memory
+            arr[0, 0, 0] = -1
+            self.assertEqual(shared.array[0, 0, 0], -1)
+        finally:
+            shared.release()
+
+    def testSplit(self):
+        shared = SharedArray.from_array(self.data)
+        try:
+            parts = [pickle.loads(pickle.dumps(part)) for part in shared.split(3, axis=1)]
+            expected = np.array_split(self.data, 3, axis=1)
+            self.assertEqual(len(parts), 3)
+            for part, exp in zip(parts, expected):
+                self.assertEqual(part.shape, exp.shape)
+                self.assertTrue(np.all(part == exp))
+            parts[1][...] = 0
+            self.assertTrue(np.all(shared.array[:, 22:43] == 0))
+        finally:
+            shared.release()
+
+    def testReleaseArrayValid(self):
+        shared = SharedArray.from_array(self.data)
+        shared.release()
+        self.assertTrue(np.all(shared.array == self.data))
+        with self.assertRaises(FileNotFoundError):
+            pickle.loads(pickle.dumps(shared))
+
+    def testCanShare(self):
+        self.assertTrue(sharedmem.can_share(self.data))
+        self.assertFalse(sharedmem.can_share(self.data[:2]))
+        self.assertFalse(sharedmem.can_share(np.zeros(SHAPE, dtype=object)))
+        self.assertFalse(sharedmem.can_share([1, 2, 3]))
+
+    def testShareOutput(self):
+        output = sharedmem.share_arrays((1, True, [self.data, self.data[:2]]))
+        output = pickle.loads(pickle.dumps(output))
+        self.assertEqual(output[:2], (1, True))
+        self.assertTrue(np.all(output[2][0] == self.data))
+        self.assertFalse(output[2][0].flags.owndata)
+        self.assertTrue(np.all(output[2][1] == self.data[:2]))
+
+    def testProcess(self):
+        process = SharedProcess(self.ivm)
+        process.execute({"data" : self.data})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertEqual(process.in_shared, [True, True])
+        self.assertTrue(np.allclose(process.output, self.data + 1))
+        # Output written in place by workers remains valid after the process completes
+        self.assertTrue(np.allclose(process.out.array, self.data * 2))
+        with self.assertRaises(FileNotFoundError):
+            pickle.loads(pickle.dumps(process.out))
+
+    def testProcessNoMultiproc(self):
+        process = SharedProcess(self.ivm, multiproc=False)
+        process.execute({"data" : self.data})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(process.output, self.data + 1))
+        self.assertTrue(np.allclose(process.out.array, self.data * 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -68,7 +68,9 @@ BASIC_PROCESSES = {
     "LoadData" : LoadDataProcess,
     "LoadRois" : LoadRoisProcess,
     "SaveArtifacts" : SaveArtifactsProcess,
-    "SaveExtras" : SaveArtifactsProcess
+    "SaveExtras" : SaveArtifactsProcess,
+    "SaveSession" : SaveSessionProcess,
+    "LoadSession" : LoadSessionProcess,
 }
 
 def to_yaml(processes, indent=""):
@@ -332,6 +334,10 @@ class Script(Process):
                                                  ifnone(generic_params.get("InputId", ""), ""),
                                                  ifnone(generic_params.get("InputSubFolder", ""), "")))
             
+            # Results of processes which support it are cached if enabled generically
+            # or for this case, unless overridden for this process
+            proc_params.setdefault("cache", generic_params.get("Cache", False))
+
             proc_id = proc_params.pop("id")
             process = proc_params.pop("__impl")(self._current_ivm, indir=indir, outdir=outdir, proc_id=proc_id)
             
@@ -370,7 +376,7 @@ class Script(Process):
         if status == Process.SUCCEEDED:
             if len(self._pipeline) > 1:
                 self.log("\nDONE (%.1fs)\n" % (end - self._process_start))
-            self._output_items.extend(self._current_process.output_data_items())
+            self._output_items.extend(self._current_process.get_output_data_items())
             self._next_process()
         else:
             self.log("".join(traceback.format_exception_only(type(exception), exception)))